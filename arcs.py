@@ -0,0 +1,110 @@
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from simplify import SIMPLIFY_TOLERANCE_MM
+
+
+# How far (in mm) a point may be from the fitted circle, and the arc from the line between two points, and still be
+# drawn as part of the arc. Strokes are simplified first, which leaves the points of a curve as far apart as they can be
+# without the curve straying more than SIMPLIFY_TOLERANCE_MM from the lines between them, so this has to be a little
+# more than that (for the wobble of a hand drawn curve) or nothing would be fitted
+ARC_TOLERANCE_MM = 1.5 * SIMPLIFY_TOLERANCE_MM
+
+# The fewest points that will be replaced by an arc, fewer than this are left as straight lines
+MIN_ARC_POINTS = 4
+
+# Circles larger than this (in mm) are effectively straight lines and are left as such
+MAX_ARC_RADIUS_MM = 1000.0
+
+
+class ArcSegment(NamedTuple):
+    # the indexes of the points where the arc starts and ends
+    start: int
+    end: int
+    centre: tuple[float, float]
+    clockwise: bool
+
+
+def fit_arcs(points: np.ndarray, tolerance_mm: float = ARC_TOLERANCE_MM) -> list[ArcSegment]:
+    """
+    Find runs of the (N, 2) points that lie on a circular arc so they can be drawn with a single G2/G3 command.
+
+    Runs are grown greedily from each point for as long as every point in the run stays within tolerance of the circle
+    through the first, middle and last points and the run keeps turning the same way around its centre. The arc
+    between each pair of points must also stay within tolerance of the straight line between them, so that a few
+    points that happen to lie on a circle (e.g. the corners of a square) are still drawn as straight lines.
+    """
+    arcs = []
+    i = 0
+    while i <= len(points) - MIN_ARC_POINTS:
+        best = None
+        for j in range(i + MIN_ARC_POINTS - 1, len(points)):
+            arc = _fit_run(points[i:j + 1], tolerance_mm)
+            if arc is None:
+                break
+            best = j, arc
+        if best is None:
+            i += 1
+        else:
+            j, (centre, clockwise) = best
+            arcs.append(ArcSegment(i, j, centre, clockwise))
+            i = j
+    return arcs
+
+
+def transform_arcs(arcs: list[ArcSegment], matrix: np.ndarray) -> list[ArcSegment]:
+    """
+    Apply the 2x2 transform used for a copy of the points to the arcs fitted to them.
+
+    A transform that mirrors the points (negative determinant) also swaps the direction in which the arcs turn.
+    """
+    if not arcs:
+        return []
+    flip = np.linalg.det(matrix) < 0
+    centres = np.array([arc.centre for arc in arcs]) @ matrix.T
+    return [ArcSegment(arc.start, arc.end, (float(cx), float(cy)), arc.clockwise != flip)
+            for arc, (cx, cy) in zip(arcs, centres)]
+
+
+def reverse_arcs(arcs: list[ArcSegment], n_points: int) -> list[ArcSegment]:
+    """
+    The arcs for drawing the same points in the reverse order.
+    """
+    last = n_points - 1
+    return [ArcSegment(last - arc.end, last - arc.start, arc.centre, not arc.clockwise)
+            for arc in reversed(arcs)]
+
+
+def _fit_run(run: np.ndarray, tolerance_mm: float) -> Optional[tuple[tuple[float, float], bool]]:
+    centre = _circumcentre(run[0], run[len(run) // 2], run[-1])
+    if centre is None:
+        return None
+    offsets = run - centre
+    radii = np.hypot(offsets[:, 0], offsets[:, 1])
+    radius = radii[0]
+    if radius > MAX_ARC_RADIUS_MM or np.any(np.abs(radii - radius) > tolerance_mm):
+        return None
+    # every step must turn the same way around the centre and the whole run must be less than a full circle
+    crosses = offsets[:-1, 0] * offsets[1:, 1] - offsets[:-1, 1] * offsets[1:, 0]
+    dots = np.einsum('ij,ij->i', offsets[:-1], offsets[1:])
+    if not (np.all(crosses > 0) or np.all(crosses < 0)):
+        return None
+    steps = np.abs(np.arctan2(crosses, dots))
+    if np.sum(steps) >= 2 * math.pi - 1e-6:
+        return None
+    # the sagitta, how far the arc bulges away from each chord
+    if np.any(radius * (1 - np.cos(steps / 2)) > tolerance_mm):
+        return None
+    return (float(centre[0]), float(centre[1])), bool(crosses[0] < 0)
+
+
+def _circumcentre(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> Optional[np.ndarray]:
+    d = 2 * (a[0] * (b[1] - c[1]) + b[0] * (c[1] - a[1]) + c[0] * (a[1] - b[1]))
+    if abs(d) < 1e-12:
+        return None  # the points are collinear
+    a2, b2, c2 = a @ a, b @ b, c @ c
+    ux = (a2 * (b[1] - c[1]) + b2 * (c[1] - a[1]) + c2 * (a[1] - b[1])) / d
+    uy = (a2 * (c[0] - b[0]) + b2 * (a[0] - c[0]) + c2 * (b[0] - a[0])) / d
+    return np.array([ux, uy])
@@ -0,0 +1,13 @@
+import os
+from typing import Union
+
+
+def write_atomically(path: str, content: Union[str, bytes]):
+    """
+    Write the content to the file at path, as text if it is a str. It is written to a temporary file beside it that is
+    then renamed over it, so that anything reading the file (or a power cut) never sees half of it.
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
@@ -0,0 +1,193 @@
+import argparse
+import json
+import logging
+import math
+import platform
+import random
+import statistics
+import subprocess
+import time
+from typing import Optional
+
+import drawcore_serial
+import plotter
+from encoder import encode_move
+from drawing import draw_snowflake
+from path_planner import plan_travel
+from session import Session
+from transforms import as_stroke, replicate
+from virtual_drawcore import VirtualDrawCore
+
+logger = logging.getLogger(__name__)
+
+
+ORDERS = [3, 6, 12]
+COMMAND_COUNT = 1000
+MOVE_COUNT = 1000
+ENCODE_COUNT = 100000
+ENCODE_REPEATS = 5
+TRANSFORM_REPEATS = 20
+
+
+def corpus() -> dict[str, list[tuple[float, float]]]:
+    """
+    A fixed set of strokes like the ones drawn with the joystick, the same on every run.
+    """
+    rng = random.Random(42)
+    walk = [(0.0, 0.0)]
+    heading = 0.0
+    for _ in range(300):
+        heading += rng.uniform(-0.3, 0.3)
+        x, y = walk[-1]
+        walk.append((x + 0.5 * math.cos(heading), y + 0.5 * math.sin(heading)))
+    return {
+        "line": [(i * 0.33, 0.0) for i in range(200)],
+        "zigzag": [(i * 2.0, 10.0 * (i % 2)) for i in range(40)],
+        "spiral": [(t * math.cos(t), t * math.sin(t)) for t in (i * 0.05 for i in range(600))],
+        "petal": [(30 + 20 * math.cos(t), 20 * math.sin(t)) for t in (i * math.pi / 100 for i in range(101))],
+        "random_walk": walk,
+    }
+
+
+def session_corpus(path: str) -> dict[str, list[tuple[float, float]]]:
+    with Session(path) as session:
+        strokes = {f"stroke_{i}": stroke.points.tolist() for i, stroke in enumerate(session.strokes())}
+    return strokes
+
+
+def percentile(samples: list[float], p: int) -> float:
+    return statistics.quantiles(samples, n=100)[p - 1]
+
+
+def benchmark_command(port_name: str) -> dict:
+    serial_port = drawcore_serial.test_port(port_name)
+    try:
+        start_time = time.perf_counter()
+        for i in range(COMMAND_COUNT):
+            drawcore_serial.command(serial_port, f"G1G90X{i % 100}.000Y0.000F2000\r")
+        elapsed = time.perf_counter() - start_time
+    finally:
+        drawcore_serial.close_port(serial_port)
+    return {"commands": COMMAND_COUNT, "seconds": elapsed, "commands_per_second": COMMAND_COUNT / elapsed}
+
+
+def benchmark_move_to(plotter_instance: plotter.Plotter) -> dict:
+    latencies = []
+    for i in range(MOVE_COUNT):
+        start_time = time.perf_counter()
+        plotter_instance.move_to(i % 100, 0, feed_rate=2000)
+        latencies.append(time.perf_counter() - start_time)
+    plotter_instance.wait_until_idle()
+    return {"moves": MOVE_COUNT,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000}
+
+
+def benchmark_encode() -> dict:
+    """
+    How many move commands a second can be encoded, without sending them anywhere: by formatting a str and encoding it,
+    as the plotter used to, and by the encoder. The best of ENCODE_REPEATS runs is taken.
+    """
+    rng = random.Random(42)
+    moves = [(rng.uniform(-200, 200), rng.uniform(-200, 200), rng.choice((2000, 4000))) for _ in range(ENCODE_COUNT)]
+
+    def format_moves():
+        for x, y, feed_rate in moves:
+            f"G1G90X{x:.3f}Y{y:.3f}F{feed_rate}\r".encode('ascii')
+
+    def encode_moves():
+        for x, y, feed_rate in moves:
+            encode_move(x, y, feed_rate)
+
+    results = {"commands": ENCODE_COUNT}
+    for name, encode in (("format", format_moves), ("encoder", encode_moves)):
+        seconds = []
+        for _ in range(ENCODE_REPEATS):
+            start_time = time.perf_counter()
+            encode()
+            seconds.append(time.perf_counter() - start_time)
+        results[f"{name}_commands_per_second"] = ENCODE_COUNT / min(seconds)
+    return results
+
+
+def benchmark_snowflake(plotter_instance: plotter.Plotter, strokes: dict[str, list[tuple[float, float]]]) -> list[dict]:
+    results = []
+    for name, drawing in strokes.items():
+        for order in ORDERS:
+            for mirror in (False, True):
+                plotter_instance.move_to(*drawing[-1], feed_rate=8000)
+                plan = plan_travel(replicate(as_stroke(drawing), order, mirror), drawing[-1], drawing[-1])
+                start_time = time.perf_counter()
+                draw_snowflake(plotter_instance, drawing, order, mirror, return_to=drawing[-1])
+                results.append({"stroke": name, "points": len(drawing), "order": order, "mirror": mirror,
+                                "seconds": time.perf_counter() - start_time,
+                                "pen_up_mm": plan.pen_up_mm,
+                                "naive_pen_up_mm": plan.naive_pen_up_mm,
+                                "pen_lifts_saved": plan.lifts_saved})
+    return results
+
+
+def benchmark_transform(strokes: dict[str, list[tuple[float, float]]]) -> list[dict]:
+    results = []
+    for name, drawing in strokes.items():
+        stroke = as_stroke(drawing)
+        for order in ORDERS:
+            copies = replicate(stroke, order, True)
+            start_time = time.perf_counter()
+            for _ in range(TRANSFORM_REPEATS):
+                replicate(stroke, order, True)
+            elapsed = (time.perf_counter() - start_time) / TRANSFORM_REPEATS
+            results.append({"stroke": name, "order": order,
+                            "ns_per_point": elapsed / copies.shape[0] / copies.shape[1] * 1e9})
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(strokes: dict[str, list[tuple[float, float]]], time_scale: float) -> dict:
+    results = {"commit": git_commit(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+               "python": platform.python_version(),
+               "machine": platform.machine(),
+               "time_scale": time_scale}
+    with VirtualDrawCore(time_scale=time_scale) as device:
+        results["command"] = benchmark_command(device.path)
+        for streaming in (False, True):
+            transport = "streaming" if streaming else "blocking"
+            plotter_instance = plotter.Plotter(streaming=streaming)
+            plotter_instance.initialise(device.path)
+            try:
+                plotter_instance.set_origin()
+                results[f"move_to_{transport}"] = benchmark_move_to(plotter_instance)
+                results[f"draw_snowflake_{transport}"] = benchmark_snowflake(plotter_instance, strokes)
+            finally:
+                plotter_instance.close()
+    results["transform"] = benchmark_transform(strokes)
+    results["encode"] = benchmark_encode()
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s [%(levelname)s] %(message)s')
+
+    parser = argparse.ArgumentParser(description="Benchmark the plotting pipeline against a virtual DrawCore")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the results as JSON")
+    parser.add_argument("--session", help="use the strokes from a recorded session rather than the built in corpus")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="multiplier for the simulated motion time, 0 measures only the software and serial time")
+    args = parser.parse_args()
+
+    strokes = session_corpus(args.session) if args.session else corpus()
+    results = run(strokes, args.time_scale)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import logging
+import math
+import time
+from typing import Optional
+
+import metrics
+from plotter import Plotter
+
+logger = logging.getLogger(__name__)
+
+
+# Consecutive moves are joined into one while their headings stay within this angle (in degrees) of each other and
+# their feed rates within this fraction
+COALESCE_ANGLE_TOLERANCE_DEGREES = 3.0
+COALESCE_FEED_TOLERANCE = 0.1
+
+# The longest a move is held back to be joined with those that follow it (in seconds), which is as far as the pen can
+# fall behind the joystick on a straight line
+COALESCE_DEADLINE = 0.3
+
+# A move isn't held back once the plotter would finish the moves it already has within this long (in seconds), so the
+# pen doesn't stop and wait for it
+COALESCE_LEAD_TIME = 0.1
+
+# The six directions of the hexagon are at multiples of this angle (in radians) from the x axis
+_HEXAGON_ANGLE = math.pi / 3
+
+
+def snap_to_hexagon(x: float, y: float) -> tuple[float, float]:
+    """Turn the vector to the nearest of the six directions of a hexagon, keeping its length"""
+    length = math.hypot(x, y)
+    if length == 0:
+        return x, y
+    angle = round(math.atan2(y, x) / _HEXAGON_ANGLE) * _HEXAGON_ANGLE
+    return length * math.cos(angle), length * math.sin(angle)
+
+
+class MoveCoalescer:
+    """
+    Joins up the moves made each control loop iteration while the joystick is held in the same direction, so that a
+    long straight line is drawn with a few long moves rather than a short move per iteration.
+
+    Each move extends the pending move while its heading and feed rate match. The pending move is sent when one
+    doesn't, once it has been held for the deadline, as soon as the plotter is about to run out of moves (by its
+    timeline), or when it is flushed (e.g. when the joystick is let go).
+    """
+    def __init__(self, plotter: Plotter, deadline: float = COALESCE_DEADLINE,
+                 angle_tolerance_degrees: float = COALESCE_ANGLE_TOLERANCE_DEGREES,
+                 feed_tolerance: float = COALESCE_FEED_TOLERANCE, lead_time: float = COALESCE_LEAD_TIME):
+        self.plotter = plotter
+        self.deadline = deadline
+        self.lead_time = lead_time
+        self.angle_tolerance = math.radians(angle_tolerance_degrees)
+        self.feed_tolerance = feed_tolerance
+        self._target = None
+        self._feed_rate = None
+        self._heading = None
+        self._held_since = None
+
+    @property
+    def position(self) -> tuple[float, float]:
+        """Where the pen will be once the pending move has been sent"""
+        return self._target if self._target is not None else (self.plotter.x, self.plotter.y)
+
+    def move_to(self, x: float, y: float, feed_rate: int, now: Optional[float] = None) -> list[tuple[float, float]]:
+        """
+        Move on to the given point, returning the points that were sent to the plotter.
+        """
+        now = time.monotonic() if now is None else now
+        if self._target is not None:
+            heading = math.atan2(y - self._target[1], x - self._target[0])
+            if (_angle_between(heading, self._heading) <= self.angle_tolerance
+                    and abs(feed_rate - self._feed_rate) <= self.feed_tolerance * self._feed_rate):
+                self._target = (x, y)
+                # the pending move is a straight line from where the pen is, so its heading can drift a little
+                self._heading = math.atan2(y - self.plotter.y, x - self.plotter.x)
+                metrics.MOVES_COALESCED.inc()
+                due = now - self._held_since >= self.deadline or self._running_out(now)
+                return self.flush() if due else []
+        sent = self.flush()
+        self._target = (x, y)
+        self._feed_rate = feed_rate
+        self._heading = math.atan2(y - self.plotter.y, x - self.plotter.x)
+        self._held_since = now
+        if self.deadline <= 0 or self._running_out(now):
+            sent.extend(self.flush())
+        return sent
+
+    def _running_out(self, now: float) -> bool:
+        return self.plotter.timeline.remaining(now) <= self.lead_time
+
+    def flush(self) -> list[tuple[float, float]]:
+        """Send the pending move, if there is one, returning the point it moves to"""
+        if self._target is None:
+            return []
+        target, self._target = self._target, None
+        self.plotter.move_to(*target, feed_rate=self._feed_rate)
+        return [target]
+
+
+def _angle_between(a: float, b: float) -> float:
+    return abs((a - b + math.pi) % (2 * math.pi) - math.pi)
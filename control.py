@@ -5,9 +5,17 @@ import time
 import signal
 
 import joystick
+import metrics
 import plotter
 from plotter import MAX_FEED_RATE_PEN_DOWN_MM_MIN
 from drawing import draw_snowflake
+from fanout import create_fanout
+from coalesce import MoveCoalescer, snap_to_hexagon
+from jog import Jogger
+from render import RenderPlotter, render_pattern
+from session import SessionRecorder, new_session_path
+from simplify import MIN_SEGMENT_LENGTH_MM, SIMPLIFY_TOLERANCE_MM, simplify_stroke
+from smoothing import OneEuroFilter, StickFilter
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +28,56 @@ LOOP_SLEEP_TIME = 0.1  # 100ms
 # Safety margin from the edge of the plotter's working area (in mm)
 MARGIN_MM = 30.0
 
+# The serial port of the plotter, e.g. the path printed by virtual_drawcore.py, or None to find an attached DrawCore
+PLOTTER_PORT = None
+
+# Stream commands to the plotter using character counting rather than waiting for each "ok"
+USE_STREAMING_TRANSPORT = True
+
+# Move the pen using the firmware's jog commands, which are cancelled as soon as the joystick is released, rather than
+# a move per loop iteration. This needs GRBL 1.1 style $J= jogging, which not every DrawCore's firmware has, so it is
+# off by default
+USE_JOG_MODE = False
+
+# Smooth the jitter out of the direction the joystick is pushed (with a one euro filter, see smoothing.py) so that the
+# pen makes fewer sharp turns, which the plotter has to slow down for
+USE_STICK_SMOOTHING = True
+STICK_SMOOTHING_MIN_CUTOFF_HZ = 1.5
+STICK_SMOOTHING_BETA = 0.5
+
+# Without jog mode, the moves made while the joystick is held in the same direction are joined up into one (see
+# coalesce.py) while the plotter still has moves to get on with, holding each back for at most this long (in seconds)
+# so the pen falls at most that far behind. 0 to send every move straight away
+MOVE_COALESCE_DEADLINE = 0.3
+
+# Only move in the six directions of a hexagon, which makes snowflake-like patterns more likely
+SNAP_TO_HEXAGON = False
+
+# Draw every pattern on the other attached plotters too (or those listed in FANOUT_PORTS), each at its own pace.
+# FANOUT_OVERRIDES maps a port to the order and/or mirror to use on it, e.g. {"/dev/ttyUSB1": {"order": 8}}
+USE_FANOUT = False
+FANOUT_PORTS = None
+FANOUT_OVERRIDES = {}
+
+# How long to wait for each fanned out plotter to finish the patterns it has waiting when we exit (in seconds)
+FANOUT_CLOSE_TIMEOUT = 60.0
+
+# The port and settings of the plotter are cached in this file so that it is ready sooner the next time we start
+DEVICE_CACHE_PATH = "device_cache.json"
+
+# Every stroke is recorded to a new session file in this directory so that it can be replayed later
+SESSION_DIR = "sessions"
+
+# A preview of the page, with every pattern on it, is written to this PNG as each pattern starts (e.g. for a screen
+# to show while the plot runs), or None to not write one
+PREVIEW_PATH = None
+PREVIEW_WIDTH_PX = 480
+
+# Metrics are dumped to this file (a Prometheus textfile, or JSON if it doesn't end with .prom) on SIGUSR1 and every
+# METRICS_DUMP_INTERVAL seconds
+METRICS_PATH = "metrics.prom"
+METRICS_DUMP_INTERVAL = 10.0
+
 def calculate_distance(x, y):
     """Calculate distance from center (0,0) with pygame coordinates"""
     return math.sqrt(x * x + y * y)  # Returns value 0.0 to 1.0 for unit circle
@@ -54,6 +112,14 @@ def calculate_max_radius(plotter_instance):
         logger.warning(f"No device dimensions available, using fallback radius: {fallback_radius}mm")
         return fallback_radius
 
+def update_preview(preview: RenderPlotter, drawing: list[tuple[float, float]], order: int, mirror: bool):
+    """Add the pattern to the preview of the page and write it out"""
+    render_pattern(drawing, order, mirror, plotter=preview)
+    try:
+        preview.save_png(PREVIEW_PATH, PREVIEW_WIDTH_PX)
+    except OSError as e:
+        logger.warning(f"Failed to write preview {PREVIEW_PATH}: {e}")
+
 def main():
     # Create an event to signal the thread to exit
     exit_event = threading.Event()
@@ -61,6 +127,8 @@ def main():
 
     # Create a thread for joystick reading
     joystick_thread = threading.Thread(target=joystick_instance.read_event_loop, args=(exit_event,))
+    session_recorder = None
+    fanout = None
 
     try:
         # Start the thread
@@ -72,10 +140,21 @@ def main():
             
         # Register signal handler
         signal.signal(signal.SIGINT, signal_handler)
+        metrics.REGISTRY.dump_on_signal(METRICS_PATH)
+        metrics.REGISTRY.dump_periodically(METRICS_PATH, METRICS_DUMP_INTERVAL, exit_event)
 
         # Initialize plotter
-        plotter_instance = plotter.Plotter()
-        plotter_instance.initialise()
+        plotter_instance = plotter.Plotter(streaming=USE_STREAMING_TRANSPORT)
+        plotter_instance.initialise(PLOTTER_PORT, cache_path=DEVICE_CACHE_PATH)
+
+        session_recorder = SessionRecorder(new_session_path(SESSION_DIR))
+        preview = None
+        if PREVIEW_PATH is not None:
+            preview = RenderPlotter(plotter_instance.width_mm, plotter_instance.height_mm)
+
+        if USE_FANOUT:
+            fanout = create_fanout(FANOUT_PORTS, exclude=(plotter_instance.serial_port.name,),
+                                   overrides=FANOUT_OVERRIDES, streaming=USE_STREAMING_TRANSPORT)
 
         # Initialize state variables
         current_drawing = []
@@ -83,13 +162,27 @@ def main():
         mirror = True
         dead_zone = 0.04  # 4% of full range for dead zone
         max_radius = calculate_max_radius(plotter_instance)
+        jogger = Jogger(plotter_instance, max_radius) if USE_JOG_MODE else None
+        coalescer = MoveCoalescer(plotter_instance, deadline=MOVE_COALESCE_DEADLINE,
+                                  lead_time=LOOP_SLEEP_TIME) if jogger is None else None
+        stick_filter = StickFilter()
+        if USE_STICK_SMOOTHING:
+            stick_filter = OneEuroFilter(STICK_SMOOTHING_MIN_CUTOFF_HZ, STICK_SMOOTHING_BETA)
+            logger.info(f"Smoothing the joystick, which adds at most {stick_filter.max_latency * 1000:.0f}ms of lag")
+
+        def settle():
+            # jogs are refused while other moves are running, and other moves shouldn't start in the middle of a jog
+            if jogger is not None:
+                plotter_instance.wait_until_finished()
 
         def home_and_origin():
             def _do():
+                settle()
                 logger.info("Homing and setting origin")
                 plotter_instance.home()
                 plotter_instance.centre()
                 plotter_instance.set_origin()
+                settle()
             plotter_instance.execute_if_idle(_do)
 
         def log_state():
@@ -111,11 +204,25 @@ def main():
 
         def move_to_origin():
             def _do():
+                settle()
                 logger.info("Moving to origin")
                 if not plotter_instance.is_at_origin():
                     plotter_instance.move_to(0, 0, 8000)
+                settle()
             plotter_instance.execute_if_idle(_do)
 
+        def record_points(points):
+            if plotter_instance.is_pen_down():
+                current_drawing.extend(points)
+
+        def needs_attention(state):
+            # whether the joystick has moved out of the dead zone or the pen needs to go down or up
+            if calculate_distance(state["ABS_X"], state["ABS_Y"]) >= dead_zone:
+                return True
+            if plotter_instance.is_pen_up():
+                return state["ABS_Z"] > 0.1
+            return state["ABS_Z"] <= 0.0
+
         # Register callbacks
         joystick_instance.register_button_callback(button="ABS_HAT0Y", value=-1, callback=lambda: change_order(1))
         joystick_instance.register_button_callback(button="ABS_HAT0Y", value=1, callback=lambda: change_order(-1))
@@ -126,7 +233,9 @@ def main():
 
         # Main control loop
         while not exit_event.is_set():
+            loop_start = time.perf_counter()
             sleep_time_start = time.time()
+            joystick_state_version = joystick_instance.version
             joystick_state = joystick_instance.latest_state()
             
             # Read joystick input (in -1.0 to 1.0 range)
@@ -139,51 +248,118 @@ def main():
 
             if joystick_z > 0.1 and plotter_instance.is_pen_up():
                 with plotter_instance.exclusive:
+                    if jogger is not None:
+                        jogger.stop()
+                    if coalescer is not None:
+                        coalescer.flush()
                     plotter_instance.pen_down()
+                    settle()
                     current_drawing.append((plotter_instance.x, plotter_instance.y))
             elif joystick_z <= 0.0 and plotter_instance.is_pen_down():
                 with plotter_instance.exclusive:
+                    if jogger is not None:
+                        record_points(jogger.stop())
+                    if coalescer is not None:
+                        record_points(coalescer.flush())
                     plotter_instance.pen_up()
+                    simplified_drawing = simplify_stroke(current_drawing,
+                                                         tolerance_mm=SIMPLIFY_TOLERANCE_MM,
+                                                         min_segment_mm=MIN_SEGMENT_LENGTH_MM)
+                    session_recorder.record(simplified_drawing, order=order, mirror=mirror)
+                    if fanout is not None and simplified_drawing:
+                        fanout.submit(simplified_drawing, order=order, mirror=mirror)
+                        fanout.log_progress()
+                    if preview is not None and simplified_drawing:
+                        update_preview(preview, simplified_drawing, order=order, mirror=mirror)
                     draw_snowflake(plotter=plotter_instance,
-                                drawing=current_drawing,
+                                drawing=simplified_drawing,
                                 order=order,
                                 mirror=mirror,
                                 return_to=(plotter_instance.x, plotter_instance.y))
                     current_drawing = []
 
-            # Handle movement
+            # Smooth the direction the joystick is pushed in, but not letting go of it so that the pen stops at once
             if distance < dead_zone:
-                feed_rate = 0
-                plotter_instance.check_sleep()
+                stick_filter.reset()
             else:
-                # Scale the feed rate by how far the joystick is pushed
-                feed_rate = map_distance_to_feedrate(distance, MAX_FEED_RATE_PEN_DOWN_MM_MIN)
+                joystick_x, joystick_y = stick_filter.filter(joystick_x, joystick_y, loop_start)
+                metrics.STICK_FILTER_LAG.observe(stick_filter.latency)
+                # the stick is out of the dead zone even if the smoothed position has lagged back into it
+                distance = max(calculate_distance(joystick_x, joystick_y), dead_zone)
+
+            # Handle movement, unless housekeeping (e.g. homing) is using the plotter in which case leave it alone
+            # until that is done
+            have_plotter = plotter_instance.exclusive.acquire(blocking=False)
+            try:
+                if not have_plotter:
+                    feed_rate = None
+                elif distance < dead_zone:
+                    feed_rate = 0
+                    if jogger is not None:
+                        record_points(jogger.stop())
+                    if coalescer is not None:
+                        record_points(coalescer.flush())
+                elif jogger is not None:
+                    # keep a little motion queued ahead of the pen in the direction the joystick is pushed
+                    feed_rate = map_distance_to_feedrate(distance, MAX_FEED_RATE_PEN_DOWN_MM_MIN)
+                    x_direction, y_direction = calculate_components(joystick_y, joystick_x, 1.0)
+                    if SNAP_TO_HEXAGON:
+                        x_direction, y_direction = snap_to_hexagon(x_direction, y_direction)
+                    record_points(jogger.update(x_direction, y_direction, feed_rate))
+                else:
+                    # Scale the feed rate by how far the joystick is pushed
+                    feed_rate = map_distance_to_feedrate(distance, MAX_FEED_RATE_PEN_DOWN_MM_MIN)
                 
-                # Calculate movement for exactly one sleep period
-                movement_scale = feed_rate * (LOOP_SLEEP_TIME / 60)  # Convert from mm/min to mm/sleep_time
-                x_portion_of_distance, y_portion_of_distance = calculate_components(
-                    joystick_y, joystick_x, movement_scale
-                )
-
-                target_x = plotter_instance.x + x_portion_of_distance
-                target_y = plotter_instance.y + y_portion_of_distance
-                distance_from_origin = math.sqrt(target_x ** 2 + target_y ** 2)
-
-                if distance_from_origin <= max_radius:
-                    with plotter_instance.exclusive:
+                    # Calculate movement for exactly one sleep period
+                    movement_scale = feed_rate * (LOOP_SLEEP_TIME / 60)  # Convert from mm/min to mm/sleep_time
+                    x_portion_of_distance, y_portion_of_distance = calculate_components(
+                        joystick_y, joystick_x, movement_scale
+                    )
+                    if SNAP_TO_HEXAGON:
+                        x_portion_of_distance, y_portion_of_distance = snap_to_hexagon(x_portion_of_distance,
+                                                                                       y_portion_of_distance)
+
+                    # carry on from the end of the move that is being held back to be joined up with this one
+                    position_x, position_y = coalescer.position
+                    target_x = position_x + x_portion_of_distance
+                    target_y = position_y + y_portion_of_distance
+                    distance_from_origin = math.sqrt(target_x ** 2 + target_y ** 2)
+
+                    # only add the next move once the plotter is within a loop iteration (and however long moves are
+                    # held back for) of finishing those it has (by the motion model), otherwise moves pile up and the
+                    # pen lags behind the joystick
+                    if distance_from_origin > max_radius:
+                        # we can't go any further this way, so don't hold back the move to the edge
+                        record_points(coalescer.flush())
+                    elif plotter_instance.timeline.remaining() < LOOP_SLEEP_TIME + coalescer.deadline:
+                        # this only queues the move for the serial worker, so it only blocks if the queue is full
                         sleep_time_start = time.time()
-                        plotter_instance.move_to(x=target_x, y=target_y, feed_rate=feed_rate)
+                        sent_points = coalescer.move_to(target_x, target_y, feed_rate)
                         command_taken_time = time.time() - sleep_time_start
                         if command_taken_time > 0.01:
                             logger.info(f"!!!! Command took {command_taken_time} seconds !!!!")
-                    if plotter_instance.is_pen_down():
-                        current_drawing.append((plotter_instance.x, plotter_instance.y))
+                        record_points(sent_points)
+            finally:
+                if have_plotter:
+                    plotter_instance.exclusive.release()
+            if have_plotter and feed_rate == 0:
+                plotter_instance.check_sleep()
+
+            loop_time = time.perf_counter() - loop_start
+            metrics.LOOP_ITERATION.observe(loop_time)
+            if loop_time > LOOP_SLEEP_TIME:
+                metrics.LOOP_OVERRUNS.inc()
 
-            # Small sleep to prevent busy waiting
+            # Wait for the next tick, or while the plotter is idle until the joystick needs attention so we respond at
+            # once
             try:
                 remaining_sleep_time = LOOP_SLEEP_TIME - (time.time() - sleep_time_start)
                 if remaining_sleep_time > 0:
-                    time.sleep(remaining_sleep_time)
+                    if feed_rate == 0:
+                        joystick_instance.wait_for_change(joystick_state_version, remaining_sleep_time,
+                                                          predicate=needs_attention)
+                    else:
+                        time.sleep(remaining_sleep_time)
             except InterruptedError:
                 break
 
@@ -197,11 +373,29 @@ def main():
         
         # Ensure pen is up
         try:
+            if jogger is not None:
+                jogger.stop()
             if plotter_instance.is_pen_down():
                 plotter_instance.pen_up()
             plotter_instance.sleep()
+            plotter_instance.wait_until_idle()
+            plotter_instance.close()
         except:
             pass
+        try:
+            if session_recorder is not None:
+                session_recorder.close()
+        except Exception as e:
+            logger.warning(f"Failed to close the session: {e}")
+        try:
+            if fanout is not None:
+                fanout.close(timeout=FANOUT_CLOSE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Failed to close the other plotters: {e}")
+        try:
+            metrics.REGISTRY.dump(METRICS_PATH)
+        except OSError as e:
+            logger.warning(f"Failed to dump metrics: {e}")
         
         # Wait for the joystick thread to finish
         logger.info("Waiting for joystick thread to terminate...")
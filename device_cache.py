@@ -0,0 +1,53 @@
+import json
+import logging
+from typing import Optional
+
+from atomic_file import write_atomically
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceCache:
+    """
+    The port a DrawCore was last found on and the settings reported by each firmware version we've seen, kept on disk
+    so that starting up can skip searching the serial ports and the full `$$` dump.
+
+    Both are checked by the version query that is made when connecting: the port must answer it and the settings are
+    only used for the same version string. Delete the file if the settings are changed on the device.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.port = None
+        self.profiles = {}
+
+    @classmethod
+    def load(cls, path: str) -> "DeviceCache":
+        cache = cls(path)
+        try:
+            with open(path) as f:
+                content = json.load(f)
+            cache.port = content.get("port")
+            cache.profiles = content.get("profiles", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable device cache {path}: {e}")
+        return cache
+
+    def profile(self, version: str) -> Optional[dict[str, float]]:
+        """The settings last reported by a DrawCore with the given version string, if any"""
+        return self.profiles.get(version)
+
+    def update(self, port: str, version: str, settings: dict[str, float]):
+        """Remember where the DrawCore was found and its settings, saving them if they have changed"""
+        if self.port == port and self.profiles.get(version) == settings:
+            return
+        self.port = port
+        self.profiles[version] = settings
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning(f"Failed to save device cache {self.path}: {e}")
+
+    def save(self):
+        write_atomically(self.path, json.dumps({"port": self.port, "profiles": self.profiles}, indent=2))
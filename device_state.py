@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# How often the streaming transport asks the controller for a status report (in seconds), GRBL suggests no more than
+# five times a second
+STATUS_REPORT_INTERVAL = 0.2
+
+# States in a status report in which the plotter is (or may still be) moving
+MOVING_STATES = ("Run", "Jog", "Hold", "Home")
+
+
+class Status(NamedTuple):
+    state: str
+    # positions are (x, y, z) in mm, the controller reports either the machine or the work position
+    machine_position: Optional[tuple[float, float, float]]
+    work_position: Optional[tuple[float, float, float]]
+    # the work coordinate offset, which is only included in some reports
+    work_offset: Optional[tuple[float, float, float]]
+    # the free space in the planner (in blocks) and in the receive buffer (in bytes), if the report includes it
+    buffer: Optional[tuple[int, int]] = None
+    # the feed rate of the current move (in mm/min), if the report includes it
+    feed_rate: Optional[float] = None
+
+
+def parse_status(report: str) -> Status:
+    """Parse a status report, e.g. `<Idle|MPos:0.000,0.000,0.000|Bf:15,128|FS:0,0|WCO:0.000,0.000,0.000>`"""
+    fields = report.strip().lstrip('<').rstrip('>').split('|')
+    positions = {}
+    buffer = None
+    feed_rate = None
+    for field in fields[1:]:
+        name, _, value = field.partition(':')
+        if name in ("MPos", "WPos", "WCO"):
+            positions[name] = tuple(float(v) for v in value.split(','))
+        elif name == "Bf":
+            blocks, _, rx_bytes = value.partition(',')
+            buffer = (int(blocks), int(rx_bytes))
+        elif name in ("FS", "F"):
+            feed_rate = float(value.split(',')[0])
+    return Status(fields[0], positions.get("MPos"), positions.get("WPos"), positions.get("WCO"), buffer, feed_rate)
+
+
+class DeviceState:
+    """
+    What the plotter last reported about itself: its state (Idle, Run etc.), where it really is, how full its buffers
+    are and any alarm it has raised.
+
+    This is kept up to date by the streaming transport's reader thread from the status reports and alarms it reads, and
+    can be read from any thread. The work coordinate offset isn't in every report, so the last one reported is kept to
+    work out the work position from the machine position.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.status: Optional[Status] = None
+        self.work_offset: Optional[tuple[float, float, float]] = None
+        # the last alarm (e.g. `ALARM:1`), until a status report shows the plotter is out of the alarm state
+        self.alarm: Optional[str] = None
+        # when the last status report was read (in seconds, from time.monotonic) and how many have been read
+        self.updated: Optional[float] = None
+        self.reports = 0
+
+    def update(self, report: str) -> Status:
+        """Record a status report from the plotter, returning the parsed report"""
+        status = parse_status(report)
+        with self._condition:
+            self.status = status
+            if status.work_offset is not None:
+                self.work_offset = status.work_offset
+            if self.alarm is not None and not status.state.startswith("Alarm"):
+                self.alarm = None
+            self.updated = time.monotonic()
+            self.reports += 1
+            self._condition.notify_all()
+        return status
+
+    def raise_alarm(self, alarm: str):
+        """Record an alarm reported by the plotter"""
+        with self._condition:
+            self.alarm = alarm
+            self._condition.notify_all()
+
+    def forget_work_offset(self):
+        """Forget the work coordinate offset, e.g. once the origin has been moved"""
+        with self._condition:
+            self.work_offset = None
+
+    @property
+    def state(self) -> Optional[str]:
+        """The plotter's state without its sub-state (e.g. `Hold` for `Hold:0`), if it has reported it"""
+        return self.status.state.split(':')[0] if self.status is not None else None
+
+    @property
+    def is_idle(self) -> bool:
+        return self.state == "Idle"
+
+    @property
+    def is_moving(self) -> bool:
+        return self.state in MOVING_STATES
+
+    @property
+    def machine_position(self) -> Optional[tuple[float, float, float]]:
+        status = self.status
+        return status.machine_position if status is not None else None
+
+    @property
+    def work_position(self) -> Optional[tuple[float, float, float]]:
+        """Where the plotter is in work coordinates, if it has reported enough to tell"""
+        with self._condition:
+            if self.status is None:
+                return None
+            if self.status.work_position is not None:
+                return self.status.work_position
+            if self.status.machine_position is None or self.work_offset is None:
+                return None
+            return tuple(m - o for m, o in zip(self.status.machine_position, self.work_offset))
+
+    @property
+    def planner_blocks_free(self) -> Optional[int]:
+        status = self.status
+        return status.buffer[0] if status is not None and status.buffer is not None else None
+
+    @property
+    def rx_bytes_free(self) -> Optional[int]:
+        status = self.status
+        return status.buffer[1] if status is not None and status.buffer is not None else None
+
+    def wait_for(self, predicate: Callable[['DeviceState'], bool], timeout: float) -> bool:
+        """
+        Wait until the predicate is true of the state, checking it again after each status report or alarm, returning
+        whether it became true before the timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: predicate(self), timeout=timeout)
@@ -2,13 +2,19 @@
 # drawcore_serial.py
 # Serial connection utilities for DrawCore
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from packaging.version import parse
 import logging
 import time
 import serial
 
+import metrics
+
 logger = logging.getLogger(__name__)
 
+# How long a quick probe waits for a DrawCore to answer a version query (in seconds)
+PROBE_TIMEOUT = 0.5
+
 
 def find_port():
     # Find first available Board by searching USB ports.
@@ -132,10 +138,11 @@ def test_port(port_name):
         return None
 
 
-def open_port():
+def open_port(port_name=None):
     # Find and open a port to a single attached EiBotBoard.
-    # The first port located will be used.
-    found_port = find_port()
+    # The first port located will be used, unless the path of a port is given
+    # (for example the pty of a virtual DrawCore).
+    found_port = port_name if port_name is not None else find_port()
     serial_port = test_port(found_port)
     if serial_port:
         return serial_port
@@ -144,6 +151,81 @@ def open_port():
         return None
 
 
+def probe_port(port_name, timeout=PROBE_TIMEOUT):
+    # Open a serial port and check that a DrawCore answers a single version query within the timeout.
+    # Return the open port (with the usual 1 second timeout) and the version string, or None.
+    try:
+        serial_port = serial.Serial()
+        serial_port.port = port_name
+        serial_port.baudrate = 115200
+        serial_port.timeout = timeout
+        serial_port.rts = 0
+        serial_port.dtr = 0
+        serial_port.open()
+    except serial.SerialException as err:
+        logger.info("Unable to open serial port `{}`: {}".format(port_name, err))
+        return None
+    try:
+        serial_port.reset_input_buffer()
+        serial_port.write('v\r'.encode('ascii'))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = serial_port.readline()
+            if not line:
+                break
+            if line.startswith("DrawCore".encode('ascii')):
+                serial_port.timeout = 1
+                serial_port.reset_input_buffer()
+                return serial_port, line.decode('ascii').strip()
+    except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+        logger.info("Error probing serial port `{}`: {}".format(port_name, err))
+    serial_port.close()
+    return None
+
+
+def probe_ports(port_names, timeout=PROBE_TIMEOUT):
+    # Probe the given ports at the same time, returning the first DrawCore to answer
+    # (the open port and its version string) or None.
+    port_names = list(port_names)
+    if not port_names:
+        return None
+    found = None
+    with ThreadPoolExecutor(max_workers=len(port_names), thread_name_prefix="probe") as executor:
+        futures = [executor.submit(probe_port, port_name, timeout) for port_name in port_names]
+        for future in as_completed(futures):
+            result = future.result()
+            if result is None:
+                continue
+            if found is None:
+                found = result
+            else:
+                close_port(result[0])  # only one DrawCore is used
+    return found
+
+
+def connect(port_name=None, preferred_port=None):
+    # Find and open a DrawCore, returning the open port and its version string, or None.
+    # The given port is used if there is one. Otherwise the preferred port (e.g. where a DrawCore was found last time)
+    # is probed first so that the other ports needn't be listed, and then every attached DrawCore is probed at once.
+    # If none of them answer the quick probe we fall back to the slower, more patient test_port.
+    if port_name is None and preferred_port is not None:
+        result = probe_port(preferred_port)
+        if result is not None:
+            return result
+        logger.info('No DrawCore on {0}, searching for one'.format(preferred_port))
+    if port_name is not None:
+        candidates = [port_name]
+    else:
+        candidates = [port[0] for port in list_drawcore_ports() or []]
+    result = probe_ports(candidates)
+    if result is not None:
+        return result
+    serial_port = open_port(port_name)
+    if serial_port is None:
+        return None
+    return serial_port, query_version(serial_port)
+
+
 def close_port(port_name):
     if port_name is not None:
         try:
@@ -160,21 +242,33 @@ def timestamp():
 def query(port_name, cmd):
     if port_name is not None and cmd is not None:
         response_lines = []
+        cmd_type = metrics.command_type(cmd)
+        start_time = time.perf_counter()
         try:
-            port_name.write(cmd.encode('ascii'))
+            encoded = cmd.encode('ascii')
+            port_name.write(encoded)
+            metrics.BYTES_WRITTEN.inc(len(encoded))
             
             # Keep reading lines until we get an 'ok' or timeout
             while True:
-                line = port_name.readline().decode('ascii').strip()
+                raw = port_name.readline()
+                metrics.BYTES_READ.inc(len(raw))
+                line = raw.decode('ascii').strip()
                 n_retry_count = 0
                 
                 # Handle empty responses with retry
                 while len(line) == 0 and n_retry_count < 20:
-                    line = port_name.readline().decode('ascii').strip()
+                    raw = port_name.readline()
+                    metrics.BYTES_READ.inc(len(raw))
+                    line = raw.decode('ascii').strip()
                     n_retry_count += 1
+                metrics.READ_RETRIES.inc(n_retry_count)
                 
                 # Special case for commands that don't return 'ok'
                 if cmd.split(",")[0].strip().lower() in ["v", "i", "a", "mr", "pi", "qm"]:
+                    if not line:
+                        metrics.TIMEOUTS.inc()
+                    metrics.COMMAND_LATENCY.observe(time.perf_counter() - start_time, type=cmd_type)
                     return line if line else ''
 
                 # If we got a response
@@ -184,45 +278,103 @@ def query(port_name, cmd):
                     response_lines.append(line)
                 else:
                     # No response after retries
+                    metrics.TIMEOUTS.inc()
                     break
             
+            metrics.COMMAND_LATENCY.observe(time.perf_counter() - start_time, type=cmd_type)
             # Return all lines joined with newlines
             return '\n'.join(response_lines) if response_lines else ''
             
         except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+            metrics.ERRORS.inc(type=cmd_type)
             logger.error("Error reading serial data")
             logger.info("Error context:", exc_info=err)
             return ''
 
 
 def command(port_name, cmd):
+    # cmd can be a str, or bytes that are already encoded (e.g. by encoder.py) and are written as they are
     if port_name is not None and cmd is not None:
+        cmd_type = metrics.command_type(cmd)
+        start_time = time.perf_counter()
         try:
-            port_name.write(cmd.encode('ascii'))
+            encoded = cmd if isinstance(cmd, bytes) else cmd.encode('ascii')
+            port_name.write(encoded)
+            metrics.BYTES_WRITTEN.inc(len(encoded))
             response = port_name.readline().decode('ascii')
             n_retry_count = 0
             while len(response) == 0 and n_retry_count < 20:
                 # get new response to replace null response if necessary
                 response = port_name.readline().decode('ascii')
                 n_retry_count += 1
+            metrics.BYTES_READ.inc(len(response))
+            metrics.READ_RETRIES.inc(n_retry_count)
+            metrics.COMMAND_LATENCY.observe(time.perf_counter() - start_time, type=cmd_type)
             if response.strip().startswith("ok"):
                 # Debug option: indicate which command:
                 # inkex.errormsg( 'OK after command: ' + cmd )
                 pass
             else:
+                cmd = _text(cmd)
                 if response:
+                    metrics.ERRORS.inc(type=cmd_type)
                     error_msg = '\n'.join(('Unexpected response from DrawCore.',
                                         '    Command: {0}'.format(cmd.strip()),
                                         '    Response: {0}'.format(response.strip())))
                 else:
+                    metrics.TIMEOUTS.inc()
                     error_msg = 'DrawCore Serial Timeout after command: {0}'.format(cmd)
                 raise ValueError(error_msg)
         except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+            metrics.ERRORS.inc(type=cmd_type)
+            cmd = _text(cmd)
             if cmd.strip().lower() not in ["rb"]:  # Ignore error on reboot (RB) command
                 logger.error('Failed after command: {0}'.format(cmd))
                 logger.info("Error context:", exc_info=err)
 
 
+def _text(cmd) -> str:
+    return cmd.decode('ascii') if isinstance(cmd, bytes) else cmd
+
+
+def query_status(port_name):
+    # Send the realtime status query and return the status report (e.g. "<Idle|MPos:0.000,0.000,0.000|...>"),
+    # which has no 'ok'. Anything else read while waiting for it is skipped.
+    if port_name is not None:
+        start_time = time.perf_counter()
+        try:
+            port_name.write(b'?')
+            metrics.BYTES_WRITTEN.inc(1)
+            for _ in range(20):
+                raw = port_name.readline()
+                metrics.BYTES_READ.inc(len(raw))
+                line = raw.decode('ascii').strip()
+                if line.startswith('<'):
+                    metrics.COMMAND_LATENCY.observe(time.perf_counter() - start_time, type='?')
+                    return line
+                if not line:
+                    break
+            metrics.TIMEOUTS.inc()
+            raise ValueError('DrawCore Serial Timeout waiting for status report')
+        except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+            metrics.ERRORS.inc(type='?')
+            logger.error("Error reading serial data")
+            logger.info("Error context:", exc_info=err)
+            return ''
+
+
+def realtime(port_name, cmd):
+    # Write a realtime command (e.g. jog cancel), which is acted on at once and has no response
+    if port_name is not None:
+        try:
+            port_name.write(cmd)
+            metrics.BYTES_WRITTEN.inc(len(cmd))
+        except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+            metrics.ERRORS.inc(type='realtime')
+            logger.error('Failed after realtime command: {0}'.format(cmd))
+            logger.info("Error context:", exc_info=err)
+
+
 def min_version(port_name, version_string):
     # Query the DrawCore firmware version for the DrawCore located at port_name.
     # Return True if the DrawCore firmware version is at least version_string.
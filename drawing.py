@@ -1,59 +1,192 @@
-import math
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterator, Optional
 
-from plotter import Plotter, MAX_FEED_RATE_PEN_UP_MM_MIN, MAX_FEED_RATE_PEN_DOWN_MM_MIN
+from plotter import Plotter, MAX_FEED_RATE_PEN_DOWN_MM_MIN
+from arcs import ArcSegment, ARC_TOLERANCE_MM, fit_arcs, reverse_arcs, transform_arcs
+from feed_planner import feed_profile, travel_feed_rate
+from motion_model import MotionModel
+from path_planner import plan_travel
+from transforms import as_stroke, replicate, symmetry_matrices
 
+logger = logging.getLogger(__name__)
 
-def draw_snowflake(plotter: Plotter, drawing: list[tuple[float, float]], order: int, mirror: bool, return_to: tuple[float, float]):
+
+# How many transformed strokes the producer may calculate ahead of the plotter
+PIPELINE_DEPTH = 4
+
+# Fitting arcs to a drawing with more points than this takes long enough to keep the plotter waiting (about 30ms at this
+# size, 0.35s for 3000 points), so its first copy is drawn with straight lines while the arcs are fitted for the rest
+DEFER_ARC_FITTING_POINTS = 500
+
+_END_OF_PATTERN = object()
+
+
+def draw_snowflake(plotter: Plotter, drawing: list[tuple[float, float]], order: int, mirror: bool, return_to: tuple[float, float],
+                   arc_tolerance_mm: Optional[float] = ARC_TOLERANCE_MM, wait: bool = True,
+                   include_original: bool = False,
+                   on_progress: Optional[Callable[[int, int], None]] = None) -> float:
+    """
+    Draw the symmetric copies of the drawing and return the time taken to complete the pattern (in seconds).
+
+    The copies are calculated on a producer thread whilst this thread keeps the plotter fed, so that calculating the
+    next copy overlaps with sending the current one rather than pausing the plotter between segments. The order and
+    direction of the copies are planned to minimise the pen-up travel between them. Runs of points that lie on an arc
+    (within arc_tolerance_mm) are drawn as arcs, pass None to only draw straight lines. Each segment is drawn as fast
+    as its curvature and the plotter's limits allow (see feed_planner.py) and pen-up moves at the plotter's maximum
+    rate.
+
+    If not wait, this returns as soon as everything has been sent rather than when the plotter has finished moving.
+    If include_original, the drawing itself is drawn first (e.g. on a plotter it wasn't drawn on by hand). on_progress
+    is called with the number of strokes sent so far and the total after each one.
+    """
     if not drawing:
-        return
-    # we've already drawn the first one, so we can skip it
-    # we need to draw a reflection of the current drawing
-    # and then draw five more and their reflections
-
-    # what are the angles...
-    angle_delta: float = 360 / order
-    angles = [angle_delta * i for i in range(order)]
-    # do we guess from the drawing which is closest or always start with 0?
-
-    # we need to rotate the drawing by 60 degrees
-    for angle in angles[1:]:
-        rotated_drawing = [rotate((0, 0), (x, y), math.radians(angle))
-                           for x, y in drawing]
-        draw(plotter, rotated_drawing)
-
-    # now draw the mirror image
-    if mirror:
-        # mirror on the x-axis
-        mirrored_drawing = [(-x, y) for x, y in drawing]
-        for angle in angles:
-            rotated_drawing = [rotate((0, 0), (x, y), math.radians(angle))
-                               for x, y in mirrored_drawing]
-            draw(plotter, rotated_drawing)
+        return 0.0
+    start_time = time.monotonic()
+
+    strokes = queue.Queue(maxsize=PIPELINE_DEPTH)
+    stop_event = threading.Event()
+    producer = threading.Thread(target=_produce_strokes,
+                                args=(planned_strokes(drawing, order, mirror,
+                                                      start=(plotter.x, plotter.y), end=return_to,
+                                                      arc_tolerance_mm=arc_tolerance_mm,
+                                                      include_original=include_original,
+                                                      model=plotter.motion_model),
+                                      strokes, stop_event),
+                                name="snowflake-producer", daemon=True)
+    producer.start()
+    total = len(symmetry_matrices(order, mirror)) + (1 if include_original else 0)
+    sent = 0
+    try:
+        while (item := strokes.get()) is not _END_OF_PATTERN:
+            if isinstance(item, Exception):
+                raise item
+            stroke, arcs, chained, feed_rates = item
+            draw(plotter, stroke, arcs=arcs, chained=chained, lift_pen=False, feed_rates=feed_rates)
+            sent += 1
+            if on_progress is not None:
+                on_progress(sent, total)
+        if plotter.is_pen_down():
+            plotter.pen_up()
+    finally:
+        stop_event.set()
+        producer.join()
 
     # now return to the start
-    plotter.move_to(*return_to, feed_rate=8000)
+    plotter.move_to(*return_to, feed_rate=travel_feed_rate(plotter.motion_model))
+    if wait:
+        plotter.wait_until_finished()
 
+    elapsed = time.monotonic() - start_time
+    if wait:
+        logger.info(f"Pattern complete in {elapsed:.2f} seconds")
+    else:
+        logger.info(f"Pattern sent in {elapsed:.2f} seconds, "
+                    f"it should be finished in {plotter.timeline.remaining():.2f} seconds")
+    return elapsed
 
-def rotate(origin: tuple[float, float], point: tuple[float, float], angle: float) -> tuple[float, float]:
+
+def planned_strokes(drawing: list[tuple[float, float]], order: int, mirror: bool,
+                    start: tuple[float, float], end: tuple[float, float],
+                    arc_tolerance_mm: Optional[float] = ARC_TOLERANCE_MM, include_original: bool = False,
+                    model: Optional[MotionModel] = None
+                    ) -> Iterator[tuple[list[tuple[float, float]], list[ArcSegment], bool, Optional[list[int]]]]:
     """
-    Rotate a point counterclockwise by a given angle around a given origin.
+    Generate each copy of the drawing in the order and direction that minimises the pen-up travel from start to end.
 
-    The angle should be given in radians.
+    Each copy comes with the arcs fitted to it, whether it starts where the previous one finished, in which case the
+    pen can stay down, and, given the plotter's motion model, the feed rate for each of its segments. The arcs and feed
+    rates are worked out once for the drawing and transformed along with each copy, except that the first copy of a
+    long drawing is drawn with straight lines so that the plotter can start on it while they are worked out. If
+    include_original, the drawing itself comes first and the copies are planned from its end.
     """
-    ox, oy = origin
-    px, py = point
+    stroke = as_stroke(drawing)
+    # usually we've already drawn the first one, so the copies skip it and then include the reflections
+    copies = replicate(stroke, order, mirror)
+    matrices = symmetry_matrices(order, mirror)
+
+    def fitted() -> tuple[list[ArcSegment], Optional[list[int]]]:
+        arcs = fit_arcs(stroke, arc_tolerance_mm) if arc_tolerance_mm is not None else []
+        return arcs, feed_profile(stroke, model, arcs) if model is not None else None
+
+    deferred = arc_tolerance_mm is not None and len(stroke) > DEFER_ARC_FITTING_POINTS
+    if deferred:
+        arcs, feed_rates = [], feed_profile(stroke, model) if model is not None else None
+    else:
+        arcs, feed_rates = fitted()
+    if include_original:
+        yield stroke.tolist(), arcs, False, feed_rates
+        start = tuple(stroke[-1])
+    plan = plan_travel(copies, start, end)
+    for step, ((index, reverse), chained) in enumerate(zip(plan.steps, plan.chained)):
+        if deferred and (include_original or step > 0):
+            arcs, feed_rates = fitted()
+            deferred = False
+        copy_arcs = transform_arcs(arcs, matrices[index])
+        if reverse:
+            reversed_feed_rates = feed_rates[::-1] if feed_rates is not None else None
+            yield copies[index][::-1].tolist(), reverse_arcs(copy_arcs, len(stroke)), chained, reversed_feed_rates
+        else:
+            yield copies[index].tolist(), copy_arcs, chained, feed_rates
+
+
+def _produce_strokes(strokes: Iterator, output: queue.Queue, stop_event: threading.Event):
+    try:
+        for stroke in strokes:
+            if not _put(output, stroke, stop_event):
+                return
+    except Exception as e:
+        _put(output, e, stop_event)
+        return
+    _put(output, _END_OF_PATTERN, stop_event)
+
 
-    qx = ox + math.cos(angle) * (px - ox) - math.sin(angle) * (py - oy)
-    qy = oy + math.sin(angle) * (px - ox) + math.cos(angle) * (py - oy)
-    return qx, qy
+def _put(output: queue.Queue, item, stop_event: threading.Event) -> bool:
+    # keep checking whether the consumer has given up so that we never block forever on a full queue
+    while not stop_event.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
 
 
-def draw(plotter: Plotter, drawing: list[tuple[float, float]]):
-    plotter.pen_up()
-    # move to the start of the line
-    plotter.move_to(*drawing[0], feed_rate=MAX_FEED_RATE_PEN_UP_MM_MIN)
-    plotter.pen_down()
+def draw(plotter: Plotter, drawing: list[tuple[float, float]], arcs: Optional[list[ArcSegment]] = None,
+         chained: bool = False, lift_pen: bool = True, feed_rates: Optional[list[int]] = None):
+    """
+    Draw a line through the given points, drawing the runs of points covered by the arcs as arcs.
+
+    If chained, the pen is already down at the start of the line so it is drawn on from there. If not lift_pen, the
+    pen is left down at the end so that a following line can be chained on to it. feed_rates gives the feed rate for
+    each segment of the line (an arc is drawn at the slowest of those it covers), otherwise it is all drawn at
+    MAX_FEED_RATE_PEN_DOWN_MM_MIN.
+    """
+    if feed_rates is None:
+        feed_rates = [MAX_FEED_RATE_PEN_DOWN_MM_MIN] * (len(drawing) - 1)
+    if not chained or plotter.is_pen_up():
+        if plotter.is_pen_down():
+            plotter.pen_up()
+        # move to the start of the line
+        plotter.move_to(*drawing[0], feed_rate=travel_feed_rate(plotter.motion_model))
+        plotter.pen_down()
     # now draw the rest of the shape with the pen down
-    for x, y in drawing[1:]:
-        plotter.move_to(x, y, feed_rate=MAX_FEED_RATE_PEN_DOWN_MM_MIN)
-    plotter.pen_up()
+    arcs_by_start = {arc.start: arc for arc in arcs or []}
+    if 0 in arcs_by_start and (plotter.x, plotter.y) != tuple(drawing[0]):
+        # a chained line can start a little way from where the last one finished, which an arc can't as the
+        # controller refuses arcs whose ends aren't the same distance from the centre
+        plotter.move_to(*drawing[0], feed_rate=feed_rates[0])
+    i = 1
+    while i < len(drawing):
+        arc = arcs_by_start.get(i - 1)
+        if arc is not None:
+            plotter.arc_to(*drawing[arc.end], *arc.centre, clockwise=arc.clockwise,
+                           feed_rate=min(feed_rates[arc.start:arc.end]))
+            i = arc.end + 1
+        else:
+            plotter.move_to(*drawing[i], feed_rate=feed_rates[i - 1])
+            i += 1
+    if lift_pen:
+        plotter.pen_up()
@@ -0,0 +1,68 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# The commands sent for every move, formatted straight into bytes rather than building a str and then encoding it.
+# Coordinates are written in fixed point to 3 decimal places (a micron), exactly as `f"{x:.3f}"` writes them, and feed
+# rates as whole numbers, so the bytes sent are the same as before
+_MOVE = b"G1G90X%.3fY%.3fF%d\r"
+_ARC = {True: b"G2G90X%.3fY%.3fI%.3fJ%.3fF%d\r", False: b"G3G90X%.3fY%.3fI%.3fJ%.3fF%d\r"}
+_JOG = b"$J=G91X%.3fY%.3fF%d\r"
+_PEN = b"G1G90Z%.1fF%d\r"
+
+
+def encode_move(x: float, y: float, feed_rate: int) -> bytes:
+    return _MOVE % (x, y, feed_rate)
+
+
+def encode_arc(x: float, y: float, i: float, j: float, clockwise: bool, feed_rate: int) -> bytes:
+    """An arc to (x, y) around the centre at the offset (i, j) from where it starts"""
+    return _ARC[clockwise] % (x, y, i, j, feed_rate)
+
+
+def encode_jog(dx: float, dy: float, feed_rate: int) -> bytes:
+    return _JOG % (dx, dy, feed_rate)
+
+
+def encode_pen(z: float, feed_rate: int) -> bytes:
+    return _PEN % (z, feed_rate)
+
+
+class CommandBatch:
+    """
+    A buffer of encoded command lines, so that a run of commands can be handed to the transport at once and written
+    with a single `write()` (as far as the controller's receive buffer allows).
+
+    The lines are appended to one bytearray and written out from memoryviews of it, rather than each being written on
+    its own or joined into a new bytes object. Lines that are waiting to be acknowledged are referred to by their index
+    in the batch rather than copied out of it, so a batch mustn't be changed once it has been written.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        # where each line ends in the buffer (after its \r)
+        self.ends = []
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def add(self, line: bytes):
+        """Add an encoded line, including its terminating \\r"""
+        self.buffer += line
+        self.ends.append(len(self.buffer))
+
+    def start(self, index: int) -> int:
+        """Where the line at index starts in the buffer"""
+        return self.ends[index - 1] if index else 0
+
+    def length(self, index: int) -> int:
+        """The length of the line at index, including its \\r"""
+        return self.ends[index] - self.start(index)
+
+    def text(self, index: int) -> str:
+        """The line at index without its \\r, e.g. for error messages"""
+        return self.buffer[self.start(index):self.ends[index] - 1].decode('ascii')
+
+    def view(self, first: int, last: int) -> memoryview:
+        """The lines from first up to (but not including) last, without copying them"""
+        return memoryview(self.buffer)[self.start(first):self.start(last)]
\ No newline at end of file
@@ -0,0 +1,214 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import drawcore_serial
+from drawing import draw_snowflake
+from plotter import Plotter
+
+logger = logging.getLogger(__name__)
+
+
+# How many patterns can be waiting for each plotter. When a slow plotter has this many waiting new patterns are
+# dropped for it, so that it falls behind rather than holding up the others
+FANOUT_QUEUE_SIZE = 8
+
+_STOP = object()
+
+
+class Job(NamedTuple):
+    drawing: list[tuple[float, float]]
+    order: int
+    mirror: bool
+
+
+class DeviceProgress(NamedTuple):
+    name: str
+    jobs_waiting: int = 0
+    jobs_done: int = 0
+    jobs_dropped: int = 0
+    # strokes of the current pattern that have been sent, out of the total
+    strokes_sent: int = 0
+    strokes_total: int = 0
+    last_duration: Optional[float] = None
+    error: Optional[str] = None
+
+
+class FanoutTarget:
+    """
+    One of the plotters that patterns are fanned out to, drawing them from its own queue on its own thread.
+
+    The order and mirroring of every pattern can be overridden for this plotter. The pattern's original stroke is
+    drawn too, as it was only drawn by hand on the plotter the joystick drives.
+    """
+    def __init__(self, plotter: Plotter, name: str, order: Optional[int] = None, mirror: Optional[bool] = None,
+                 queue_size: int = FANOUT_QUEUE_SIZE):
+        self.plotter = plotter
+        self.name = name
+        self.order = order
+        self.mirror = mirror
+        # replaced rather than modified, so it can be read from any thread
+        self.progress = DeviceProgress(name)
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=f"fanout-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, job: Job) -> bool:
+        """Queue a pattern for this plotter, returning False if it was dropped because too many are waiting"""
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            logger.warning(f"{self.name} is {self._waiting()} patterns behind, dropping this one")
+            self.progress = self.progress._replace(jobs_dropped=self.progress.jobs_dropped + 1)
+            return False
+        self.progress = self.progress._replace(jobs_waiting=self._waiting())
+        return True
+
+    def stop(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stop once the patterns that are waiting have been drawn, waiting up to timeout seconds (or for ever if it is
+        None) and returning whether the thread has finished.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._stopping = True
+        try:
+            self._jobs.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning(f"{self.name} still has {self._waiting()} patterns waiting, not waiting for it to stop")
+            return False
+        self._thread.join(timeout=max(deadline - time.monotonic(), 0.0) if deadline is not None else None)
+        return not self._thread.is_alive()
+
+    def _waiting(self) -> int:
+        # the patterns waiting to be drawn, not counting the marker to stop
+        return self._jobs.qsize() - (1 if self._stopping else 0)
+
+    def _run(self):
+        while (job := self._jobs.get()) is not _STOP:
+            self.progress = self.progress._replace(jobs_waiting=self._waiting(), strokes_sent=0)
+            try:
+                with self.plotter.exclusive:
+                    elapsed = draw_snowflake(plotter=self.plotter,
+                                             drawing=job.drawing,
+                                             order=self.order if self.order is not None else job.order,
+                                             mirror=self.mirror if self.mirror is not None else job.mirror,
+                                             return_to=tuple(job.drawing[-1]),
+                                             include_original=True,
+                                             on_progress=self._on_progress)
+            except Exception as e:
+                logger.error(f"{self.name} failed to draw pattern: {e}")
+                self.progress = self.progress._replace(error=str(e))
+                continue
+            self.progress = self.progress._replace(jobs_done=self.progress.jobs_done + 1, last_duration=elapsed,
+                                                   error=None)
+            logger.info(f"{self.name} drew pattern {self.progress.jobs_done} in {elapsed:.1f} seconds, "
+                        f"{self._waiting()} waiting")
+
+    def _on_progress(self, sent: int, total: int):
+        self.progress = self.progress._replace(strokes_sent=sent, strokes_total=total)
+
+
+class Fanout:
+    """
+    Draws every pattern on several plotters at once, each from its own thread so a slow plotter doesn't hold up the
+    others.
+    """
+    def __init__(self, targets: list[FanoutTarget]):
+        self.targets = targets
+
+    def start(self):
+        for target in self.targets:
+            target.start()
+
+    def submit(self, drawing: list[tuple[float, float]], order: int, mirror: bool):
+        """Queue the pattern for every plotter"""
+        job = Job(list(drawing), order, mirror)
+        for target in self.targets:
+            target.submit(job)
+
+    def progress(self) -> list[DeviceProgress]:
+        return [target.progress for target in self.targets]
+
+    def log_progress(self):
+        """Log how far each plotter has got"""
+        for progress in self.progress():
+            error = f", failed: {progress.error}" if progress.error is not None else ""
+            logger.info(f"{progress.name}: {progress.jobs_done} patterns drawn, {progress.jobs_waiting} waiting, "
+                        f"{progress.jobs_dropped} dropped, stroke {progress.strokes_sent} of {progress.strokes_total}"
+                        f"{error}")
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Finish the patterns that are waiting, waiting up to timeout seconds for each plotter, then park and close the
+        plotters. A plotter that is still drawing after that is left alone, as its thread is still using it.
+        """
+        for target in self.targets:
+            if not target.stop(timeout=timeout):
+                logger.warning(f"{target.name} didn't finish drawing in time, leaving it as it is")
+                continue
+            try:
+                if target.plotter.is_pen_down():
+                    target.plotter.pen_up()
+                target.plotter.sleep()
+                target.plotter.wait_until_idle()
+            except Exception as e:
+                logger.warning(f"Error shutting down {target.name}: {e}")
+            target.plotter.close()
+
+
+def connect_plotters(port_names: Optional[list[str]] = None, exclude: tuple[str, ...] = (),
+                     streaming: bool = True) -> list[Plotter]:
+    """
+    Initialise a plotter on each of the given ports (by default every attached DrawCore, except those excluded) at the
+    same time, then home each one and set its origin at the centre. Ports that fail are logged and left out.
+    """
+    if port_names is None:
+        port_names = [port[0] for port in drawcore_serial.list_drawcore_ports() or []]
+    port_names = [port_name for port_name in port_names if port_name not in exclude]
+
+    def _connect(port_name: str) -> Optional[Plotter]:
+        plotter_instance = Plotter(streaming=streaming)
+        try:
+            plotter_instance.initialise(port_name)
+            plotter_instance.home()
+            plotter_instance.centre()
+            plotter_instance.set_origin()
+            plotter_instance.wait_until_finished()
+        except Exception as e:
+            logger.error(f"Failed to set up the plotter on {port_name}: {e}")
+            plotter_instance.close()
+            return None
+        return plotter_instance
+
+    if not port_names:
+        return []
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(port_names), thread_name_prefix="fanout-connect") as executor:
+        plotters = [plotter_instance for plotter_instance in executor.map(_connect, port_names)
+                    if plotter_instance is not None]
+    logger.info(f"Connected to {len(plotters)} of {len(port_names)} plotters for fan-out "
+                f"in {time.monotonic() - start_time:.1f} seconds")
+    return plotters
+
+
+def create_fanout(port_names: Optional[list[str]] = None, exclude: tuple[str, ...] = (),
+                  overrides: Optional[dict[str, dict]] = None, streaming: bool = True) -> Fanout:
+    """
+    Connect to the plotters (see `connect_plotters`) and start fanning out to them. Overrides maps a port to the order
+    and/or mirror to use for that plotter, e.g. {"/dev/ttyUSB1": {"order": 8, "mirror": False}}.
+    """
+    overrides = overrides or {}
+    targets = []
+    for plotter_instance in connect_plotters(port_names, exclude=exclude, streaming=streaming):
+        name = plotter_instance.serial_port.name
+        override = overrides.get(name, {})
+        targets.append(FanoutTarget(plotter_instance, name, order=override.get("order"), mirror=override.get("mirror")))
+    fanout = Fanout(targets)
+    fanout.start()
+    return fanout
@@ -0,0 +1,71 @@
+import logging
+from typing import Optional
+
+import numpy as np
+
+from arcs import ArcSegment
+from motion_model import MotionModel
+from plotter import MAX_FEED_RATE_PEN_DOWN_MM_MIN
+
+logger = logging.getLogger(__name__)
+
+
+# At a corner pen-down moves are slowed as GRBL's planner slows at a junction, as if they could cut the corner by this
+# much (in mm, like $11 but much larger than the controller's own so that corners drawn with a brush pen stay sharp),
+# so a right angle is drawn at about 900mm/min and a reversal at MIN_FEED_RATE_MM_MIN
+CORNER_DEVIATION_MM = 0.2
+
+# Around curves pen-down moves are slowed so that the acceleration towards the centre of the curve is no more than this
+# (in mm/s^2, nor more than the plotter's $120/$121), which keeps the line from a brush pen even
+CURVE_ACCELERATION_MM_S2 = 500.0
+
+# However tight the curve or corner, pen-down moves go at least this fast (in mm/min)
+MIN_FEED_RATE_MM_MIN = 300
+
+
+def feed_profile(stroke: np.ndarray, model: MotionModel, arcs: Optional[list[ArcSegment]] = None,
+                 max_feed_rate: float = MAX_FEED_RATE_PEN_DOWN_MM_MIN,
+                 curve_acceleration: float = CURVE_ACCELERATION_MM_S2,
+                 corner_deviation: float = CORNER_DEVIATION_MM) -> list[int]:
+    """
+    The feed rate (in mm/min) to draw each segment of the (N, 2) stroke at: as fast as allowed on straight runs (no
+    faster than the fixed pen-down rate) and slower around sharper corners and tighter curves.
+
+    At each point the speed is limited by how sharply the stroke turns there, in the same way as GRBL's junction
+    deviation, and by the curvature of the circle through it and its neighbours, and each segment is limited by the
+    slower of the points at its ends. The segments covered by one of the arcs are limited by the arc's radius
+    instead, as they are drawn with a single move along it. Rotating or reflecting the stroke doesn't change these, so
+    the profile of a stroke can be used for all of its symmetric copies (reversed for copies that are drawn backwards).
+    """
+    if len(stroke) < 2:
+        return []
+    max_feed_rate = min(max_feed_rate, model.max_rates[0], model.max_rates[1])
+    curve_acceleration = min(curve_acceleration, model.accelerations[0], model.accelerations[1])
+
+    before = stroke[1:-1] - stroke[:-2]
+    after = stroke[2:] - stroke[1:-1]
+    across = stroke[2:] - stroke[:-2]
+    # twice the area of the triangle each point makes with its neighbours
+    area = np.abs(before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0])
+    before_lengths = np.linalg.norm(before, axis=1)
+    after_lengths = np.linalg.norm(after, axis=1)
+    sides = before_lengths * after_lengths * np.linalg.norm(across, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        radius = np.where(area > 0, sides / (2 * area), np.inf)
+        # as junction_speed in motion_model.py: going straight on has cos_theta -1 and reversing has cos_theta 1
+        cos_theta = np.clip(-np.einsum('ij,ij->i', before, after) / (before_lengths * after_lengths), -1.0, 1.0)
+        sin_theta_half = np.sqrt(0.5 * (1.0 - np.nan_to_num(cos_theta, nan=-1.0)))
+        corner_speed = np.sqrt(curve_acceleration * corner_deviation * sin_theta_half / (1.0 - sin_theta_half))
+    corner_speed = np.where(sin_theta_half > 0.999999, np.inf, corner_speed)
+    speed = np.minimum(np.sqrt(curve_acceleration * radius), corner_speed)
+    point_feed_rates = np.concatenate(([np.inf], speed * 60, [np.inf]))
+    segment_feed_rates = np.minimum(point_feed_rates[:-1], point_feed_rates[1:])
+    for arc in arcs or []:
+        arc_radius = np.linalg.norm(stroke[arc.start] - arc.centre)
+        segment_feed_rates[arc.start:arc.end] = np.sqrt(curve_acceleration * arc_radius) * 60
+    return np.clip(segment_feed_rates, MIN_FEED_RATE_MM_MIN, max_feed_rate).astype(int).tolist()
+
+
+def travel_feed_rate(model: MotionModel) -> int:
+    """The feed rate (in mm/min) for pen-up moves, as fast as the plotter's $110/$111 allow"""
+    return int(min(model.max_rates[0], model.max_rates[1]))
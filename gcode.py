@@ -0,0 +1,213 @@
+import argparse
+import collections
+import logging
+import os
+import time
+from concurrent.futures import TimeoutError
+from typing import BinaryIO, Callable, NamedTuple, Optional
+
+import drawcore_serial
+from device_cache import DeviceCache
+from drawing import draw_snowflake
+from plotter import Plotter
+from replay import replay
+from transport import ACK_TIMEOUT, RecordingTransport, SerialTimeout, StreamingTransport, split_lines
+
+logger = logging.getLogger(__name__)
+
+
+# How often the streamer reports its progress (in seconds)
+PROGRESS_INTERVAL = 5.0
+
+# How many lines the streamer hands to the transport at once, to be written together
+STREAM_BATCH_SIZE = 16
+
+
+class StreamProgress(NamedTuple):
+    lines_done: int
+    lines_total: int
+    bytes_done: int
+    bytes_total: int
+    elapsed: float
+    # how much longer the job should take (in seconds), once anything has been acknowledged
+    eta: Optional[float]
+
+
+def recording_plotter(output: BinaryIO, settings: Optional[dict[str, float]] = None) -> Plotter:
+    """
+    A plotter that writes everything it would send to output, using the given settings (as reported by `$$`) for the
+    size of the plot area and the motion model.
+    """
+    plotter_instance = Plotter(streaming=True)
+    plotter_instance.transport = RecordingTransport(output)
+    if settings:
+        plotter_instance.apply_settings(settings)
+    return plotter_instance
+
+
+def compile_pattern(output: BinaryIO, drawing: list[tuple[float, float]], order: int, mirror: bool,
+                    return_to: tuple[float, float], start: tuple[float, float] = (0.0, 0.0),
+                    settings: Optional[dict[str, float]] = None, **kwargs) -> int:
+    """
+    Write the commands `draw_snowflake` sends to draw the pattern, starting with the pen up at start, returning the
+    number of bytes written. Any other arguments are passed on to `draw_snowflake`.
+    """
+    plotter_instance = recording_plotter(output, settings)
+    plotter_instance.x, plotter_instance.y = start
+    draw_snowflake(plotter_instance, drawing, order, mirror, return_to, **kwargs)
+    return plotter_instance.transport.bytes_written
+
+
+def compile_session(output: BinaryIO, path: str, settings: Optional[dict[str, float]] = None) -> int:
+    """
+    Write the commands that replaying the recorded session sends (see replay.py), from homing the plotter to sending it
+    to sleep at the end, returning the number of bytes written.
+    """
+    plotter_instance = recording_plotter(output, settings)
+    plotter_instance.home()
+    plotter_instance.centre()
+    plotter_instance.set_origin()
+    replay(plotter_instance, path)
+    if plotter_instance.is_pen_down():
+        plotter_instance.pen_up()
+    plotter_instance.sleep()
+    return plotter_instance.transport.bytes_written
+
+
+def stream_file(transport: StreamingTransport, path: str,
+                on_progress: Optional[Callable[[StreamProgress], None]] = None) -> StreamProgress:
+    """
+    Send the commands in a G-code file (one per line) to the controller as fast as its receive buffer takes them, and
+    wait for them all to be acknowledged. on_progress is called every PROGRESS_INTERVAL seconds and at the end.
+
+    Each line is sent with a terminating \\r, so a compiled job is sent byte for byte as it was compiled.
+    """
+    with open(path, "rb") as f:
+        lines = split_lines(f.read().decode('ascii'))
+    return stream_lines(transport, lines, on_progress)
+
+
+def stream_lines(transport: StreamingTransport, lines: list[str],
+                 on_progress: Optional[Callable[[StreamProgress], None]] = None,
+                 on_acknowledged: Optional[Callable[[int], None]] = None) -> StreamProgress:
+    """
+    Send the commands to the controller as `stream_file` does. on_acknowledged is called with the number of commands
+    acknowledged so far each time another one is.
+    """
+    bytes_total = sum(len(line) + 1 for line in lines)
+    # the futures for the lines that haven't been acknowledged yet, which are acknowledged in order
+    pending = collections.deque()
+    lines_done = 0
+    bytes_done = 0
+    start_time = time.monotonic()
+    last_progress_time = start_time
+    last_ack_time = start_time
+
+    def progress() -> StreamProgress:
+        elapsed = time.monotonic() - start_time
+        eta = elapsed * (bytes_total - bytes_done) / bytes_done if bytes_done else None
+        return StreamProgress(lines_done, len(lines), bytes_done, bytes_total, elapsed, eta)
+
+    def report():
+        nonlocal last_progress_time
+        last_progress_time = time.monotonic()
+        if on_progress is not None:
+            on_progress(progress())
+
+    def acknowledged(future, length: int):
+        nonlocal lines_done, bytes_done, last_ack_time
+        # raises the controller's error, if it had one
+        future.result()
+        pending.popleft()
+        lines_done += 1
+        bytes_done += length
+        last_ack_time = time.monotonic()
+        if on_acknowledged is not None:
+            on_acknowledged(lines_done)
+
+    for first in range(0, len(lines), STREAM_BATCH_SIZE):
+        batch = lines[first:first + STREAM_BATCH_SIZE]
+        pending.extend(zip(transport.send_batch(batch), (len(line) + 1 for line in batch)))
+        while pending and pending[0][0].done():
+            acknowledged(*pending[0])
+        if time.monotonic() - last_progress_time >= PROGRESS_INTERVAL:
+            report()
+
+    while pending:
+        future, length = pending[0]
+        try:
+            future.result(timeout=PROGRESS_INTERVAL)
+        except TimeoutError:
+            if time.monotonic() - last_ack_time > ACK_TIMEOUT:
+                raise SerialTimeout(f"DrawCore Serial Timeout with {len(pending)} commands unacknowledged")
+            report()
+            continue
+        acknowledged(future, length)
+    report()
+    return progress()
+
+
+def log_progress(progress: StreamProgress):
+    eta = f", {progress.eta:.0f} seconds to go" if progress.eta is not None else ""
+    logger.info(f"Sent {progress.lines_done} of {progress.lines_total} commands "
+                f"({100 * progress.bytes_done / max(progress.bytes_total, 1):.1f}%) "
+                f"in {progress.elapsed:.0f} seconds{eta}")
+
+
+def cached_settings(cache_path: str, version: Optional[str] = None) -> Optional[dict[str, float]]:
+    """
+    The settings cached for the given firmware version, or for the only version in the cache if none is given.
+    """
+    cache = DeviceCache.load(cache_path)
+    if version is None and len(cache.profiles) == 1:
+        version = next(iter(cache.profiles))
+    settings = cache.profile(version) if version is not None else None
+    if settings is None:
+        logger.warning(f"No settings cached in {cache_path} for firmware {version or '(unknown)'}, "
+                       f"the default plot area will be used")
+    return settings
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s [%(levelname)s] %(message)s')
+
+    parser = argparse.ArgumentParser(description="Compile recorded sessions to G-code and stream G-code to the plotter")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    compile_parser = subparsers.add_parser("compile", help="compile a recorded session to a G-code file")
+    compile_parser.add_argument("session", help="the session file to compile")
+    compile_parser.add_argument("--output", help="the G-code file to write (defaults to the session's name)")
+    compile_parser.add_argument("--cache", default="device_cache.json",
+                                help="the device cache to take the plotter's settings from")
+    compile_parser.add_argument("--firmware", help="the firmware version whose cached settings to use")
+    stream_parser = subparsers.add_parser("stream", help="stream G-code files to the plotter, one after another")
+    stream_parser.add_argument("files", nargs="+", help="the G-code files to stream")
+    stream_parser.add_argument("--port", help="the serial port of the plotter (defaults to the first DrawCore found)")
+    args = parser.parse_args()
+
+    if args.action == "compile":
+        output_path = args.output or f"{os.path.splitext(args.session)[0]}.gcode"
+        start_time = time.monotonic()
+        with open(output_path, "wb") as output:
+            size = compile_session(output, args.session, cached_settings(args.cache, args.firmware))
+        logger.info(f"Compiled {args.session} to {output_path} ({size} bytes) "
+                    f"in {time.monotonic() - start_time:.1f} seconds")
+        return
+
+    connection = drawcore_serial.connect(args.port)
+    if connection is None:
+        raise Exception("Failed to find plotter.")
+    serial_port, version = connection
+    logger.info(f"Connected to DrawCore version {version} on {serial_port.name}")
+    transport = StreamingTransport(serial_port)
+    try:
+        for path in args.files:
+            logger.info(f"Streaming {path}")
+            progress = stream_file(transport, path, on_progress=log_progress)
+            logger.info(f"Streamed {path} in {progress.elapsed:.1f} seconds")
+    finally:
+        transport.close()
+        drawcore_serial.close_port(serial_port)
+
+
+if __name__ == "__main__":
+    main()
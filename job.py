@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from typing import Callable, Optional
+
+import serial
+
+import drawcore_serial
+from atomic_file import write_atomically
+from gcode import StreamProgress, log_progress, stream_lines
+from transport import SerialTimeout, StreamingTransport, split_lines
+
+logger = logging.getLogger(__name__)
+
+
+# How often a running job saves how far it has got (in seconds)
+CHECKPOINT_INTERVAL = 2.0
+
+# How many times in a row to try to reconnect to the plotter after losing it, and how long to wait before each try
+# (in seconds)
+RECONNECT_ATTEMPTS = 30
+RECONNECT_DELAY = 2.0
+
+# Commands that have been acknowledged may still have been waiting in the controller's planner when the connection was
+# lost (GRBL's holds 16 moves), so a job resumes this many commands before the last one acknowledged
+RESUME_OVERLAP = 16
+
+# The feed rate of the pen-up move back to where a job resumes (in mm/min)
+RESUME_FEED_RATE = 5000
+
+# Errors that mean the connection to the plotter was lost, rather than it refusing a command
+CONNECTION_ERRORS = (serial.SerialException, OSError, ConnectionError, SerialTimeout)
+
+_WORD = re.compile(r"([A-Z])(-?[0-9.]+)")
+
+
+class PlotJob:
+    """
+    A G-code file (e.g. a session compiled by gcode.py) plotted from start to finish, surviving the plotter being
+    unplugged or the program being stopped part way through.
+
+    How many commands the plotter has acknowledged is saved to a checkpoint file beside the job as it runs, and the
+    checkpoint is deleted once the job is finished. If the connection is lost the port is reopened and the job resumes
+    from the checkpoint, as does running the same job again. To resume, the job's own set-up (everything up to and
+    including the first G92, i.e. homing and setting the origin) is sent again, then the pen is lifted, moved to where
+    the plotter was and put back as it was. A job without a G92 (e.g. a single pattern from `compile_pattern`) doesn't
+    say where the plotter was, so it is started again from the beginning instead.
+    """
+    def __init__(self, path: str, checkpoint_path: Optional[str] = None):
+        self.path = path
+        self.checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+        with open(path, "rb") as f:
+            content = f.read()
+        self.lines = split_lines(content.decode('ascii'))
+        # the checkpoint is only used for the same job
+        self.digest = hashlib.sha1(content).hexdigest()
+        self.setup_end = next((i + 1 for i, line in enumerate(self.lines) if line.upper().startswith("G92")), 0)
+        self.lines_done = self._load_checkpoint()
+
+    @property
+    def finished(self) -> bool:
+        return self.lines_done >= len(self.lines)
+
+    def _load_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path) as f:
+                content = json.load(f)
+            if content.get("digest") == self.digest:
+                return min(int(content.get("lines_done", 0)), len(self.lines))
+            logger.warning(f"Ignoring checkpoint {self.checkpoint_path}, which is for a different job")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {self.checkpoint_path}: {e}")
+        return 0
+
+    def save_checkpoint(self):
+        checkpoint = {"path": self.path, "digest": self.digest, "lines_done": self.lines_done}
+        write_atomically(self.checkpoint_path, json.dumps(checkpoint, indent=2))
+
+    def clear_checkpoint(self):
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def resume_from(self) -> int:
+        """The index of the command to resume from"""
+        if self.setup_end == 0:
+            if self.lines_done:
+                logger.warning(f"{self.path} doesn't set the origin, so it can't be resumed and is starting again")
+            return 0
+        if self.lines_done <= self.setup_end:
+            # nothing has been drawn yet, so start again
+            return 0
+        return max(self.setup_end, self.lines_done - RESUME_OVERLAP)
+
+    def resume_commands(self, index: int) -> list[str]:
+        """
+        The commands that put the plotter back as it was before the command at index: the job's set-up, then a pen-up
+        move to where it was and putting the pen back.
+        """
+        if index == 0:
+            return []
+        # the set-up leaves the plotter at the origin
+        x, y, z = 0.0, 0.0, None
+        absolute = True
+        for line in self.lines[self.setup_end:index]:
+            upper = line.upper()
+            if upper.startswith("$"):
+                continue
+            words = dict(_WORD.findall(upper))
+            if words.get("G") == "91":
+                absolute = False
+            elif words.get("G") == "90":
+                absolute = True
+            if "X" in words:
+                x = float(words["X"]) if absolute else x + float(words["X"])
+            if "Y" in words:
+                y = float(words["Y"]) if absolute else y + float(words["Y"])
+            if "Z" in words:
+                z = float(words["Z"]) if absolute else (z or 0.0) + float(words["Z"])
+        commands = self.lines[:self.setup_end]
+        commands += ["G1G90Z0.5F5000", f"G1G90X{x:.3f}Y{y:.3f}F{RESUME_FEED_RATE}"]
+        if z is not None:
+            commands.append(f"G1G90Z{z:.1f}F5000")
+        return commands
+
+    def stream(self, transport: StreamingTransport,
+               on_progress: Optional[Callable[[StreamProgress], None]] = None) -> StreamProgress:
+        """
+        Send the rest of the job, from the checkpoint, saving the checkpoint as the commands are acknowledged.
+        """
+        start = self.resume_from()
+        preamble = self.resume_commands(start)
+        if start:
+            logger.info(f"Resuming {self.path} from command {start} of {len(self.lines)}")
+        else:
+            # starting again, so nothing that was done before counts
+            self.lines_done = 0
+        last_checkpoint_time = time.monotonic()
+
+        def acknowledged(count: int):
+            nonlocal last_checkpoint_time
+            if count > len(preamble):
+                # commands from before the checkpoint may be sent again, which doesn't take it backwards
+                self.lines_done = max(self.lines_done, start + count - len(preamble))
+            if time.monotonic() - last_checkpoint_time >= CHECKPOINT_INTERVAL:
+                last_checkpoint_time = time.monotonic()
+                self.save_checkpoint()
+
+        try:
+            return stream_lines(transport, preamble + self.lines[start:], on_progress, on_acknowledged=acknowledged)
+        finally:
+            self.save_checkpoint()
+
+    def run(self, port_name: Optional[str] = None,
+            on_progress: Optional[Callable[[StreamProgress], None]] = None) -> StreamProgress:
+        """
+        Plot the job (or the rest of it) on the plotter on the given port or the first DrawCore found, deleting the
+        checkpoint once it is finished. If the plotter is lost it is reconnected to, giving up after RECONNECT_ATTEMPTS
+        connections in a row fail to get any further.
+        """
+        serial_port = self._connect(port_name, reconnecting=False)
+        failures = 0
+        while True:
+            transport = StreamingTransport(serial_port)
+            lines_done = self.lines_done
+            try:
+                progress = self.stream(transport, on_progress)
+                break
+            except CONNECTION_ERRORS as err:
+                failures = 0 if self.lines_done > lines_done else failures + 1
+                logger.warning(f"Lost the plotter after {self.lines_done} of {len(self.lines)} commands: {err}")
+                if failures >= RECONNECT_ATTEMPTS:
+                    raise
+            finally:
+                _close(transport, serial_port)
+            serial_port = self._connect(port_name, reconnecting=True)
+        self.clear_checkpoint()
+        return progress
+
+    def _connect(self, port_name: Optional[str], reconnecting: bool):
+        if not reconnecting:
+            connection = drawcore_serial.connect(port_name)
+            if connection is None:
+                raise Exception("Failed to find plotter.")
+            serial_port, version = connection
+            logger.info(f"Connected to DrawCore version {version} on {serial_port.name}")
+            return serial_port
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(RECONNECT_DELAY)
+            serial_port = drawcore_serial.open_port(port_name)
+            if serial_port is not None:
+                logger.info(f"Reconnected to DrawCore on {serial_port.name}")
+                return serial_port
+            logger.info(f"Failed to reconnect to DrawCore (attempt {attempt + 1} of {RECONNECT_ATTEMPTS})")
+        raise Exception("Failed to reconnect to plotter.")
+
+
+def _close(transport: StreamingTransport, serial_port):
+    try:
+        transport.close()
+        drawcore_serial.close_port(serial_port)
+    except (serial.SerialException, OSError) as err:
+        logger.debug(f"Ignoring error closing the lost port: {err}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s [%(levelname)s] %(message)s')
+
+    parser = argparse.ArgumentParser(description="Plot G-code files, resuming them if they were interrupted")
+    parser.add_argument("files", nargs="+", help="the G-code files to plot, one after another")
+    parser.add_argument("--port", help="the serial port of the plotter (defaults to the first DrawCore found)")
+    parser.add_argument("--restart", action="store_true", help="start the jobs again rather than resuming them")
+    args = parser.parse_args()
+
+    for path in args.files:
+        job = PlotJob(path)
+        if args.restart:
+            job.lines_done = 0
+        if job.finished:
+            logger.info(f"{path} has already been plotted")
+            continue
+        logger.info(f"Plotting {path}")
+        progress = job.run(args.port, on_progress=log_progress)
+        logger.info(f"Plotted {path} in {progress.elapsed:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
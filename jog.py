@@ -0,0 +1,97 @@
+import collections
+import logging
+import math
+import time
+
+from plotter import Plotter
+
+logger = logging.getLogger(__name__)
+
+
+# How much motion to keep queued ahead of the pen (in seconds), enough that it doesn't stop between control loop
+# iterations but little enough that a change of direction is picked up quickly
+JOG_LOOKAHEAD_TIME = 0.15
+
+# The shortest jog to send (in seconds), so that we don't flood the plotter with tiny jogs
+MIN_JOG_TIME = 0.02
+
+# How long after the motion model says it should have been reached a point is taken as passed (in seconds), allowing
+# for the time taken to send the jog
+JOG_LAG_TIME = 0.05
+
+# How long to wait for the plotter to stop when the joystick is released (in seconds), which holds up the control loop.
+# Even from the plotter's maximum rate it should take less than this to decelerate
+JOG_STOP_TIMEOUT = 0.3
+
+
+class Jogger:
+    """
+    Moves the plotter continuously in the direction the joystick is pushed using the firmware's jog commands.
+
+    Short incremental jogs are queued so that there is always a little motion ahead of the pen (according to the
+    plotter's motion timeline) and, as they run on into each other, the pen moves smoothly rather than in a series of
+    starts and stops. When the joystick is released the remaining jogs are cancelled straight away.
+    """
+    def __init__(self, plotter: Plotter, max_radius: float):
+        self.plotter = plotter
+        self.max_radius = max_radius
+        # the end of each jog that has been sent with when it should be reached, and the last point that was passed
+        self._pending_points = collections.deque()
+        self._last_point = None
+        self._jogging = False
+
+    @property
+    def jogging(self) -> bool:
+        return self._jogging
+
+    def update(self, x_direction: float, y_direction: float, feed_rate: int) -> list[tuple[float, float]]:
+        """
+        Keep jogging in the given direction (a unit vector) at the given feed rate (in mm/min), returning the points
+        that the pen should have passed since the last update.
+        """
+        now = time.monotonic()
+        jog_time = JOG_LOOKAHEAD_TIME - self.plotter.timeline.remaining(now)
+        if jog_time >= MIN_JOG_TIME and feed_rate > 0:
+            distance = feed_rate / 60 * jog_time
+            target_x = self.plotter.x + x_direction * distance
+            target_y = self.plotter.y + y_direction * distance
+            if math.sqrt(target_x ** 2 + target_y ** 2) <= self.max_radius:
+                if not self._jogging:
+                    self._last_point = (self.plotter.x, self.plotter.y)
+                self.plotter.jog(target_x - self.plotter.x, target_y - self.plotter.y, feed_rate)
+                self._pending_points.append((self.plotter.timeline.finish_time(now), (self.plotter.x, self.plotter.y)))
+                self._jogging = True
+        return self._reached_points(now)
+
+    def stop(self) -> list[tuple[float, float]]:
+        """
+        Cancel any jogging, returning the points that the pen passed since the last update and where it stopped.
+        """
+        if not self._jogging:
+            return []
+        stopped_at = self.plotter.cancel_jog(timeout=JOG_STOP_TIMEOUT)
+        logger.debug(f"Jog cancelled at {stopped_at}")
+        # the points that were passed are those before the jog that the pen stopped part way along
+        path = [self._last_point, *(point for _, point in self._pending_points)]
+        stopped_on = min(range(len(path) - 1), key=lambda i: _distance_to_segment(stopped_at, path[i], path[i + 1]),
+                         default=0)
+        self._pending_points.clear()
+        self._jogging = False
+        return [*path[1:stopped_on + 1], stopped_at]
+
+    def _reached_points(self, now: float) -> list[tuple[float, float]]:
+        points = []
+        while self._pending_points and self._pending_points[0][0] + JOG_LAG_TIME <= now:
+            self._last_point = self._pending_points.popleft()[1]
+            points.append(self._last_point)
+        return points
+
+
+def _distance_to_segment(point: tuple[float, float], start: tuple[float, float], end: tuple[float, float]) -> float:
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    length_squared = dx * dx + dy * dy
+    t = 0.0
+    if length_squared > 0:
+        t = max(0.0, min(1.0, ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length_squared))
+    return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
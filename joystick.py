@@ -1,11 +1,64 @@
-import copy
 import logging
 import threading
+from typing import Callable, Optional
+
 import pygame
 
 logger = logging.getLogger(__name__)
 
 
+# The names of the joystick's controls, in the order they are held in a JoystickState, with their rest state
+STATE_LAYOUT = (
+    ("ABS_X", 0.0),  # main stick left/right (left = -1.0, centre = 0.0, right = 1.0)
+    ("ABS_Y", 0.0),  # main stick up/down (top = -1.0, centre = 0.0, bottom = 1.0)
+    ("ABS_Z", 0.0),  # throttle lever (forwards = -1.0, rest = 0.0, back = 1.0)
+    ("ABS_RZ", 0.0),  # main stick rotate (anti-clockwise = -1.0, rest = 0.0, clockwise = 1.0)
+    ("ABS_THROTTLE", 0.0),  # left/right button behind ABS_Z lever (left = -1.0, rest = 0.0, right = 1.0)
+    ("BTN_TRIGGER", 0),  # 1 main trigger
+    ("BTN_THUMB", 0),  # 2 thumb button
+    ("BTN_THUMB2", 0),  # 3 right hand button
+    ("BTN_TOP", 0),  # 4 top right button
+    ("ABS_HAT0X", 0),  # hat left/right (left = -1, rest = 0, right = 1)
+    ("ABS_HAT0Y", 0),  # hat up/down (top = -1, rest = 0, bottom = 1)
+    ("BTN_TOP2", 0),  # 5 top button on throttle front
+    ("BTN_PINKIE", 0),  # 6 button on throttle front
+    ("BTN_BASE", 0),  # 7 button on throttle front
+    ("BTN_BASE2", 0),  # 8 button on throttle front
+    ("BTN_BASE3", 0),  # 9 button on throttle back
+    ("BTN_BASE4", 0),  # 10 button on throttle back
+    ("BTN_BASE5", 0),  # SE button
+    ("BTN_BASE6", 0),  # ST button
+)
+STATE_INDEX = {name: index for index, (name, _) in enumerate(STATE_LAYOUT)}
+
+# pygame's axis and button numbers mapped to the control's name and its index in a JoystickState
+AXIS_NAMES = ("ABS_X", "ABS_Y", "ABS_Z", "ABS_RZ", "ABS_THROTTLE")
+BUTTON_NAMES = ("BTN_TRIGGER", "BTN_THUMB", "BTN_THUMB2", "BTN_TOP", "BTN_TOP2", "BTN_PINKIE",
+                "BTN_BASE", "BTN_BASE2", "BTN_BASE3", "BTN_BASE4", "BTN_BASE5", "BTN_BASE6")
+_AXES = tuple(STATE_INDEX[name] for name in AXIS_NAMES)
+_BUTTONS = tuple((name, STATE_INDEX[name]) for name in BUTTON_NAMES)
+_HAT_X = STATE_INDEX["ABS_HAT0X"]
+_HAT_Y = STATE_INDEX["ABS_HAT0Y"]
+
+# How long the event loop blocks waiting for a joystick event before checking whether it should exit (in ms)
+EVENT_WAIT_TIMEOUT_MS = 100
+
+
+class JoystickState(tuple):
+    """
+    An immutable snapshot of the joystick's controls, which can be indexed by name (e.g. `state["ABS_X"]`).
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = STATE_INDEX[key]
+        return tuple.__getitem__(self, key)
+
+    def as_dict(self) -> dict:
+        return {name: value for (name, _), value in zip(STATE_LAYOUT, self)}
+
+
 class Joystick:
     def __init__(self):
         # Initialize pygame and joystick subsystem
@@ -21,125 +74,104 @@ class Joystick:
         
         logger.info(f"Initialized joystick: {self._joystick.get_name()}")
         
-        # the rest state for my joystick
-        self._joystick_state = {
-            "ABS_X": 0.0,  # main stick left/right (left = -1.0, centre = 0.0, right = 1.0)
-            "ABS_Y": 0.0,  # main stick up/down (top = -1.0, centre = 0.0, bottom = 1.0)
-            "ABS_Z": 0.0,  # throttle lever (forwards = -1.0, rest = 0.0, back = 1.0)
-            "ABS_RZ": 0.0,  # main stick rotate (anti-clockwise = -1.0, rest = 0.0, clockwise = 1.0)
-            "ABS_THROTTLE": 0.0,  # left/right button behind ABS_Z lever (left = -1.0, rest = 0.0, right = 1.0)
-            "BTN_TRIGGER": 0,  # 1 main trigger
-            "BTN_THUMB": 0,  # 2 thumb button
-            "BTN_THUMB2": 0,  # 3 right hand button
-            "BTN_TOP": 0,  # 4 top right button
-            "ABS_HAT0X": 0,  # hat left/right (left = -1, rest = 0, right = 1)
-            "ABS_HAT0Y": 0,  # hat up/down (top = -1, rest = 0, bottom = 1)
-            "BTN_TOP2": 0,  # 5 top button on throttle front
-            "BTN_PINKIE": 0,  # 6 button on throttle front
-            "BTN_BASE": 0,  # 7 button on throttle front
-            "BTN_BASE2": 0,  # 8 button on throttle front
-            "BTN_BASE3": 0,  # 9 button on throttle back
-            "BTN_BASE4": 0,  # 10 button on throttle back
-            "BTN_BASE5": 0,  # SE button
-            "BTN_BASE6": 0,  # ST button
-        }
+        self._values = [rest for _, rest in STATE_LAYOUT]
+        # the latest snapshot is replaced, never modified, so readers can take it without a lock
+        self._state = JoystickState(self._values)
+        self._version = 0
         self._button_callbacks = {}
         self.lock = threading.Lock()
+        self._changed = threading.Condition(self.lock)
         self._exit_event = None
 
-    def latest_state(self):
-        with self.lock:
-            return copy.deepcopy(self._joystick_state)
+    @property
+    def version(self) -> int:
+        """
+        A number that increases whenever the state of the joystick changes.
+        """
+        return self._version
+
+    def latest_state(self) -> JoystickState:
+        return self._state
+
+    def wait_for_change(self, version: int, timeout: float,
+                        predicate: Optional[Callable[[JoystickState], bool]] = None) -> JoystickState:
+        """
+        Wait until the state of the joystick has changed since the given version (and satisfies the predicate, if one
+        is given) or the timeout (in seconds) expires, returning the latest state.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._version != version and (predicate is None or predicate(self._state)),
+                timeout=timeout
+            )
+            return self._state
 
     def check_events(self):
         """Non-blocking event check"""
-        for event in pygame.event.get():
-            callbacks = []
-            
-            with self.lock:
+        self._handle_events(pygame.event.get())
+
+    def _handle_events(self, events):
+        callbacks = []
+        values = self._values
+        with self.lock:
+            changed = False
+            for event in events:
                 if event.type == pygame.JOYAXISMOTION:
-                    if event.axis == 0:  # X axis
-                        self._joystick_state["ABS_X"] = event.value
-                    elif event.axis == 1:  # Y axis
-                        self._joystick_state["ABS_Y"] = event.value
-                    elif event.axis == 2:  # Throttle (Z)
-                        self._joystick_state["ABS_Z"] = event.value
-                    elif event.axis == 3:  # Rotation (RZ)
-                        self._joystick_state["ABS_RZ"] = event.value
-                    elif event.axis == 4:  # Throttle lever
-                        self._joystick_state["ABS_THROTTLE"] = event.value
-                
+                    if event.axis < len(_AXES):
+                        index = _AXES[event.axis]
+                        if values[index] != event.value:
+                            values[index] = event.value
+                            changed = True
+
                 elif event.type == pygame.JOYHATMOTION:
                     if event.hat == 0:  # Assuming first (and only) hat
                         x, y = event.value
-                        old_x = self._joystick_state["ABS_HAT0X"]
-                        old_y = self._joystick_state["ABS_HAT0Y"]
-                        self._joystick_state["ABS_HAT0X"] = x
-                        self._joystick_state["ABS_HAT0Y"] = -y  # Pygame uses opposite Y convention
-                        
+                        y = -y  # Pygame uses opposite Y convention
                         # Check for hat callbacks
-                        if x != old_x and (("ABS_HAT0X", x) in self._button_callbacks):
-                            callbacks.append(self._button_callbacks[("ABS_HAT0X", x)])
-                        if -y != old_y and (("ABS_HAT0Y", -y) in self._button_callbacks):
-                            callbacks.append(self._button_callbacks[("ABS_HAT0Y", -y)])
-                
-                elif event.type == pygame.JOYBUTTONDOWN:
-                    button_mapping = {
-                        0: "BTN_TRIGGER",
-                        1: "BTN_THUMB",
-                        2: "BTN_THUMB2",
-                        3: "BTN_TOP",
-                        4: "BTN_TOP2",
-                        5: "BTN_PINKIE",
-                        6: "BTN_BASE",
-                        7: "BTN_BASE2",
-                        8: "BTN_BASE3",
-                        9: "BTN_BASE4",
-                        10: "BTN_BASE5",
-                        11: "BTN_BASE6"
-                    }
-                    if event.button in button_mapping:
-                        button_name = button_mapping[event.button]
-                        self._joystick_state[button_name] = 1
-                        if (button_name, 1) in self._button_callbacks:
-                            callbacks.append(self._button_callbacks[(button_name, 1)])
-                
-                elif event.type == pygame.JOYBUTTONUP:
-                    button_mapping = {
-                        0: "BTN_TRIGGER",
-                        1: "BTN_THUMB",
-                        2: "BTN_THUMB2",
-                        3: "BTN_TOP",
-                        4: "BTN_TOP2",
-                        5: "BTN_PINKIE",
-                        6: "BTN_BASE",
-                        7: "BTN_BASE2",
-                        8: "BTN_BASE3",
-                        9: "BTN_BASE4",
-                        10: "BTN_BASE5",
-                        11: "BTN_BASE6"
-                    }
-                    if event.button in button_mapping:
-                        button_name = button_mapping[event.button]
-                        self._joystick_state[button_name] = 0
-                        if (button_name, 0) in self._button_callbacks:
-                            callbacks.append(self._button_callbacks[(button_name, 0)])
-
-            # Execute callbacks outside the lock
-            for callback in callbacks:
-                callback()
+                        if x != values[_HAT_X]:
+                            values[_HAT_X] = x
+                            changed = True
+                            if ("ABS_HAT0X", x) in self._button_callbacks:
+                                callbacks.append(self._button_callbacks[("ABS_HAT0X", x)])
+                        if y != values[_HAT_Y]:
+                            values[_HAT_Y] = y
+                            changed = True
+                            if ("ABS_HAT0Y", y) in self._button_callbacks:
+                                callbacks.append(self._button_callbacks[("ABS_HAT0Y", y)])
+
+                elif event.type == pygame.JOYBUTTONDOWN or event.type == pygame.JOYBUTTONUP:
+                    if event.button < len(_BUTTONS):
+                        button_name, index = _BUTTONS[event.button]
+                        value = 1 if event.type == pygame.JOYBUTTONDOWN else 0
+                        values[index] = value
+                        changed = True
+                        if (button_name, value) in self._button_callbacks:
+                            callbacks.append(self._button_callbacks[(button_name, value)])
+
+            if changed:
+                # publish a new snapshot once for the whole batch of events
+                self._state = JoystickState(values)
+                self._version += 1
+                self._changed.notify_all()
+
+        # Execute callbacks outside the lock
+        for callback in callbacks:
+            callback()
 
     def read_event_loop(self, exit_event):
         """
-        Main event loop that continuously checks for joystick events
+        Main event loop that blocks waiting for joystick events
         """
         self._exit_event = exit_event
         logger.info("Starting joystick event loop")
         
         try:
             while not exit_event.is_set():
-                self.check_events()
-                pygame.time.wait(10)  # Small sleep to prevent busy waiting
+                event = pygame.event.wait(EVENT_WAIT_TIMEOUT_MS)
+                if event.type == pygame.NOEVENT:
+                    continue
+                # handle the event that woke us along with any others that are already waiting
+                self._handle_events([event, *pygame.event.get()])
         
         except Exception as e:
             logger.error(f"Error in joystick event loop: {e}")
@@ -0,0 +1,235 @@
+import bisect
+import json
+import logging
+import re
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union
+
+from atomic_file import write_atomically
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds of the latency histogram buckets (in seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_COMMAND_TYPE = re.compile(r"^\s*(\$[A-Za-z$]*|[A-Za-z][0-9.]*)")
+_ENCODED_COMMAND_TYPE = re.compile(_COMMAND_TYPE.pattern.encode('ascii'))
+
+
+def command_type(cmd: Union[str, bytes]) -> str:
+    """
+    The type of a command for labelling metrics, e.g. 'G1' for 'G1G90X1.000Y2.000F2000' or '$H' for '$H'.
+    """
+    if isinstance(cmd, bytes):
+        match = _ENCODED_COMMAND_TYPE.match(cmd)
+        return match.group(1).decode('ascii').upper() if match else "other"
+    match = _COMMAND_TYPE.match(cmd)
+    return match.group(1).upper() if match else "other"
+
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_key(labels), 0)
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            return [{"labels": dict(key), "value": value} for key, value in self._values.items()]
+
+    def prometheus(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for sample in self.snapshot():
+            lines.append(f"{self.name}{_format_labels(sample['labels'])} {sample['value']}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # for each set of labels: the count in each bucket (plus +Inf), the sum and the count of observations
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def count(self, **labels) -> int:
+        values = self._values.get(_key(labels))
+        return values[2] if values else 0
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            return [{"labels": dict(key),
+                     "buckets": dict(zip([*map(str, self.buckets), "+Inf"], counts)),
+                     "sum": total,
+                     "count": count}
+                    for key, (counts, total, count) in self._values.items()]
+
+    def prometheus(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for sample in self.snapshot():
+            cumulative = 0
+            for bound, count in sample["buckets"].items():
+                cumulative += count
+                labels = _format_labels({**sample["labels"], "le": bound})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(sample["labels"])
+            lines.append(f"{self.name}_sum{labels} {sample['sum']}")
+            lines.append(f"{self.name}_count{labels} {sample['count']}")
+        return lines
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+class Registry:
+    """
+    The metrics for the process, which can be read in-process or dumped as JSON or a Prometheus textfile.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get_or_create(name, lambda: Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(name, help, buckets))
+
+    def _get_or_create(self, name, create):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = create()
+            return self._metrics[name]
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in list(self._metrics.items())}
+
+    def prometheus(self) -> str:
+        return "\n".join(line for metric in list(self._metrics.values()) for line in metric.prometheus()) + "\n"
+
+    def dump(self, path: str):
+        """
+        Write the metrics to the given path, as a Prometheus textfile if it ends with .prom otherwise as JSON.
+        """
+        if path.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps({"timestamp": time.time(), "metrics": self.snapshot()}, indent=2)
+        write_atomically(path, content)
+
+    def dump_on_signal(self, path: str, signum: int = signal.SIGUSR1):
+        """
+        Dump the metrics to the given path whenever the process receives the signal (this must be called from the
+        main thread).
+        """
+        signal.signal(signum, lambda received_signum, frame: self._dump_logging_errors(path))
+
+    def dump_periodically(self, path: str, interval: float, exit_event: threading.Event) -> threading.Thread:
+        """
+        Dump the metrics to the given path every interval seconds until the exit event is set.
+        """
+        def _run():
+            while not exit_event.wait(interval):
+                self._dump_logging_errors(path)
+        thread = threading.Thread(target=_run, name="metrics-dump", daemon=True)
+        thread.start()
+        return thread
+
+    def _dump_logging_errors(self, path: str):
+        try:
+            self.dump(path)
+        except OSError as e:
+            logger.warning(f"Failed to dump metrics to {path}: {e}")
+
+
+REGISTRY = Registry()
+
+# The metrics for the hot paths, shared by the modules that update them
+COMMAND_LATENCY = REGISTRY.histogram("drawcore_command_seconds",
+                                     "Time from writing a command to its response, by command type")
+BYTES_WRITTEN = REGISTRY.counter("drawcore_bytes_written_total", "Bytes written to the DrawCore")
+WRITES = REGISTRY.counter("drawcore_writes_total", "Writes to the DrawCore, each of one or more commands")
+BYTES_READ = REGISTRY.counter("drawcore_bytes_read_total", "Bytes read from the DrawCore")
+READ_RETRIES = REGISTRY.counter("drawcore_read_retries_total", "Empty reads retried while waiting for a response")
+TIMEOUTS = REGISTRY.counter("drawcore_timeouts_total", "Commands that timed out waiting for a response")
+ERRORS = REGISTRY.counter("drawcore_errors_total", "Error responses and serial errors, by command type")
+MOVE_TO_LATENCY = REGISTRY.histogram("plotter_move_to_seconds", "Time taken by calls to Plotter.move_to")
+LOCK_WAIT = REGISTRY.histogram("plotter_exclusive_wait_seconds", "Time spent waiting to acquire Plotter.exclusive")
+LOOP_ITERATION = REGISTRY.histogram("control_loop_iteration_seconds",
+                                    "Time taken by each control loop iteration, before sleeping")
+LOOP_OVERRUNS = REGISTRY.counter("control_loop_overruns_total",
+                                 "Control loop iterations that took longer than the loop period")
+STICK_FILTER_LAG = REGISTRY.histogram("control_stick_filter_lag_seconds",
+                                      "How far the smoothed joystick position lags behind the stick")
+MOVES_COALESCED = REGISTRY.counter("control_moves_coalesced_total",
+                                  "Moves that were joined on to the previous move rather than sent")
+
+
+class InstrumentedLock:
+    """
+    A lock that records how long callers wait to acquire it.
+    """
+    def __init__(self, wait_histogram: Histogram):
+        self._lock = threading.Lock()
+        self._wait_histogram = wait_histogram
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start_time = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired and blocking:
+            self._wait_histogram.observe(time.perf_counter() - start_time)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
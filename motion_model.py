@@ -0,0 +1,280 @@
+import collections
+import logging
+import math
+import threading
+import time
+from typing import NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+# Used for any settings the controller doesn't report, the same as the virtual DrawCore's
+DEFAULT_JUNCTION_DEVIATION_MM = 0.010  # $11
+DEFAULT_MAX_RATES_MM_MIN = (10000.0, 10000.0, 5000.0)  # $110, $111, $112
+DEFAULT_ACCELERATIONS_MM_S2 = (1000.0, 1000.0, 1000.0)  # $120, $121, $122
+
+# How many moves the controller's planner holds (GRBL's BLOCK_BUFFER_SIZE, the same as the virtual DrawCore's), which
+# is as far ahead as it can plan
+PLANNER_BLOCK_COUNT = 16
+
+
+class Block(NamedTuple):
+    # a planned move
+    start: tuple[float, float, float]
+    target: tuple[float, float, float]
+    length: float
+    # unit vector of the direction of travel at the end of the move
+    direction: tuple[float, float, float]
+    nominal_speed: float  # mm/s
+    acceleration: float  # mm/s^2
+    # jogs can be cancelled, other moves can't
+    jog: bool = False
+
+
+def trapezoid_time(length: float, entry_speed: float, nominal_speed: float, exit_speed: float,
+                   acceleration: float) -> float:
+    """
+    The time (in seconds) to move the given length accelerating from the entry speed up to at most the nominal speed
+    and decelerating to the exit speed.
+    """
+    if length <= 0:
+        return 0.0
+    acceleration_distance = (nominal_speed ** 2 - entry_speed ** 2) / (2 * acceleration)
+    deceleration_distance = (nominal_speed ** 2 - exit_speed ** 2) / (2 * acceleration)
+    if acceleration_distance + deceleration_distance <= length:
+        cruise_distance = length - acceleration_distance - deceleration_distance
+        return ((nominal_speed - entry_speed) / acceleration + (nominal_speed - exit_speed) / acceleration
+                + cruise_distance / nominal_speed)
+    # a triangular profile, never reaching the nominal speed
+    peak_speed = math.sqrt((2 * acceleration * length + entry_speed ** 2 + exit_speed ** 2) / 2)
+    return (peak_speed - entry_speed) / acceleration + (peak_speed - exit_speed) / acceleration
+
+
+def trapezoid_distance(elapsed: float, length: float, entry_speed: float, nominal_speed: float, exit_speed: float,
+                       acceleration: float) -> float:
+    """
+    How far (in mm) along a move with the same profile as `trapezoid_time` we are after the given time (in seconds).
+    """
+    if length <= 0 or elapsed <= 0:
+        return 0.0
+    peak_speed = min(nominal_speed, math.sqrt((2 * acceleration * length + entry_speed ** 2 + exit_speed ** 2) / 2))
+    acceleration_time = max(0.0, peak_speed - entry_speed) / acceleration
+    acceleration_distance = (peak_speed ** 2 - entry_speed ** 2) / (2 * acceleration)
+    deceleration_distance = (peak_speed ** 2 - exit_speed ** 2) / (2 * acceleration)
+    cruise_time = max(0.0, length - acceleration_distance - deceleration_distance) / peak_speed
+    if elapsed <= acceleration_time:
+        return entry_speed * elapsed + 0.5 * acceleration * elapsed ** 2
+    if elapsed <= acceleration_time + cruise_time:
+        return acceleration_distance + peak_speed * (elapsed - acceleration_time)
+    decelerating = elapsed - acceleration_time - cruise_time
+    distance = (length - deceleration_distance) + peak_speed * decelerating - 0.5 * acceleration * decelerating ** 2
+    return min(length, distance)
+
+
+def junction_speed(previous: Block, following: Block, junction_deviation: float) -> float:
+    """
+    The fastest speed (in mm/s) to pass from one move to the next, as worked out by GRBL's planner.
+    """
+    cos_theta = -sum(a * b for a, b in zip(previous.direction, following.direction))
+    limit = min(previous.nominal_speed, following.nominal_speed)
+    if cos_theta < -0.999999:
+        return limit  # straight on
+    if cos_theta > 0.999999:
+        return 0.0  # reversing
+    sin_theta_half = math.sqrt(0.5 * (1.0 - cos_theta))
+    acceleration = min(previous.acceleration, following.acceleration)
+    return min(limit, math.sqrt(acceleration * junction_deviation * sin_theta_half / (1.0 - sin_theta_half)))
+
+
+class MotionModel:
+    """
+    A trapezoidal model of how the controller moves, using its acceleration, max rate and junction deviation settings.
+    """
+    def __init__(self, junction_deviation: float = DEFAULT_JUNCTION_DEVIATION_MM,
+                 max_rates: Sequence[float] = DEFAULT_MAX_RATES_MM_MIN,
+                 accelerations: Sequence[float] = DEFAULT_ACCELERATIONS_MM_S2):
+        self.junction_deviation = junction_deviation
+        self.max_rates = tuple(max_rates)
+        self.accelerations = tuple(accelerations)
+
+    @classmethod
+    def from_settings(cls, settings: dict[str, float]) -> "MotionModel":
+        """Create a model from the settings reported by `$$`"""
+        return cls(settings.get("$11", DEFAULT_JUNCTION_DEVIATION_MM),
+                   tuple(settings.get(f"$11{i}", DEFAULT_MAX_RATES_MM_MIN[i]) for i in range(3)),
+                   tuple(settings.get(f"$12{i}", DEFAULT_ACCELERATIONS_MM_S2[i]) for i in range(3)))
+
+    def block(self, start: tuple[float, float, float], target: tuple[float, float, float], feed_rate: float,
+              motion: int = 1, centre: Optional[tuple[float, float]] = None, jog: bool = False) -> Optional[Block]:
+        """
+        The block for a move (G0, G1 or, around the given centre, G2/G3) at the given feed rate (in mm/min), or None
+        if it doesn't go anywhere.
+        """
+        delta = [t - s for s, t in zip(start, target)]
+        if motion in (2, 3):
+            radius = math.hypot(start[0] - centre[0], start[1] - centre[1])
+            start_angle = math.atan2(start[1] - centre[1], start[0] - centre[0])
+            end_angle = math.atan2(target[1] - centre[1], target[0] - centre[0])
+            sweep = end_angle - start_angle
+            if motion == 2 and sweep >= 0:
+                sweep -= 2 * math.pi
+            elif motion == 3 and sweep <= 0:
+                sweep += 2 * math.pi
+            length = math.hypot(abs(sweep) * radius, delta[2])
+            # the direction of travel at the end of the arc is the tangent there
+            sign = -1 if motion == 2 else 1
+            direction = (-sign * math.sin(end_angle), sign * math.cos(end_angle), 0.0)
+        else:
+            length = math.sqrt(sum(d * d for d in delta))
+            direction = tuple(d / length for d in delta) if length else (0.0, 0.0, 0.0)
+        if length == 0:
+            return None
+
+        axes = [i for i in range(3) if delta[i] or (i < 2 and motion in (2, 3))]
+        max_rate = min(self.max_rates[i] for i in axes)
+        speed = max_rate if motion == 0 else min(feed_rate, max_rate)
+        acceleration = min(self.accelerations[i] for i in axes)
+        return Block(start, target, length, direction, speed / 60, acceleration, jog)
+
+    def plan(self, blocks: Sequence[Block], entry_speed: float = 0.0,
+             exit_speed: float = 0.0) -> list[tuple[float, float]]:
+        """
+        The entry and exit speed (in mm/s) of each of a sequence of blocks, as GRBL's planner would work them out.
+        """
+        if not blocks:
+            return []
+        # the fastest we can pass from each block to the next, then slowed so we can always stop in time (backwards)
+        # and can reach each speed in time (forwards)
+        exits = [junction_speed(block, following, self.junction_deviation)
+                 for block, following in zip(blocks, blocks[1:])] + [exit_speed]
+        for i in range(len(blocks) - 1, 0, -1):
+            exits[i - 1] = min(exits[i - 1], math.sqrt(exits[i] ** 2 + 2 * blocks[i].acceleration * blocks[i].length))
+        speeds = []
+        entry = entry_speed
+        for block, block_exit in zip(blocks, exits):
+            block_exit = min(block_exit, math.sqrt(entry ** 2 + 2 * block.acceleration * block.length))
+            speeds.append((entry, block_exit))
+            entry = block_exit
+        return speeds
+
+    def durations(self, blocks: Sequence[Block], entry_speed: float = 0.0, exit_speed: float = 0.0) -> list[float]:
+        """The time (in seconds) each of a sequence of blocks will take"""
+        return [trapezoid_time(block.length, entry, block.nominal_speed, block_exit, block.acceleration)
+                for block, (entry, block_exit) in zip(blocks, self.plan(blocks, entry_speed, exit_speed))]
+
+    def path_duration(self, points: Sequence[tuple[float, float]], feed_rate: float) -> float:
+        """The time (in seconds) to move through the given points (with the pen at a constant height)"""
+        blocks = [self.block((*start, 0.0), (*end, 0.0), feed_rate) for start, end in zip(points, points[1:])]
+        return sum(self.durations([block for block in blocks if block is not None]))
+
+
+class _TimedBlock:
+    def __init__(self, block: Block):
+        self.block = block
+        self.entry_speed = 0.0
+        self.exit_speed = 0.0
+        self.start_time = 0.0
+        self.finish_time = 0.0
+
+
+class MotionTimeline:
+    """
+    The moves that have been sent to the plotter with when each should start and finish, which is used to send more
+    moves just before the plotter runs out and to estimate where the pen is.
+
+    As each move is added the moves that haven't finished yet and would still be in the controller's planner are
+    re-planned, as the planner does when a move joins its buffer, assuming that the plotter starts a move as soon as it
+    has been sent.
+    """
+    def __init__(self, model: MotionModel, position: tuple[float, float, float] = (0.0, 0.0, 0.0)):
+        self.model = model
+        # where the last move that was added ends
+        self.position = position
+        self._blocks = collections.deque()
+        self._lock = threading.Lock()
+
+    def add(self, target: tuple[float, float, float], feed_rate: float, motion: int = 1,
+            centre: Optional[tuple[float, float]] = None, jog: bool = False, now: Optional[float] = None) -> float:
+        """
+        Add a move (see `MotionModel.block`), returning when (by the monotonic clock) it should finish.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._remove_finished(now)
+            block = self.model.block(self.position, target, feed_rate, motion, centre, jog)
+            self.position = target
+            if block is None:
+                return self._blocks[-1].finish_time if self._blocks else now
+            timed = _TimedBlock(block)
+            if not self._blocks:
+                timed.start_time = now
+            self._blocks.append(timed)
+            self._replan()
+            return timed.finish_time
+
+    def finish_time(self, now: Optional[float] = None) -> float:
+        """When (by the monotonic clock) all of the moves should be finished"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return max(now, self._blocks[-1].finish_time) if self._blocks else now
+
+    def remaining(self, now: Optional[float] = None) -> float:
+        """How long (in seconds) until all of the moves should be finished"""
+        now = time.monotonic() if now is None else now
+        return self.finish_time(now) - now
+
+    def position_at(self, at: Optional[float] = None) -> tuple[float, float, float]:
+        """
+        Where the pen should be at the given time (by the monotonic clock), taking arcs as straight lines.
+        """
+        at = time.monotonic() if at is None else at
+        with self._lock:
+            for timed in self._blocks:
+                if at < timed.finish_time:
+                    block = timed.block
+                    if at <= timed.start_time:
+                        return block.start
+                    distance = trapezoid_distance(at - timed.start_time, block.length, timed.entry_speed,
+                                                  block.nominal_speed, timed.exit_speed, block.acceleration)
+                    fraction = distance / block.length
+                    return tuple(s + (t - s) * fraction for s, t in zip(block.start, block.target))
+            return self.position
+
+    def reset(self, position: tuple[float, float, float]):
+        """
+        Forget the moves, e.g. once the plotter is known to have stopped or its moves have been cancelled.
+        """
+        with self._lock:
+            self._blocks.clear()
+            self.position = position
+
+    def rebase(self, position: tuple[float, float, float]):
+        """
+        Move the origin so that the last move ends at the given position (e.g. after `G92`).
+        """
+        with self._lock:
+            offset = tuple(p - q for p, q in zip(position, self.position))
+            for timed in self._blocks:
+                block = timed.block
+                timed.block = block._replace(start=tuple(s + o for s, o in zip(block.start, offset)),
+                                             target=tuple(t + o for t, o in zip(block.target, offset)))
+            self.position = position
+
+    def _remove_finished(self, now: float):
+        while self._blocks and self._blocks[0].finish_time <= now:
+            self._blocks.popleft()
+
+    def _replan(self):
+        # only the moves in the controller's planner are re-planned, the first of them has already started (or starts
+        # now) or follows a move that the planner has finished with, so its entry speed and start time are fixed
+        blocks = [self._blocks[i] for i in range(-min(len(self._blocks), PLANNER_BLOCK_COUNT), 0)]
+        speeds = self.model.plan([timed.block for timed in blocks], blocks[0].entry_speed)
+        start_time = blocks[0].start_time
+        for timed, (entry_speed, exit_speed) in zip(blocks, speeds):
+            block = timed.block
+            timed.entry_speed = entry_speed
+            timed.exit_speed = exit_speed
+            timed.start_time = start_time
+            timed.finish_time = start_time + trapezoid_time(block.length, entry_speed, block.nominal_speed,
+                                                            exit_speed, block.acceleration)
+            start_time = timed.finish_time
@@ -1,8 +1,16 @@
 import logging
-import threading
+import time
 from enum import Enum
+from typing import Optional, Union
 
 import drawcore_serial
+import metrics
+from device_cache import DeviceCache
+from device_state import MOVING_STATES, STATUS_REPORT_INTERVAL, DeviceState, Status, parse_status
+from encoder import encode_arc, encode_jog, encode_move, encode_pen
+from motion_model import MotionModel, MotionTimeline
+from serial_worker import Priority, SerialWorker
+from transport import ACK_TIMEOUT, JOG_CANCEL, BlockingTransport, SerialTimeout, StreamingTransport
 
 logger = logging.getLogger(__name__)
 
@@ -10,26 +18,54 @@ logger = logging.getLogger(__name__)
 MAX_FEED_RATE_PEN_UP_MM_MIN = 8000
 MAX_FEED_RATE_PEN_DOWN_MM_MIN = 2000
 
+# How long to wait for the plotter to stop after cancelling a jog, and how often to ask whether it has (in seconds)
+STOP_TIMEOUT = 5.0
+STATUS_POLL_INTERVAL = 0.01
+
 
 class PenState(Enum):
     UP = 0
     DOWN = 1
 
 
+def parse_settings(response: str) -> dict[str, float]:
+    """Parse the response to `$$` into a dictionary of setting (e.g. '$130') to value"""
+    settings = {}
+    for line in response.split('\n'):
+        if '=' in line:
+            setting_num, value = line.split('=')
+            settings[setting_num] = float(value.strip())
+    return settings
+
+
 # Coordinates are in mm
 # +ve x is right
 # +ve y is up
 
 class Plotter:
-    def __init__(self):
+    def __init__(self, streaming: bool = False, status_interval: Optional[float] = STATUS_REPORT_INTERVAL):
+        # when streaming, commands are sent using character counting rather than waiting for each "ok", and the
+        # plotter is asked for a status report every status_interval seconds (if it isn't None) to keep the device
+        # state up to date
+        self.streaming = streaming
+        self.status_interval = status_interval
         self.serial_port = None
+        self.transport = BlockingTransport(None)
+        # the thread that owns the transport once the plotter is initialised
+        self.worker = None
         self.x = 0
         self.y = 0
         self.z = 0
-        self._lock = threading.Lock()
+        self._lock = metrics.InstrumentedLock(metrics.LOCK_WAIT)
         self.sleep_count = 0
         self.width_mm = None
         self.height_mm = None
+        # what the plotter last reported about itself, unlike x, y and z which are where it has been told to go
+        self.device_state = DeviceState()
+        # the controller's settings, which the motion model uses to estimate when the moves we send will finish
+        self.settings = {}
+        self.motion_model = MotionModel()
+        self.timeline = MotionTimeline(self.motion_model)
 
     @property
     def exclusive(self):
@@ -40,26 +76,25 @@ class Plotter:
 
     def execute_if_idle(self, f):
         """
-        Execute the given function if the plotter is idle (i.e. not locked exclusively using the above context manager)
+        Queue the given function to be executed once the plotter is idle (i.e. nothing else is waiting to be sent and
+        it is not locked exclusively using the above context manager), returning a future for its result. The lock is
+        held while the function runs, so anything else that wants exclusive use of the plotter waits for it to finish.
         """
-        if self._lock.acquire(blocking=False):
-            try:
+        if self.worker is None:
+            # not initialised, there's nothing to wait for
+            with self._lock:
                 f()
-            finally:
-                self._lock.release()
+            return None
+        return self.worker.submit(f, Priority.HOUSEKEEPING)
 
     def query_configuration(self):
         """Query the plotter's configuration including device dimensions"""
         # Query the device settings
-        response = drawcore_serial.query(self.serial_port, "$$\r")  # Get all settings
-
-        # Parse the response to get width and height
-        settings = {}
-        for line in response.split('\n'):
-            if '=' in line:
-                setting_num, value = line.split('=')
-                settings[setting_num] = float(value.strip())
+        response = self.transport.query("$$\r")  # Get all settings
+        self.apply_settings(parse_settings(response))
 
+    def apply_settings(self, settings: dict[str, float]):
+        """Use the plotter's settings, as reported by `$$`"""
         # Get width and height from settings $130 and $131
         if '$130' in settings:
             self.width_mm = settings['$130']
@@ -69,24 +104,91 @@ class Plotter:
             self.height_mm = settings['$131'] 
             logger.info(f"Device height: {self.height_mm}mm")
 
-    def initialise(self):
+        self.settings = settings
+        self.motion_model = MotionModel.from_settings(settings)
+        self.timeline = MotionTimeline(self.motion_model, (self.x, self.y, self.z))
+        logger.info(f"Motion model: max rates {self.motion_model.max_rates}mm/min, "
+                    f"accelerations {self.motion_model.accelerations}mm/s^2, "
+                    f"junction deviation {self.motion_model.junction_deviation}mm")
+
+    def initialise(self, port_name=None, cache_path: Optional[str] = None):
         """
-        Initialise the plotter.
+        Initialise the plotter, connecting to the given port or the first DrawCore found.
+
+        If a cache path is given, the port and settings found are saved there and used to start up faster next time.
         """
         logger.info("Initialising plotter...")
-        self.serial_port = drawcore_serial.open_port()
-        if self.serial_port is None:
+        start_time = time.monotonic()
+        cache = DeviceCache.load(cache_path) if cache_path is not None else None
+        connection = drawcore_serial.connect(port_name, preferred_port=cache.port if cache is not None else None)
+        if connection is None:
             raise Exception("Failed to find plotter.")
-        version = drawcore_serial.query_version(self.serial_port)
+        self.serial_port, version = connection
         logger.info(f"Connected to DrawCore version {version} on {self.serial_port.name}")
-        
-        # Query the device configuration
-        self.query_configuration()
+
+        if self.streaming:
+            self.transport = StreamingTransport(self.serial_port, device_state=self.device_state,
+                                                status_interval=self.status_interval)
+            logger.info("Using streaming transport")
+        else:
+            self.transport = BlockingTransport(self.serial_port)
+
+        # Query the device configuration, unless we already know it for this version of the firmware
+        settings = cache.profile(version) if cache is not None else None
+        if settings is not None:
+            logger.info("Using cached device settings")
+            self.apply_settings(settings)
+        else:
+            self.query_configuration()
+        if cache is not None:
+            cache.update(self.serial_port.name, version, self.settings)
+
+        # from now on everything is sent by a single thread
+        self.worker = SerialWorker(self.transport, self._lock)
+        logger.info(f"Plotter ready in {time.monotonic() - start_time:.2f} seconds")
+
+    def close(self):
+        """
+        Stop the transport and close the serial port.
+        """
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+        self.transport.close()
+        drawcore_serial.close_port(self.serial_port)
+        self.serial_port = None
+        self.transport = BlockingTransport(None)
+
+    def wait_until_idle(self, timeout: float = ACK_TIMEOUT):
+        """
+        Wait until every command sent so far has been acknowledged by the plotter.
+        """
+        if self.worker is not None and not self.worker.on_worker_thread():
+            self.worker.wait_idle()
+        self.transport.wait_idle(timeout=timeout)
+
+    def wait_until_finished(self):
+        """
+        Wait until the plotter has finished all of the motion that has been sent to it.
+
+        A zero length dwell is only acknowledged once the planner buffer has emptied.
+        """
+        self._send("G4P0\r")
+        self.wait_until_idle()
+        self.timeline.reset((self.x, self.y, self.z))
+
+    def _send(self, cmd: Union[str, bytes], priority: Priority = Priority.DRAW):
+        if self.worker is None:
+            return self.transport.send(cmd)
+        return self.worker.submit(cmd, priority)
 
     def home(self):
         # Home the plotter, this uses the micro-switches to find the top left corner
-        drawcore_serial.command(self.serial_port, "$H\r")
+        future = self._send("$H\r")
+        # homing isn't modelled, the moves that follow it are timed from when they are sent
+        self.timeline.reset((self.x, self.y, self.z))
         self.reset_sleep()
+        return future
 
     def centre(self):
         # Move to the centre of the plotter from the top left corner
@@ -94,39 +196,134 @@ class Plotter:
             # Use the actual device dimensions
             x_centre = self.width_mm / 2
             y_centre = -self.height_mm / 2  # Negative because Y is inverted
-            drawcore_serial.command(self.serial_port, f"G1G91X{x_centre:.3f}Y{y_centre:.3f}F5000\r\r")
+            future = self._send(f"G1G91X{x_centre:.3f}Y{y_centre:.3f}F5000\r\r")
         else:
             # Fallback to hardcoded values
-            drawcore_serial.command(self.serial_port, "G1G91X147.463Y-210F5000\r\r")
+            x_centre, y_centre = 147.463, -210
+            future = self._send("G1G91X147.463Y-210F5000\r\r")
+        start_x, start_y, start_z = self.timeline.position
+        self.timeline.add((start_x + x_centre, start_y + y_centre, start_z), 5000)
         self.reset_sleep()
+        return future
 
     def set_origin(self):
         # Set the current position as the origin
-        drawcore_serial.command(self.serial_port, "G92X0Y0\r\r")
+        future = self._send("G92X0Y0\r\r")
         self.x = 0
         self.y = 0
+        self.device_state.forget_work_offset()
+        self.timeline.rebase((0.0, 0.0, self.timeline.position[2]))
+        return future
 
     def is_at_origin(self) -> bool:
         return self.x == 0 and self.y == 0
 
-    def move_to(self, x, y, feed_rate):
-        # Move to the given location at the given feed rate
-        drawcore_serial.command(self.serial_port, f"G1G90X{x:.3f}Y{y:.3f}F{feed_rate}\r")
+    def move_to(self, x, y, feed_rate, priority: Priority = Priority.DRAW):
+        # Move to the given location at the given feed rate, returning a future for the plotter's acknowledgement
+        start_time = time.perf_counter()
+        future = self._send(encode_move(x, y, feed_rate), priority)
+        self.timeline.add((x, y, self.z), feed_rate)
+        self.x = x
+        self.y = y
+        self.reset_sleep()
+        metrics.MOVE_TO_LATENCY.observe(time.perf_counter() - start_time)
+        return future
+
+    def arc_to(self, x, y, centre_x, centre_y, clockwise: bool, feed_rate, priority: Priority = Priority.DRAW):
+        # Move along a circular arc around the given centre to the given location at the given feed rate
+        # (the centre is sent as an offset from the current location)
+        future = self._send(encode_arc(x, y, centre_x - self.x, centre_y - self.y, clockwise, feed_rate), priority)
+        self.timeline.add((x, y, self.z), feed_rate, motion=2 if clockwise else 3, centre=(centre_x, centre_y))
         self.x = x
         self.y = y
         self.reset_sleep()
+        return future
+
+    def jog(self, dx, dy, feed_rate):
+        # Jog by the given distance at the given feed rate, returning a future for the plotter's acknowledgement
+        # (unlike a move, a jog can be stopped straight away using cancel_jog)
+        dx = round(dx, 3)
+        dy = round(dy, 3)
+        future = self._send(encode_jog(dx, dy, feed_rate), Priority.JOG)
+        self.x += dx
+        self.y += dy
+        self.timeline.add((self.x, self.y, self.z), feed_rate, jog=True)
+        self.reset_sleep()
+        return future
+
+    def cancel_jog(self, timeout: float = STOP_TIMEOUT) -> tuple[float, float]:
+        """
+        Stop jogging at once, dropping any jogs that are still waiting to be sent, and return where the plotter
+        stopped (which becomes its position).
+
+        If the plotter hasn't reported that it has stopped within about timeout seconds, where it last reported it was
+        is used instead so that the caller isn't held up for long.
+        """
+        deadline = time.monotonic() + timeout
+        if self.worker is not None:
+            self.worker.discard(Priority.JOG)
+        # jogs that have already been sent must reach the planner first, otherwise they would run after the cancel
+        try:
+            self.wait_until_idle(timeout=timeout)
+        except SerialTimeout as err:
+            logger.warning(f"Cancelling jogs that may not have been acknowledged yet: {err}")
+        self.transport.realtime(JOG_CANCEL)
+        try:
+            self.x, self.y = self.query_position(wait_for_stop=True, timeout=max(deadline - time.monotonic(), 0.0))
+        except ValueError as err:
+            position = self.device_state.work_position
+            if position is None:
+                raise
+            logger.warning(f"Using the last reported position after cancelling a jog: {err}")
+            self.x, self.y = position[0], position[1]
+        self.timeline.reset((self.x, self.y, self.z))
+        return self.x, self.y
+
+    def query_status(self) -> Status:
+        """Ask the plotter for a status report"""
+        if isinstance(self.transport, StreamingTransport):
+            # the streaming transport's reader has already recorded the report in the device state, by the time we
+            # see it a newer one may have been recorded too
+            return parse_status(self.transport.query_status())
+        if self.worker is not None and not self.worker.on_worker_thread():
+            # the blocking transport can only be used by the worker
+            report = self.worker.submit(self.transport.query_status, Priority.JOG).result(timeout=ACK_TIMEOUT)
+        else:
+            report = self.transport.query_status()
+        return self.device_state.update(report)
+
+    def query_position(self, wait_for_stop: bool = False, timeout: float = STOP_TIMEOUT) -> tuple[float, float]:
+        """
+        Ask the plotter where it is (in work coordinates), optionally waiting (for up to timeout seconds) for it to stop
+        moving first.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.query_status()
+            # the work offset isn't in every report so we may have to ask again
+            position = self.device_state.work_position
+            moving = wait_for_stop and status.state.split(':')[0] in MOVING_STATES
+            if position is not None and not moving:
+                return position[0], position[1]
+            if time.monotonic() > deadline:
+                raise ValueError(f"Timed out waiting for the plotter's position, last status: {status}")
+            time.sleep(STATUS_POLL_INTERVAL)
 
     def pen_down(self):
         # Lower the pen
-        drawcore_serial.command(self.serial_port, "G1G90Z5.0F5000\r")
+        future = self._send(encode_pen(5.0, 5000))
         self.z = 5.0
+        self.timeline.add((self.x, self.y, self.z), 5000)
         self.reset_sleep()
+        return future
 
     def pen_up(self):
         # Raise the pen
-        drawcore_serial.command(self.serial_port, "G1G90Z0.5F5000\r")
+        future = self._send(encode_pen(0.5, 5000))
         self.z = 0.5
+        self.timeline.add((self.x, self.y, self.z), 5000)
         self.reset_sleep()
+        return future
 
     def is_pen_down(self) -> bool:
         return self.pen_state() == PenState.DOWN
@@ -150,4 +347,4 @@ class Plotter:
             self.sleep_count += 1
 
     def sleep(self):
-        drawcore_serial.command(self.serial_port, "$SLP\r")
+        return self._send("$SLP\r")
@@ -0,0 +1,399 @@
+import argparse
+import logging
+import math
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Optional
+
+import numpy as np
+
+from arcs import ARC_TOLERANCE_MM
+from atomic_file import write_atomically
+from drawing import draw, planned_strokes
+from feed_planner import travel_feed_rate
+from motion_model import MotionModel, MotionTimeline
+from plotter import PenState
+from session import Session
+
+logger = logging.getLogger(__name__)
+
+
+# The width of the line drawn by the pen in SVGs (in mm)
+PEN_WIDTH_MM = 0.5
+
+# How far (in pixels) a flattened arc may stray from the true arc when rasterising
+ARC_FLATNESS_PX = 0.25
+
+# The distance between the samples taken along each line when rasterising (in pixels)
+SAMPLE_SPACING_PX = 0.5
+
+# The margin left around the pattern when fitting the image to it, as a fraction of its size
+FIT_MARGIN = 0.05
+
+# How hard PNGs are compressed (zlib's level, 1 is fastest and 9 smallest)
+PNG_COMPRESSION = 6
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_CHUNK_HEADER = struct.Struct(">I4s")
+_PNG_IHDR = struct.Struct(">IIBBBBB")
+_PNG_CRC = struct.Struct(">I")
+
+
+class RenderPlotter:
+    """
+    A stand-in for `Plotter` that records what would be drawn rather than driving any hardware, so that patterns can
+    be drawn with `draw_snowflake` or `draw` and then saved as an SVG (with arcs kept as arcs) or rasterised to a PNG.
+
+    Each stretch drawn with the pen down becomes a path: its start point followed by an (x, y) for every line or an
+    (x, y, centre_x, centre_y, clockwise) for every arc. Pen-up moves are kept separately as travel.
+    """
+    def __init__(self, width_mm: Optional[float] = None, height_mm: Optional[float] = None):
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.width_mm = width_mm
+        self.height_mm = height_mm
+        self.paths = []
+        self.travel = []
+        self._path = None
+        self._lock = threading.Lock()
+        self.motion_model = MotionModel()
+        # nothing is ever waiting to be drawn, so this stays empty
+        self.timeline = MotionTimeline(self.motion_model)
+
+    @property
+    def exclusive(self):
+        return self._lock
+
+    def clear(self):
+        """Forget everything that has been drawn, e.g. to start a new page"""
+        self.paths = []
+        self.travel = []
+        if self._path is not None:
+            # carry on with the line being drawn from where the pen is
+            self.pen_down()
+
+    def move_to(self, x, y, feed_rate=None, priority=None):
+        if self._path is not None:
+            self._path.append((x, y))
+        else:
+            self.travel.append(((self.x, self.y), (x, y)))
+        self.x = x
+        self.y = y
+
+    def arc_to(self, x, y, centre_x, centre_y, clockwise: bool, feed_rate=None, priority=None):
+        if self._path is not None:
+            self._path.append((x, y, centre_x, centre_y, clockwise))
+        else:
+            self.travel.append(((self.x, self.y), (x, y)))
+        self.x = x
+        self.y = y
+
+    def pen_down(self):
+        self.z = 5.0
+        self._path = [(self.x, self.y)]
+        self.paths.append(self._path)
+
+    def pen_up(self):
+        self.z = 0.5
+        self._path = None
+
+    def is_pen_down(self) -> bool:
+        return self.pen_state() == PenState.DOWN
+
+    def is_pen_up(self) -> bool:
+        return self.pen_state() == PenState.UP
+
+    def pen_state(self) -> PenState:
+        return PenState.DOWN if self.z > 1.0 else PenState.UP
+
+    def wait_until_idle(self):
+        pass
+
+    def wait_until_finished(self):
+        pass
+
+    def reset_sleep(self):
+        pass
+
+    def check_sleep(self):
+        pass
+
+    def page_bounds(self) -> Optional[tuple[float, float, float, float]]:
+        """The plot area (min x, min y, max x, max y) around the origin at its centre, if its size is known"""
+        if self.width_mm is None or self.height_mm is None:
+            return None
+        return -self.width_mm / 2, -self.height_mm / 2, self.width_mm / 2, self.height_mm / 2
+
+    def content_bounds(self, include_travel: bool = False) -> tuple[float, float, float, float]:
+        """The extent of everything that has been drawn"""
+        # the arcs only need to be flattened roughly, to within the width of the pen
+        points = self.polylines(PEN_WIDTH_MM)
+        if include_travel and self.travel:
+            points.append(np.asarray(self.travel, dtype=np.float64).reshape(-1, 2))
+        if not points:
+            return -1.0, -1.0, 1.0, 1.0
+        points = np.concatenate(points)
+        (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+        return float(min_x), float(min_y), float(max_x), float(max_y)
+
+    def polylines(self, tolerance_mm: float) -> list[np.ndarray]:
+        """Each path as an (N, 2) array of points, with the arcs flattened to within tolerance_mm"""
+        polylines = []
+        for path in self.paths:
+            points = [path[0]]
+            for step in path[1:]:
+                if len(step) == 2:
+                    points.append(step)
+                else:
+                    points.extend(arc_points(points[-1], step[:2], step[2:4], step[4], tolerance_mm))
+            polylines.append(np.asarray(points, dtype=np.float64))
+        return polylines
+
+    def to_svg(self, bounds: Optional[tuple[float, float, float, float]] = None, show_travel: bool = False) -> str:
+        """
+        The drawing as an SVG document in mm, covering the page (if its size is known) or else the drawing.
+        """
+        min_x, min_y, max_x, max_y = bounds or self.page_bounds() or _with_margin(self.content_bounds(show_travel))
+        width = max_x - min_x
+        height = max_y - min_y
+        # SVG's y axis points down, so every y is negated, which also reverses the direction of the arcs
+        parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.3f}mm" height="{height:.3f}mm" '
+                 f'viewBox="{min_x:.3f} {-max_y:.3f} {width:.3f} {height:.3f}">\n',
+                 f'<rect x="{min_x:.3f}" y="{-max_y:.3f}" width="{width:.3f}" height="{height:.3f}" fill="white"/>\n',
+                 f'<g fill="none" stroke="black" stroke-width="{PEN_WIDTH_MM}" stroke-linecap="round" '
+                 f'stroke-linejoin="round">\n']
+        for path in self.paths:
+            x, y = path[0]
+            commands = [f"M{x:.3f} {-y:.3f}"]
+            for step in path[1:]:
+                if len(step) == 2:
+                    x, y = step
+                    commands.append(f"L{x:.3f} {-y:.3f}")
+                else:
+                    commands.extend(_svg_arc((x, y), *step))
+                    x, y = step[:2]
+            parts.append(f'<path d="{"".join(commands)}"/>\n')
+        parts.append('</g>\n')
+        if show_travel and self.travel:
+            moves = "".join(f"M{a[0]:.3f} {-a[1]:.3f}L{b[0]:.3f} {-b[1]:.3f}" for a, b in self.travel)
+            parts.append(f'<path d="{moves}" fill="none" stroke="red" stroke-width="{PEN_WIDTH_MM / 2}" '
+                         f'stroke-dasharray="2 2"/>\n')
+        parts.append('</svg>\n')
+        return "".join(parts)
+
+    def save_svg(self, path: str, bounds: Optional[tuple[float, float, float, float]] = None,
+                 show_travel: bool = False):
+        write_atomically(path, self.to_svg(bounds, show_travel).encode("utf-8"))
+
+    def rasterise(self, width_px: int, height_px: Optional[int] = None,
+                  bounds: Optional[tuple[float, float, float, float]] = None, line_width_px: float = 1.0) -> np.ndarray:
+        """
+        Render the drawing as a (height, width) greyscale image of black lines on white, covering the bounds (by
+        default the page if its size is known, or else the drawing) scaled to fit and centred.
+        """
+        min_x, min_y, max_x, max_y = bounds or self.page_bounds() or _with_margin(self.content_bounds())
+        scale = width_px / max(max_x - min_x, 1e-9)
+        if height_px is None:
+            height_px = max(1, round((max_y - min_y) * scale))
+        else:
+            scale = min(scale, height_px / max(max_y - min_y, 1e-9))
+        # centre the bounds in the image, with y flipped so that up is up
+        offset_x = width_px / 2 - (min_x + max_x) / 2 * scale
+        offset_y = height_px / 2 + (min_y + max_y) / 2 * scale
+
+        segments = []
+        for polyline in self.polylines(ARC_FLATNESS_PX / scale):
+            if len(polyline) > 1:
+                segments.append(np.stack((polyline[:-1], polyline[1:]), axis=1))
+        if not segments:
+            return np.full((height_px, width_px), 255, dtype=np.uint8)
+        segments = np.concatenate(segments)
+        segments[..., 0] = segments[..., 0] * scale + offset_x
+        segments[..., 1] = offset_y - segments[..., 1] * scale
+        ink = rasterise_segments(segments, width_px, height_px)
+        radius = round((line_width_px - 1) / 2)
+        if radius > 0:
+            ink = _dilate(ink, radius)
+        return (255 - ink * 255).astype(np.uint8)
+
+    def save_png(self, path: str, width_px: int, height_px: Optional[int] = None,
+                 bounds: Optional[tuple[float, float, float, float]] = None, line_width_px: float = 1.0):
+        write_atomically(path, encode_png(self.rasterise(width_px, height_px, bounds, line_width_px)))
+
+
+def render_pattern(drawing: list[tuple[float, float]], order: int, mirror: bool, include_original: bool = True,
+                   arc_tolerance_mm: Optional[float] = ARC_TOLERANCE_MM,
+                   plotter: Optional[RenderPlotter] = None) -> RenderPlotter:
+    """
+    Draw the pattern onto the given (or a new) RenderPlotter exactly as `draw_snowflake` would draw it on a plotter,
+    but without its producer thread or logging so that thousands of patterns can be rendered a minute. The original
+    stroke is included by default, as it is on the page too.
+    """
+    plotter = plotter or RenderPlotter()
+    if not drawing:
+        return plotter
+    return_to = tuple(drawing[-1])
+    for stroke, arcs, chained, _ in planned_strokes(drawing, order, mirror, start=(plotter.x, plotter.y),
+                                                    end=return_to, arc_tolerance_mm=arc_tolerance_mm,
+                                                    include_original=include_original):
+        draw(plotter, stroke, arcs=arcs, chained=chained, lift_pen=False)
+    if plotter.is_pen_down():
+        plotter.pen_up()
+    plotter.move_to(*return_to, feed_rate=travel_feed_rate(plotter.motion_model))
+    return plotter
+
+
+def arc_points(start: tuple[float, float], end: tuple[float, float], centre: tuple[float, float], clockwise: bool,
+               tolerance_mm: float) -> list[tuple[float, float]]:
+    """
+    Points along the arc from start to end around the centre (as G2/G3 would draw it), not including the start, that
+    stay within tolerance_mm of the arc. An arc that ends where it starts is a full circle.
+    """
+    radius = math.hypot(start[0] - centre[0], start[1] - centre[1])
+    start_angle = math.atan2(start[1] - centre[1], start[0] - centre[0])
+    end_angle = math.atan2(end[1] - centre[1], end[0] - centre[0])
+    sweep = _sweep(start_angle, end_angle, clockwise)
+    if radius <= tolerance_mm:
+        return [end]
+    step = 2 * math.acos(1 - tolerance_mm / radius)
+    n = max(1, math.ceil(abs(sweep) / step))
+    angles = start_angle + sweep * np.arange(1, n) / n
+    points = np.column_stack((centre[0] + radius * np.cos(angles), centre[1] + radius * np.sin(angles)))
+    return [*map(tuple, points.tolist()), end]
+
+
+def rasterise_segments(segments: np.ndarray, width_px: int, height_px: int) -> np.ndarray:
+    """
+    Rasterise the (N, 2, 2) line segments (in pixel coordinates) into a (height, width) array of ink coverage from 0
+    to 1, anti-aliased by spreading evenly spaced samples along every segment over the four nearest pixels.
+    """
+    starts = segments[:, 0]
+    deltas = segments[:, 1] - starts
+    lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+    counts = np.maximum(1, np.ceil(lengths / SAMPLE_SPACING_PX).astype(np.int64))
+    # every sample at once: which segment it's on and how far along it
+    segment_index = np.repeat(np.arange(len(segments)), counts)
+    first_sample = np.repeat(np.cumsum(counts) - counts, counts)
+    fraction = (np.arange(len(segment_index)) - first_sample) / counts[segment_index]
+    samples = starts[segment_index] + deltas[segment_index] * fraction[:, None]
+    # and the end of each segment, so that the end of each path is drawn
+    samples = np.concatenate((samples, segments[:, 1]))
+    weights = np.concatenate(((lengths / counts)[segment_index], np.full(len(segments), SAMPLE_SPACING_PX)))
+
+    # pixel centres are at half pixels
+    samples -= 0.5
+    base = np.floor(samples)
+    fx, fy = (samples - base).T
+    base_x, base_y = base.astype(np.int64).T
+    coverage = np.zeros(width_px * height_px)
+    for dx, dy, weight in ((0, 0, (1 - fx) * (1 - fy)), (1, 0, fx * (1 - fy)),
+                           (0, 1, (1 - fx) * fy), (1, 1, fx * fy)):
+        px = base_x + dx
+        py = base_y + dy
+        inside = (px >= 0) & (px < width_px) & (py >= 0) & (py < height_px)
+        coverage += np.bincount(py[inside] * width_px + px[inside], weights=(weight * weights)[inside],
+                                minlength=width_px * height_px)
+    return np.minimum(coverage, 1.0).reshape(height_px, width_px)
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """Encode a (height, width) uint8 greyscale image as a PNG"""
+    height, width = image.shape
+    # every row starts with its filter type, 0 for none
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = image
+    return b"".join((_PNG_SIGNATURE,
+                     _png_chunk(b"IHDR", _PNG_IHDR.pack(width, height, 8, 0, 0, 0, 0)),
+                     _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), PNG_COMPRESSION)),
+                     _png_chunk(b"IEND", b"")))
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return b"".join((_PNG_CHUNK_HEADER.pack(len(data), chunk_type), data,
+                     _PNG_CRC.pack(zlib.crc32(data, zlib.crc32(chunk_type)))))
+
+
+def _sweep(start_angle: float, end_angle: float, clockwise: bool) -> float:
+    # the signed angle swept, anticlockwise being positive
+    if clockwise:
+        return -((start_angle - end_angle) % (2 * math.pi) or 2 * math.pi)
+    return (end_angle - start_angle) % (2 * math.pi) or 2 * math.pi
+
+
+def _svg_arc(start: tuple[float, float], x: float, y: float, centre_x: float, centre_y: float,
+             clockwise: bool) -> list[str]:
+    radius = math.hypot(start[0] - centre_x, start[1] - centre_y)
+    sweep = _sweep(math.atan2(start[1] - centre_y, start[0] - centre_x), math.atan2(y - centre_y, x - centre_x),
+                   clockwise)
+    # with y negated an anticlockwise arc is drawn clockwise, which is SVG's positive sweep
+    sweep_flag = 0 if clockwise else 1
+    if abs(sweep) >= 2 * math.pi - 1e-9:
+        # a full circle has to be split, as an SVG arc that ends where it starts draws nothing
+        opposite_x = 2 * centre_x - start[0]
+        opposite_y = 2 * centre_y - start[1]
+        return [f"A{radius:.3f} {radius:.3f} 0 0 {sweep_flag} {opposite_x:.3f} {-opposite_y:.3f}",
+                f"A{radius:.3f} {radius:.3f} 0 0 {sweep_flag} {x:.3f} {-y:.3f}"]
+    large_arc = 1 if abs(sweep) > math.pi else 0
+    return [f"A{radius:.3f} {radius:.3f} 0 {large_arc} {sweep_flag} {x:.3f} {-y:.3f}"]
+
+
+def _with_margin(bounds: tuple[float, float, float, float]) -> tuple[float, float, float, float]:
+    min_x, min_y, max_x, max_y = bounds
+    margin = max(max_x - min_x, max_y - min_y, 1.0) * FIT_MARGIN
+    return min_x - margin, min_y - margin, max_x + margin, max_y + margin
+
+
+def _dilate(ink: np.ndarray, radius: int) -> np.ndarray:
+    # thicken the lines by taking the darkest pixel within the radius
+    padded = np.pad(ink, radius)
+    height, width = ink.shape
+    result = ink.copy()
+    for dy in range(2 * radius + 1):
+        for dx in range(2 * radius + 1):
+            np.maximum(result, padded[dy:dy + height, dx:dx + width], out=result)
+    return result
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s [%(levelname)s] %(message)s')
+
+    parser = argparse.ArgumentParser(description="Render the patterns of a recorded session as PNGs and/or SVGs")
+    parser.add_argument("session", help="the session file to render")
+    parser.add_argument("--output", default=".", help="the directory to write the images to")
+    parser.add_argument("--size", type=int, default=256, help="the width of each PNG (in pixels)")
+    parser.add_argument("--svg", action="store_true", help="write an SVG of each pattern too")
+    parser.add_argument("--page", action="store_true",
+                        help="only write a single image of the whole page, with every pattern on it")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.session))[0]
+    start_time = time.monotonic()
+    count = 0
+    page = RenderPlotter()
+    with Session(args.session) as session:
+        for stroke in session.strokes():
+            drawing = stroke.points.tolist()
+            if args.page:
+                render_pattern(drawing, stroke.order, stroke.mirror, plotter=page)
+            else:
+                pattern = render_pattern(drawing, stroke.order, stroke.mirror)
+                pattern.save_png(os.path.join(args.output, f"{name}-{count:05d}.png"), args.size)
+                if args.svg:
+                    pattern.save_svg(os.path.join(args.output, f"{name}-{count:05d}.svg"))
+            count += 1
+            del stroke
+    if args.page:
+        page.save_png(os.path.join(args.output, f"{name}.png"), args.size)
+        if args.svg:
+            page.save_svg(os.path.join(args.output, f"{name}.svg"))
+    elapsed = time.monotonic() - start_time
+    logger.info(f"Rendered {count} patterns from {args.session} in {elapsed:.2f} seconds "
+                f"({count / max(elapsed, 1e-9) * 60:.0f} a minute)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import logging
+import time
+
+import plotter
+from drawing import draw_snowflake
+from session import Session
+
+logger = logging.getLogger(__name__)
+
+
+def replay(plotter_instance: plotter.Plotter, path: str):
+    """
+    Draw every stroke recorded in a session, and its pattern, as fast as the plotter's transport allows.
+    """
+    start_time = time.monotonic()
+    count = 0
+    with Session(path) as session:
+        for stroke in session.strokes():
+            drawing = stroke.points.tolist()
+            # the original stroke was drawn by hand, so it has to be drawn along with its copies
+            draw_snowflake(plotter=plotter_instance,
+                           drawing=drawing,
+                           order=stroke.order,
+                           mirror=stroke.mirror,
+                           return_to=tuple(drawing[-1]),
+                           wait=False,
+                           include_original=True)
+            count += 1
+            del stroke
+    plotter_instance.wait_until_finished()
+    logger.info(f"Replayed {count} strokes from {path} in {time.monotonic() - start_time:.1f} seconds")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s [%(levelname)s] %(message)s')
+
+    parser = argparse.ArgumentParser(description="Replay a recorded session on the plotter")
+    parser.add_argument("session", help="the session file to replay")
+    parser.add_argument("--port", help="the serial port of the plotter (defaults to the first DrawCore found)")
+    args = parser.parse_args()
+
+    plotter_instance = plotter.Plotter(streaming=True)
+    plotter_instance.initialise(args.port)
+    try:
+        plotter_instance.home()
+        plotter_instance.centre()
+        plotter_instance.set_origin()
+        replay(plotter_instance, args.session)
+    finally:
+        if plotter_instance.is_pen_down():
+            plotter_instance.pen_up()
+        plotter_instance.sleep()
+        plotter_instance.wait_until_idle()
+        plotter_instance.close()
+
+
+if __name__ == "__main__":
+    main()
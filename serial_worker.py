@@ -0,0 +1,208 @@
+import collections
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Callable, Union
+
+logger = logging.getLogger(__name__)
+
+
+# The most commands that can be waiting to be sent, across all of the priority lanes
+COMMAND_QUEUE_SIZE = 64
+
+# The most commands waiting in a lane that are handed to the transport together, to be written at once
+SEND_BATCH_SIZE = 16
+
+
+class Priority(IntEnum):
+    # jogs, which can be dropped while they are waiting (see Plotter.cancel_jog)
+    JOG = 0
+    # moves, pen commands and drawing patterns, which are sent in the order they were submitted along with jogs
+    DRAW = 1
+    # homing, moving to the origin etc., which only run when nothing else is waiting and nobody has exclusive use
+    HOUSEKEEPING = 2
+
+
+class SerialWorker:
+    """
+    The single owner of the plotter's transport, fed by a bounded queue with a lane for each priority.
+
+    Callers submit commands (or functions that are run with sole use of the transport) and get a future back straight
+    away, so they never block on serial I/O, only on the queue being full. Housekeeping is deferred while the given
+    lock is held, and holds it while it runs, so it can't be interleaved with a job that is using the plotter
+    exclusively. Jogs and drawing are
+    sent in the order they were submitted, so housekeeping is the only work that anything goes ahead of. A run of
+    commands waiting in the same lane is handed to the transport as a batch.
+    """
+    def __init__(self, transport, exclusive_lock: threading.Lock, maxsize: int = COMMAND_QUEUE_SIZE):
+        self.transport = transport
+        self.maxsize = maxsize
+        self._exclusive_lock = exclusive_lock
+        self._lanes = {priority: collections.deque() for priority in Priority}
+        # numbers the items as they are submitted, to keep jogs and drawing in order across their lanes
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._size = 0
+        self._active = False
+        # whether the worker holds the exclusive lock, for the housekeeping it is running
+        self._holding_lock = False
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="serial-worker", daemon=True)
+        self._thread.start()
+
+    def on_worker_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, item: Union[str, bytes, Callable], priority: Priority = Priority.DRAW) -> Future:
+        """
+        Queue a command, or a function to call, returning a future for its acknowledgement (or return value).
+        """
+        if self.on_worker_thread():
+            # already running on the worker (e.g. within a housekeeping function) so just do it now
+            return self._execute(item)
+        future = Future()
+        with self._condition:
+            self._raise_pending_error()
+            while self._size >= self.maxsize and self._running:
+                self._condition.wait(timeout=0.1)
+            if not self._running:
+                raise ConnectionError("Serial worker stopped")
+            self._lanes[priority].append((next(self._sequence), item, future))
+            self._size += 1
+            self._condition.notify_all()
+        return future
+
+    def discard(self, priority: Priority) -> int:
+        """
+        Drop everything waiting in the given priority's lane (e.g. jogs that have been cancelled), cancelling their
+        futures and returning how many there were.
+        """
+        with self._condition:
+            lane = self._lanes[priority]
+            discarded = len(lane)
+            while lane:
+                _, _, future = lane.popleft()
+                future.cancel()
+            self._size -= discarded
+            self._condition.notify_all()
+        return discarded
+
+    def wait_idle(self):
+        """
+        Wait until everything that has been queued has been handed to the transport.
+        """
+        with self._condition:
+            # housekeeping that is deferred by someone holding the exclusive lock isn't waited for, as that someone is
+            # probably us
+            while not self._is_idle() and self._running:
+                self._condition.wait(timeout=0.05)
+            self._raise_pending_error()
+
+    def stop(self):
+        """
+        Stop once everything that has been queued has been handed to the transport.
+        """
+        try:
+            self.wait_idle()
+        finally:
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+            self._thread.join(timeout=2.0)
+
+    def _is_idle(self) -> bool:
+        if self._active:
+            return False
+        if self._exclusive_lock.locked():
+            return all(not lane for priority, lane in self._lanes.items() if priority != Priority.HOUSEKEEPING)
+        return self._size == 0
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _next_items(self):
+        with self._condition:
+            while self._running:
+                lane = self._next_lane()
+                if lane is not None:
+                    items = [lane.popleft()[1:]]
+                    # functions are run on their own, commands are sent along with those that follow them (as long as
+                    # nothing was submitted to another lane in between)
+                    if not callable(items[0][0]):
+                        other = self._lanes[Priority.DRAW if lane is self._lanes[Priority.JOG] else Priority.JOG]
+                        while (lane and len(items) < SEND_BATCH_SIZE and not callable(lane[0][1])
+                               and not (other and other[0][0] < lane[0][0])):
+                            items.append(lane.popleft()[1:])
+                    self._size -= len(items)
+                    self._active = True
+                    self._condition.notify_all()
+                    return items
+                # wait for something new, or for the exclusive lock to be released if only housekeeping is waiting
+                self._condition.wait(timeout=0.05)
+        return None
+
+    def _next_lane(self):
+        """The lane to take the next item from: whichever of jogs and drawing was submitted first, then housekeeping"""
+        jogs, draws = self._lanes[Priority.JOG], self._lanes[Priority.DRAW]
+        if jogs or draws:
+            return jogs if not draws or (jogs and jogs[0][0] < draws[0][0]) else draws
+        if self._lanes[Priority.HOUSEKEEPING] and self._exclusive_lock.acquire(blocking=False):
+            self._holding_lock = True
+            return self._lanes[Priority.HOUSEKEEPING]
+        return None
+
+    def _run(self):
+        while (items := self._next_items()) is not None:
+            try:
+                if len(items) == 1:
+                    results = [self._execute(items[0][0])]
+                else:
+                    results = self.transport.send_batch([item for item, _ in items])
+                for (_, future), result in zip(items, results):
+                    result.add_done_callback(lambda done, future=future: _copy_result(done, future))
+            except Exception as e:
+                if callable(items[0][0]):
+                    # the function's future has its exception, which is nothing to do with anyone else's commands
+                    logger.error(f"Error running {items[0][0]}: {e}")
+                    items[0][1].set_exception(e)
+                    continue
+                logger.error(f"Error sending to plotter: {e}")
+                # a batch that fails part way says how each command went, those written before it failed are still
+                # acknowledged as usual
+                results = getattr(e, "futures", [])
+                for (_, future), result in zip(items, results):
+                    result.add_done_callback(lambda done, future=future: _copy_result(done, future))
+                for _, future in items[len(results):]:
+                    future.set_exception(e)
+                with self._condition:
+                    self._error = e
+            finally:
+                with self._condition:
+                    if self._holding_lock:
+                        self._holding_lock = False
+                        self._exclusive_lock.release()
+                    self._active = False
+                    self._condition.notify_all()
+
+    def _execute(self, item: Union[str, bytes, Callable]) -> Future:
+        if callable(item):
+            future = Future()
+            try:
+                future.set_result(item())
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            return future
+        return self.transport.send(item)
+
+
+def _copy_result(source: Future, destination: Future):
+    if source.exception() is not None:
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
@@ -0,0 +1,106 @@
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# A session file is a header followed by records that are only ever appended. Each record is a small header followed
+# by the stroke's points as little-endian float32 (x, y) pairs. All headers are a multiple of 4 bytes so the points
+# are always aligned and can be read straight out of a memory map.
+FILE_MAGIC = b"SNOWFLAK"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<8sH6x")
+# timestamp, number of points, order, mirror
+RECORD_HEADER = struct.Struct("<dIHBx")
+POINT_DTYPE = np.dtype("<f4")
+
+
+class SessionStroke(NamedTuple):
+    timestamp: float
+    order: int
+    mirror: bool
+    # (N, 2) float32 array, this is a read-only view onto the session file
+    points: np.ndarray
+
+
+class SessionRecorder:
+    """
+    Appends each drawn stroke, along with the order and mirroring it was drawn with, to a session file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+            self._file.flush()
+        logger.info(f"Recording session to {path}")
+
+    def record(self, drawing: list[tuple[float, float]], order: int, mirror: bool):
+        points = np.asarray(drawing, dtype=POINT_DTYPE).reshape(-1, 2)
+        self._file.write(RECORD_HEADER.pack(time.time(), len(points), order, mirror))
+        self._file.write(points.tobytes())
+        # flush each stroke so that nothing is lost if the program is stopped
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Session:
+    """
+    A recorded session file, memory mapped so that the strokes are read without parsing or copying.
+
+    The points of each stroke are views onto the map, so they must be released before the session is closed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < FILE_HEADER.size:
+            raise ValueError(f"{path} is not a session file")
+        magic, version = FILE_HEADER.unpack_from(self._mmap, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError(f"{path} is not a version {FILE_VERSION} session file")
+
+    def strokes(self) -> Iterator[SessionStroke]:
+        offset = FILE_HEADER.size
+        size = len(self._mmap)
+        while offset + RECORD_HEADER.size <= size:
+            timestamp, n_points, order, mirror = RECORD_HEADER.unpack_from(self._mmap, offset)
+            offset += RECORD_HEADER.size
+            length = n_points * 2 * POINT_DTYPE.itemsize
+            if offset + length > size:
+                logger.warning(f"Ignoring truncated stroke at the end of {self.path}")
+                return
+            points = np.frombuffer(self._mmap, dtype=POINT_DTYPE, count=n_points * 2, offset=offset).reshape(-1, 2)
+            offset += length
+            yield SessionStroke(timestamp, order, bool(mirror), points)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def new_session_path(directory: str) -> str:
+    """
+    A path for a new session file in the given directory, named after the current time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, time.strftime("session-%Y%m%d-%H%M%S.snow"))
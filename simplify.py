@@ -0,0 +1,79 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Recorded strokes are simplified before they are replicated: points within this distance of the simplified line are
+# removed and then points closer together than the minimum segment length (both in mm)
+SIMPLIFY_TOLERANCE_MM = 0.1
+MIN_SEGMENT_LENGTH_MM = 0.5
+
+def simplify_stroke(drawing: list[tuple[float, float]], tolerance_mm: float,
+                    min_segment_mm: float) -> list[tuple[float, float]]:
+    """
+    Remove points that don't change the shape of a recorded stroke before it is replicated.
+
+    Points within tolerance_mm of the line through their neighbours are removed (Ramer-Douglas-Peucker) and then
+    points closer than min_segment_mm to the previously kept point are dropped. The end points are always kept.
+    """
+    if len(drawing) < 3:
+        return list(drawing)
+    points = np.asarray(drawing, dtype=np.float64)
+    simplified = ramer_douglas_peucker(points, tolerance_mm)
+    simplified = remove_short_segments(simplified, min_segment_mm)
+    logger.info(f"Simplified stroke from {len(drawing)} to {len(simplified)} points")
+    return [(float(x), float(y)) for x, y in simplified]
+
+
+def ramer_douglas_peucker(points: np.ndarray, tolerance_mm: float) -> np.ndarray:
+    """
+    Simplify the (N, 2) polyline, keeping every point further than tolerance_mm from the simplified line.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    # use an explicit stack rather than recursion as a long stroke could exceed the recursion limit
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _distances_to_segment(points[first + 1:last], points[first], points[last])
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance_mm:
+            index = first + 1 + furthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return points[keep]
+
+
+def remove_short_segments(points: np.ndarray, min_segment_mm: float) -> np.ndarray:
+    """
+    Drop points that are closer than min_segment_mm to the previous kept point, always keeping the last point.
+    """
+    if len(points) < 3 or min_segment_mm <= 0:
+        return points
+    kept = [points[0]]
+    for point in points[1:-1]:
+        if np.hypot(*(point - kept[-1])) >= min_segment_mm:
+            kept.append(point)
+    # the last point is always kept, replacing the previous kept point if that is too close to it
+    if len(kept) > 1 and np.hypot(*(points[-1] - kept[-1])) < min_segment_mm:
+        kept.pop()
+    kept.append(points[-1])
+    return np.array(kept)
+
+
+def _distances_to_segment(points: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    # distance to the segment rather than the infinite line, so that a stroke which doubles back on itself keeps
+    # the point where it turns around
+    direction = end - start
+    length_squared = direction @ direction
+    offsets = points - start
+    if length_squared == 0:
+        return np.hypot(offsets[:, 0], offsets[:, 1])
+    t = np.clip(offsets @ direction / length_squared, 0.0, 1.0)
+    nearest = offsets - t[:, None] * direction
+    return np.hypot(nearest[:, 0], nearest[:, 1])
@@ -0,0 +1,104 @@
+import logging
+import math
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+# The one euro filter's settings (see https://gery.casiez.net/1euro/): the cutoff frequency when the stick is held still
+# or moved slowly (in Hz), which bounds the lag, how quickly the cutoff rises as the stick moves faster (in Hz per unit
+# of stick movement per second) and the cutoff used to smooth the stick's speed (in Hz)
+ONE_EURO_MIN_CUTOFF_HZ = 1.5
+ONE_EURO_BETA = 0.5
+ONE_EURO_SPEED_CUTOFF_HZ = 1.0
+
+
+def smoothing_factor(dt: float, cutoff_hz: float) -> float:
+    """How far a first-order low-pass filter with the given cutoff moves towards a new sample dt seconds on"""
+    r = 2 * math.pi * cutoff_hz * dt
+    return r / (r + 1)
+
+
+def time_constant(cutoff_hz: float) -> float:
+    """How far (in seconds) the output of a first-order low-pass filter lags behind a steadily changing input"""
+    return 1 / (2 * math.pi * cutoff_hz)
+
+
+class StickFilter:
+    """
+    A filter for the position of the joystick, applied to each sample before it is turned into movement. This one
+    passes the samples straight through, subclasses smooth them.
+    """
+    def filter(self, x: float, y: float, timestamp: float) -> tuple[float, float]:
+        """Filter a sample of the stick position taken at the given time (in seconds)"""
+        return x, y
+
+    def reset(self):
+        """Forget the samples so far, e.g. when the stick returns to the centre"""
+        pass
+
+    @property
+    def latency(self) -> float:
+        """How far (in seconds) the output currently lags behind the stick"""
+        return 0.0
+
+    @property
+    def max_latency(self) -> float:
+        """The most the output can lag behind the stick (in seconds)"""
+        return 0.0
+
+
+class OneEuroFilter(StickFilter):
+    """
+    A one euro filter: a low-pass filter whose cutoff rises with the speed the stick is moving at. Held still or moved
+    slowly the jitter is smoothed away, whilst quick, deliberate movements are followed with little lag. The lag is
+    never more than the time constant of the minimum cutoff.
+
+    Both axes are filtered with the same cutoff, from the speed of the stick as a whole, so that smoothing doesn't
+    change the direction it is pushed in.
+    """
+    def __init__(self, min_cutoff_hz: float = ONE_EURO_MIN_CUTOFF_HZ, beta: float = ONE_EURO_BETA,
+                 speed_cutoff_hz: float = ONE_EURO_SPEED_CUTOFF_HZ):
+        self.min_cutoff_hz = min_cutoff_hz
+        self.beta = beta
+        self.speed_cutoff_hz = speed_cutoff_hz
+        self._position = None
+        self._velocity = (0.0, 0.0)
+        self._last_timestamp: Optional[float] = None
+        self._cutoff_hz = min_cutoff_hz
+
+    def filter(self, x: float, y: float, timestamp: float) -> tuple[float, float]:
+        if self._position is None:
+            self._position = (x, y)
+            self._last_timestamp = timestamp
+            return self._position
+        dt = timestamp - self._last_timestamp
+        if dt <= 0:
+            return self._position
+        self._last_timestamp = timestamp
+        last_x, last_y = self._position
+
+        # smooth the stick's velocity, and then use its speed to choose how much to smooth its position
+        a = smoothing_factor(dt, self.speed_cutoff_hz)
+        velocity_x = self._velocity[0] + a * ((x - last_x) / dt - self._velocity[0])
+        velocity_y = self._velocity[1] + a * ((y - last_y) / dt - self._velocity[1])
+        self._velocity = (velocity_x, velocity_y)
+        self._cutoff_hz = self.min_cutoff_hz + self.beta * math.hypot(velocity_x, velocity_y)
+
+        a = smoothing_factor(dt, self._cutoff_hz)
+        self._position = (last_x + a * (x - last_x), last_y + a * (y - last_y))
+        return self._position
+
+    def reset(self):
+        self._position = None
+        self._velocity = (0.0, 0.0)
+        self._last_timestamp = None
+        self._cutoff_hz = self.min_cutoff_hz
+
+    @property
+    def latency(self) -> float:
+        return time_constant(self._cutoff_hz)
+
+    @property
+    def max_latency(self) -> float:
+        return time_constant(self.min_cutoff_hz)
@@ -0,0 +1,35 @@
+import math
+import unittest
+
+import numpy as np
+
+from arcs import fit_arcs
+from simplify import MIN_SEGMENT_LENGTH_MM, SIMPLIFY_TOLERANCE_MM, simplify_stroke
+
+
+class FitArcsTest(unittest.TestCase):
+    def test_square_is_not_an_arc(self):
+        self.assertEqual(fit_arcs(np.array([(0.0, 0.0), (10.0, 0.0), (10.0, 10.0), (0.0, 10.0)])), [])
+
+    def test_hexagon_is_not_an_arc(self):
+        hexagon = np.array([(10 * math.cos(i * math.pi / 3), 10 * math.sin(i * math.pi / 3)) for i in range(6)])
+        self.assertEqual(fit_arcs(hexagon), [])
+
+    def test_densely_sampled_arc_is_fitted(self):
+        points = np.array([(15 * math.cos(t), 15 * math.sin(t)) for t in np.linspace(0, math.pi / 2, 30)])
+        arcs = fit_arcs(points)
+        self.assertEqual(len(arcs), 1)
+        self.assertEqual((arcs[0].start, arcs[0].end), (0, 29))
+        np.testing.assert_allclose(arcs[0].centre, (0, 0), atol=1e-6)
+        self.assertFalse(arcs[0].clockwise)
+
+    def test_simplified_arc_is_fitted(self):
+        for radius in (20, 50):
+            points = [(radius * math.cos(t), radius * math.sin(t)) for t in np.linspace(0, math.pi, 10 * radius)]
+            simplified = np.array(simplify_stroke(points, SIMPLIFY_TOLERANCE_MM, MIN_SEGMENT_LENGTH_MM))
+            arcs = fit_arcs(simplified)
+            self.assertEqual([(arc.start, arc.end) for arc in arcs], [(0, len(simplified) - 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+import numpy as np
+
+from feed_planner import MIN_FEED_RATE_MM_MIN, feed_profile
+from motion_model import MotionModel
+from plotter import MAX_FEED_RATE_PEN_DOWN_MM_MIN
+
+
+class FeedProfileTest(unittest.TestCase):
+    def test_straight_line_is_drawn_at_the_pen_down_rate(self):
+        stroke = np.array([(0.0, 0.0), (10.0, 0.0), (20.0, 0.0), (30.0, 0.0)])
+        self.assertEqual(feed_profile(stroke, MotionModel()), [MAX_FEED_RATE_PEN_DOWN_MM_MIN] * 3)
+
+    def test_hairpin_slows_to_the_minimum(self):
+        stroke = np.array([(0.0, 0.0), (10.0, 0.0), (20.0, 0.0), (10.0, 0.0), (0.0, 0.0)])
+        self.assertEqual(feed_profile(stroke, MotionModel())[1:3], [MIN_FEED_RATE_MM_MIN] * 2)
+
+    def test_right_angle_is_slowed(self):
+        stroke = np.array([(0.0, 0.0), (10.0, 0.0), (10.0, 10.0)])
+        feed_rates = feed_profile(stroke, MotionModel())
+        self.assertEqual(feed_rates[0], feed_rates[1])
+        self.assertLess(feed_rates[0], MAX_FEED_RATE_PEN_DOWN_MM_MIN / 2)
+        self.assertGreater(feed_rates[0], MIN_FEED_RATE_MM_MIN)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import functools
+import math
+
+import numpy as np
+
+
+# Mirror on the x-axis (i.e. x -> -x)
+MIRROR_MATRIX = np.array([[-1.0, 0.0],
+                          [0.0, 1.0]])
+
+
+def rotation_matrix(angle: float) -> np.ndarray:
+    """
+    The matrix that rotates a point counterclockwise by the given angle (in radians) around the origin.
+    """
+    cos, sin = math.cos(angle), math.sin(angle)
+    return np.array([[cos, -sin],
+                     [sin, cos]])
+
+
+@functools.lru_cache(maxsize=None)
+def symmetry_matrices(order: int, mirror: bool) -> np.ndarray:
+    """
+    The stacked (K, 2, 2) transforms for the copies of a drawing in the order they should be drawn.
+
+    The identity (the drawing itself) is not included as it has already been drawn by the time the copies are. These
+    are the rotations by each multiple of 360 / order degrees followed, when mirroring, by the mirror image rotated by
+    every multiple (including zero). The result is cached and read-only.
+    """
+    angle_delta = 2 * math.pi / order
+    rotations = [rotation_matrix(angle_delta * i) for i in range(order)]
+    matrices = rotations[1:]
+    if mirror:
+        matrices += [rotation @ MIRROR_MATRIX for rotation in rotations]
+    stacked = np.array(matrices, dtype=np.float64).reshape(-1, 2, 2)
+    stacked.setflags(write=False)
+    return stacked
+
+
+def as_stroke(drawing) -> np.ndarray:
+    """
+    Convert a drawing (a sequence of (x, y) points) into an (N, 2) array.
+    """
+    return np.asarray(drawing, dtype=np.float64).reshape(-1, 2)
+
+
+def replicate(stroke: np.ndarray, order: int, mirror: bool) -> np.ndarray:
+    """
+    Apply every symmetry transform to the (N, 2) stroke in one go, returning a (K, N, 2) array of copies.
+    """
+    return as_stroke(stroke) @ symmetry_matrices(order, mirror).transpose(0, 2, 1)
@@ -0,0 +1,447 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional, Union
+
+import serial
+
+import drawcore_serial
+import metrics
+from device_state import DeviceState
+from encoder import CommandBatch
+
+logger = logging.getLogger(__name__)
+
+
+# Size of the controller's serial receive buffer (GRBL's default is 128 bytes)
+GRBL_RX_BUFFER_SIZE = 128
+
+# How long to wait for outstanding commands to be acknowledged before giving up (in seconds)
+ACK_TIMEOUT = 30.0
+
+# How long to wait for the response to a status query (in seconds)
+STATUS_TIMEOUT = 1.0
+
+# Realtime commands, which the controller acts on as soon as they arrive rather than going through the receive buffer
+STATUS_QUERY = b"?"
+JOG_CANCEL = b"\x85"
+
+
+class SerialTimeout(ValueError):
+    """
+    The controller didn't answer in time. Unlike an error response this may only mean that the connection to it has
+    been lost.
+    """
+
+
+def split_lines(cmd: str) -> list[str]:
+    """
+    Split a command string into the individual, non-empty lines that the controller will acknowledge.
+    """
+    return [line.strip() for line in cmd.replace('\n', '\r').split('\r') if line.strip()]
+
+
+def encode_lines(cmd: Union[str, bytes]) -> list[bytes]:
+    """
+    Split a command into the lines to send, as bytes and each with its terminating \\r.
+
+    A command given as bytes must be a single line that is already encoded, with its \\r (e.g. by encoder.py), and is
+    sent as it is.
+    """
+    if isinstance(cmd, bytes):
+        return [cmd]
+    return [f"{line}\r".encode('ascii') for line in split_lines(cmd)]
+
+
+def _send_each(send, commands: list[Union[str, bytes]]) -> list[Future]:
+    """
+    Send the commands one at a time, for transports that can't write them together, failing in the same way as
+    `StreamingTransport.send_batch`.
+    """
+    futures = []
+    for i, cmd in enumerate(commands):
+        try:
+            futures.append(send(cmd))
+        except Exception as err:
+            for _ in commands[i:]:
+                future = Future()
+                future.set_exception(err)
+                futures.append(future)
+            err.futures = futures
+            raise
+    return futures
+
+
+class BlockingTransport:
+    """
+    The compatibility transport: each command is written and then we wait for its "ok" before returning.
+
+    This is exactly the behaviour of `drawcore_serial.command` and `drawcore_serial.query`.
+    """
+    def __init__(self, serial_port):
+        self.serial_port = serial_port
+
+    def send(self, cmd: Union[str, bytes]) -> Future:
+        drawcore_serial.command(self.serial_port, cmd)
+        future = Future()
+        future.set_result([])
+        return future
+
+    def send_batch(self, commands: list[Union[str, bytes]]) -> list[Future]:
+        # each command has to be acknowledged before the next is written, so they can't be written together
+        return _send_each(self.send, commands)
+
+    def query(self, cmd: str) -> str:
+        return drawcore_serial.query(self.serial_port, cmd)
+
+    def query_status(self) -> str:
+        return drawcore_serial.query_status(self.serial_port)
+
+    def realtime(self, command: bytes):
+        drawcore_serial.realtime(self.serial_port, command)
+
+    def wait_idle(self, timeout: float = ACK_TIMEOUT):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingTransport:
+    """
+    A transport that writes the bytes of each command to a file rather than sending them to a controller, exactly as
+    the streaming transport would write them (each line with its terminating \r), so that a job can be compiled now
+    and streamed later.
+
+    Nothing answers, so every command succeeds straight away and queries can't be made.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.bytes_written = 0
+
+    def send(self, cmd: Union[str, bytes]) -> Future:
+        for line in encode_lines(cmd):
+            self.bytes_written += self.output.write(line)
+        future = Future()
+        future.set_result([])
+        return future
+
+    def send_batch(self, commands: list[Union[str, bytes]]) -> list[Future]:
+        return _send_each(self.send, commands)
+
+    def query(self, cmd: str) -> str:
+        raise ValueError(f"Can't query the controller whilst recording: {cmd.strip()}")
+
+    def query_status(self) -> str:
+        raise ValueError("Can't query the controller's status whilst recording")
+
+    def realtime(self, command: bytes):
+        raise ValueError(f"Can't send realtime command {command!r} whilst recording")
+
+    def wait_idle(self, timeout: float = ACK_TIMEOUT):
+        pass
+
+    def close(self):
+        pass
+
+
+class _InFlight:
+    def __init__(self, batch: CommandBatch, index: int, future: Future):
+        # the line is left in the batch it was written from rather than copied out of it
+        self.batch = batch
+        self.index = index
+        # including the terminating \r
+        self.length = batch.length(index)
+        self.future = future
+        self.response_lines = []
+        self.sent_time = None
+
+    @property
+    def line(self) -> str:
+        return self.batch.text(self.index)
+
+    @property
+    def type(self) -> str:
+        return metrics.command_type(self.line)
+
+
+class StreamingTransport:
+    """
+    A streaming transport that uses GRBL-style character counting.
+
+    Commands are written as soon as there is room for them in the controller's receive buffer rather than waiting for
+    the previous command's "ok". This keeps the firmware's planner full so that it doesn't decelerate to a stop at the
+    end of every move. Acknowledgements are matched up with commands, in order, by a reader thread. As many lines as
+    there is room for are written at once, so a batch of commands (see `send_batch`) takes few writes.
+
+    The reader thread also passes the status reports and alarms it reads to the device state. Given a status interval,
+    a second thread asks for a status report that often, so that the device state is kept up to date. An alarm fails
+    everything that is in flight, as the controller throws away what it has been sent when it raises one.
+
+    Each call to `send` returns a future that completes with any response lines when the (last line of the) command is
+    acknowledged. Errors reported by the controller are raised from the future and also from the next call to `send`
+    or `wait_idle` so that callers that don't look at the futures still find out.
+    """
+    def __init__(self, serial_port, rx_buffer_size: int = GRBL_RX_BUFFER_SIZE,
+                 device_state: Optional[DeviceState] = None, status_interval: Optional[float] = None):
+        self.serial_port = serial_port
+        self.rx_buffer_size = rx_buffer_size
+        self.device_state = device_state if device_state is not None else DeviceState()
+        self._in_flight = collections.deque()
+        self._bytes_in_flight = 0
+        # futures waiting for status reports, which aren't acknowledged like other commands
+        self._status_futures = collections.deque()
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._error = None
+        self._closed = False
+        self._closing = threading.Event()
+        self._reader_thread = threading.Thread(target=self._read_loop, name="drawcore-reader", daemon=True)
+        self._reader_thread.start()
+        self._poller_thread = None
+        if status_interval:
+            self._poller_thread = threading.Thread(target=self._poll_loop, args=(status_interval,),
+                                                   name="drawcore-status-poller", daemon=True)
+            self._poller_thread.start()
+
+    @property
+    def bytes_in_flight(self) -> int:
+        return self._bytes_in_flight
+
+    def send(self, cmd: Union[str, bytes]) -> Future:
+        """
+        Queue a command for the controller, blocking only while its receive buffer is full.
+        """
+        return self.send_batch([cmd])[0]
+
+    def send_batch(self, commands: list[Union[str, bytes]]) -> list[Future]:
+        """
+        Queue several commands for the controller, returning a future for each. Their lines are written together, as
+        many at a time as there is room for in the receive buffer.
+
+        If writing them fails part way, the futures of the commands that weren't written fail and the exception raised
+        carries the futures for all of the commands as `futures`, as those that were written are still acknowledged.
+        """
+        futures = []
+        # only the last line of a multi-line command resolves the caller's future
+        line_futures = []
+        batch = CommandBatch()
+        for cmd in commands:
+            future = Future()
+            futures.append(future)
+            if isinstance(cmd, bytes):
+                # an encoded line, see encode_lines
+                batch.add(cmd)
+                line_futures.append(future)
+                continue
+            lines = encode_lines(cmd)
+            if not lines:
+                future.set_result([])
+                continue
+            for line in lines:
+                batch.add(line)
+            line_futures.extend(Future() for _ in lines[1:])
+            line_futures.append(future)
+        with self._write_lock:
+            try:
+                self._write_batch(batch, line_futures)
+            except Exception as err:
+                err.futures = futures
+                raise
+        return futures
+
+    def _write_batch(self, batch: CommandBatch, futures: list[Future]):
+        first = 0
+        try:
+            while first < len(batch):
+                if batch.length(first) > self.rx_buffer_size:
+                    raise ValueError(f"Command too long for DrawCore receive buffer: {batch.text(first)}")
+                with self._condition:
+                    self._raise_pending_error()
+                    while self._bytes_in_flight + batch.length(first) > self.rx_buffer_size:
+                        if not self._condition.wait(timeout=ACK_TIMEOUT):
+                            metrics.TIMEOUTS.inc()
+                            raise SerialTimeout(
+                                f"DrawCore Serial Timeout waiting for buffer space: {batch.text(first)}")
+                        self._raise_pending_error()
+                    sent_time = time.perf_counter()
+                    last = first
+                    while last < len(batch) and self._bytes_in_flight + batch.length(last) <= self.rx_buffer_size:
+                        entry = _InFlight(batch, last, futures[last])
+                        entry.sent_time = sent_time
+                        self._in_flight.append(entry)
+                        self._bytes_in_flight += entry.length
+                        last += 1
+                try:
+                    with batch.view(first, last) as data:
+                        self.serial_port.write(data)
+                        metrics.BYTES_WRITTEN.inc(len(data))
+                    metrics.WRITES.inc()
+                except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+                    metrics.ERRORS.inc(type=metrics.command_type(batch.text(first)))
+                    logger.error('Failed after command: {0}'.format(batch.text(first)))
+                    logger.info("Error context:", exc_info=err)
+                    self._fail(err)
+                    raise
+                first = last
+        except Exception as err:
+            # the lines that weren't written fail, those that were are acknowledged as usual (or have already been
+            # failed along with everything else in flight if the write itself failed)
+            for future in futures[first:]:
+                if not future.done():
+                    future.set_exception(err)
+            raise
+
+    def query(self, cmd: str) -> str:
+        """
+        Send a command and wait for its response lines (e.g. `$$`).
+        """
+        return '\n'.join(self.send(cmd).result(timeout=ACK_TIMEOUT))
+
+    def query_status(self) -> str:
+        """
+        Ask for a status report (e.g. `<Idle|MPos:0.000,0.000,0.000|...>`), which is answered straight away even when
+        the receive buffer is full.
+        """
+        future = Future()
+        with self._condition:
+            self._status_futures.append(future)
+        self.realtime(STATUS_QUERY)
+        try:
+            return future.result(timeout=STATUS_TIMEOUT)
+        except TimeoutError:
+            metrics.TIMEOUTS.inc()
+            with self._condition:
+                if future in self._status_futures:
+                    self._status_futures.remove(future)
+            raise SerialTimeout("DrawCore Serial Timeout waiting for status report")
+
+    def realtime(self, command: bytes):
+        """
+        Write a realtime command. These can be written in the middle of a line so don't wait for the write lock.
+        """
+        self.serial_port.write(command)
+        metrics.BYTES_WRITTEN.inc(len(command))
+        metrics.WRITES.inc()
+
+    def wait_idle(self, timeout: float = ACK_TIMEOUT):
+        """
+        Wait until every command that has been sent has been acknowledged by the controller.
+
+        Note that this means the commands have been accepted into the planner, not that the motion has finished.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: not self._in_flight or self._error is not None, timeout=timeout):
+                metrics.TIMEOUTS.inc()
+                raise SerialTimeout(f"DrawCore Serial Timeout with {len(self._in_flight)} commands unacknowledged")
+            self._raise_pending_error()
+
+    def close(self):
+        self._closed = True
+        self._closing.set()
+        if self._poller_thread is not None:
+            self._poller_thread.join(timeout=2.0)
+        self._reader_thread.join(timeout=2.0)
+        with self._condition:
+            self._fail_all(ConnectionError("Transport closed"))
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _fail(self, err: Exception):
+        with self._condition:
+            self._error = err
+            self._fail_all(err)
+
+    def _fail_all(self, err: Exception):
+        while self._in_flight:
+            entry = self._in_flight.popleft()
+            if not entry.future.done():
+                entry.future.set_exception(err)
+        while self._status_futures:
+            self._status_futures.popleft().set_exception(err)
+        self._bytes_in_flight = 0
+        self._condition.notify_all()
+
+    def _read_loop(self):
+        # read whatever has arrived rather than a line at a time, as readline reads a byte at a time
+        received = bytearray()
+        while not self._closed:
+            try:
+                data = self.serial_port.read(self.serial_port.in_waiting or 1)
+            except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+                if self._closed:
+                    break
+                metrics.ERRORS.inc(type="read")
+                logger.error("Error reading serial data")
+                logger.info("Error context:", exc_info=err)
+                self._fail(err)
+                break
+            if not data:
+                continue
+            metrics.BYTES_READ.inc(len(data))
+            received += data
+            start = 0
+            while (end := received.find(b"\n", start)) >= 0:
+                line = received[start:end].decode('ascii').strip()
+                start = end + 1
+                if line:
+                    self._handle_line(line)
+            del received[:start]
+
+    def _poll_loop(self, interval: float):
+        while not self._closing.wait(interval):
+            try:
+                self.realtime(STATUS_QUERY)
+            except (serial.SerialException, IOError, RuntimeError, OSError) as err:
+                if not self._closed:
+                    # the reader thread finds out about the port failing too, so leave it to fail what's in flight
+                    logger.error("Error asking for a status report, no longer polling")
+                    logger.info("Error context:", exc_info=err)
+                break
+
+    def _handle_line(self, line: str):
+        with self._condition:
+            if line.startswith("<"):
+                try:
+                    self.device_state.update(line)
+                except ValueError:
+                    logger.warning(f"Unexpected status report from DrawCore: {line}")
+                if self._status_futures:
+                    self._status_futures.popleft().set_result(line)
+                return
+            if line.startswith("ALARM"):
+                metrics.ERRORS.inc(type="alarm")
+                logger.error(f"DrawCore alarm: {line}")
+                self.device_state.raise_alarm(line)
+                error = ValueError(f"DrawCore alarm: {line}")
+                self._error = error
+                self._fail_all(error)
+                return
+            if not self._in_flight:
+                logger.warning(f"Unexpected response from DrawCore with nothing in flight: {line}")
+                return
+            entry = self._in_flight[0]
+            if line.startswith("ok"):
+                self._complete(entry)
+                entry.future.set_result(entry.response_lines)
+            elif line.startswith("error"):
+                self._complete(entry)
+                metrics.ERRORS.inc(type=entry.type)
+                error = ValueError('\n'.join(('Unexpected response from DrawCore.',
+                                              '    Command: {0}'.format(entry.line),
+                                              '    Response: {0}'.format(line))))
+                entry.future.set_exception(error)
+                self._error = error
+            else:
+                entry.response_lines.append(line)
+
+    def _complete(self, entry: _InFlight):
+        metrics.COMMAND_LATENCY.observe(time.perf_counter() - entry.sent_time, type=entry.type)
+        self._in_flight.popleft()
+        self._bytes_in_flight -= entry.length
+        self._condition.notify_all()
@@ -0,0 +1,413 @@
+import argparse
+import collections
+import logging
+import math
+import os
+import pty
+import re
+import select
+import threading
+import time
+import tty
+from typing import Optional
+
+from motion_model import Block, MotionModel, junction_speed, trapezoid_distance, trapezoid_time
+
+logger = logging.getLogger(__name__)
+
+
+VERSION_STRING = "DrawCore Virtual Firmware Version 1.0.0"
+
+# Settings reported by `$$`, loosely based on an A3 DrawCore
+DEFAULT_SETTINGS = {
+    "$11": 0.010,  # junction deviation (mm)
+    "$110": 10000.0,  # x max rate (mm/min)
+    "$111": 10000.0,  # y max rate (mm/min)
+    "$112": 5000.0,  # z max rate (mm/min)
+    "$120": 1000.0,  # x acceleration (mm/s^2)
+    "$121": 1000.0,  # y acceleration (mm/s^2)
+    "$122": 1000.0,  # z acceleration (mm/s^2)
+    "$130": 294.926,  # x max travel (mm)
+    "$131": 420.0,  # y max travel (mm)
+    "$132": 10.0,  # z max travel (mm)
+}
+
+# Size of the receive buffer and the number of moves the planner can hold (GRBL's defaults)
+DEFAULT_RX_BUFFER_SIZE = 128
+DEFAULT_PLANNER_SIZE = 16
+
+# Time taken to parse each line (in seconds)
+DEFAULT_LINE_LATENCY = 0.0005
+
+# Time taken to home (in seconds)
+HOMING_TIME = 2.0
+
+# Realtime commands
+STATUS_QUERY = ord('?')
+JOG_CANCEL = 0x85
+
+_WORD = re.compile(r"([A-Z])([-+]?[0-9]*\.?[0-9]+)")
+
+
+class VirtualDrawCore:
+    """
+    A simulated DrawCore on a pseudo-terminal, for measuring the serial layer without the hardware.
+
+    Connect to it using the path of the pty. Lines are taken out of a receive buffer of the given size (overflows are
+    counted and logged, as the real hardware would lose the data), take line_latency seconds to process and moves are
+    acknowledged once they are queued in the planner. Moves then take the time given by a trapezoidal motion model using
+    the acceleration, max rate and junction deviation settings, multiplied by time_scale (0 for no motion time).
+    """
+    def __init__(self, rx_buffer_size: int = DEFAULT_RX_BUFFER_SIZE, planner_size: int = DEFAULT_PLANNER_SIZE,
+                 line_latency: float = DEFAULT_LINE_LATENCY, time_scale: float = 1.0,
+                 settings: Optional[dict[str, float]] = None):
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+        self.line_latency = line_latency
+        self.time_scale = time_scale
+        self.settings = dict(DEFAULT_SETTINGS if settings is None else settings)
+        self.model = MotionModel.from_settings(self.settings)
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._rx_buffer = bytearray()
+        self._planner = collections.deque()
+        self._running = False
+        self._threads = []
+
+        # machine position, updated as moves complete, and the time the current move started
+        self._position = (0.0, 0.0, 0.0)
+        self._current_block = None
+        self._current_block_started = 0.0
+        self._current_block_duration = 0.0
+        self._current_block_speeds = (0.0, 0.0)
+        self._jog_cancelled = False
+        self._state = "Idle"
+        # the parser's modal state, the planned position is where the last queued move finishes
+        self._planned_position = (0.0, 0.0, 0.0)
+        self._work_offset = (0.0, 0.0, 0.0)
+        self._absolute = True
+        self._motion = 1
+        self._feed_rate = 1000.0
+
+        self.lines_processed = 0
+        self.overflows = 0
+
+    def start(self) -> str:
+        self._running = True
+        for target in (self._rx_loop, self._process_loop, self._motion_loop):
+            thread = threading.Thread(target=target, name=f"virtual-drawcore-{target.__name__}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Virtual DrawCore listening on {self.path}")
+        return self.path
+
+    def stop(self):
+        self._running = False
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=2.0)
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _write(self, response: str):
+        with self._write_lock:
+            os.write(self._master, f"{response}\r\n".encode('ascii'))
+
+    def _rx_loop(self):
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                break
+            with self._condition:
+                for byte in data:
+                    if self._handle_realtime(byte):
+                        continue
+                    if len(self._rx_buffer) >= self.rx_buffer_size:
+                        self.overflows += 1
+                        logger.warning("Virtual DrawCore receive buffer overflow")
+                    self._rx_buffer.append(byte)
+                self._condition.notify_all()
+
+    def _handle_realtime(self, byte: int) -> bool:
+        # realtime commands are acted on as soon as they arrive, without going through the receive buffer
+        if byte == STATUS_QUERY:
+            self._write(self._status_report())
+            return True
+        if byte == JOG_CANCEL:
+            self._cancel_jog()
+            return True
+        return False
+
+    def _cancel_jog(self):
+        # drop the queued jogs and stop the current one where it is (the real hardware decelerates to a stop)
+        with self._condition:
+            current = self._current_block
+            if current is not None and current.jog:
+                self._jog_cancelled = True
+            elif current is None and any(block.jog for block in self._planner):
+                self._planned_position = self._position
+            self._planner = collections.deque(block for block in self._planner if block is current or not block.jog)
+            self._condition.notify_all()
+
+    def _status_report(self) -> str:
+        x, y, z = self._current_position()
+        wx, wy, wz = self._work_offset
+        feed = self._current_block.nominal_speed * 60 if self._current_block else 0
+        return (f"<{self._state}|MPos:{x:.3f},{y:.3f},{z:.3f}"
+                f"|Bf:{self.planner_size - len(self._planner)},{self.rx_buffer_size - len(self._rx_buffer)}"
+                f"|FS:{feed:.0f},0|WCO:{wx:.3f},{wy:.3f},{wz:.3f}>")
+
+    def _current_position(self) -> tuple[float, float, float]:
+        # interpolate along the current move (along the chord for arcs)
+        block = self._current_block
+        if block is None:
+            return self._position
+        if self._current_block_duration <= 0:
+            return block.target
+        # the motion model's time, which is scaled when running the moves faster or slower
+        elapsed = (time.monotonic() - self._current_block_started) / self.time_scale
+        entry_speed, exit_speed = self._current_block_speeds
+        distance = trapezoid_distance(elapsed, block.length, entry_speed, block.nominal_speed, exit_speed,
+                                      block.acceleration)
+        progress = distance / block.length
+        return tuple(s + (t - s) * progress for s, t in zip(block.start, block.target))
+
+    def _next_line(self) -> Optional[str]:
+        with self._condition:
+            while self._running:
+                for terminator in (b'\r', b'\n'):
+                    index = self._rx_buffer.find(terminator)
+                    if index >= 0:
+                        break
+                else:
+                    self._condition.wait(timeout=0.1)
+                    continue
+                line = bytes(self._rx_buffer[:index])
+                del self._rx_buffer[:index + 1]
+                return line.decode('ascii', errors='replace').strip()
+        return None
+
+    def _process_loop(self):
+        while self._running:
+            line = self._next_line()
+            if line is None:
+                break
+            if not line:
+                continue
+            if self.line_latency:
+                time.sleep(self.line_latency)
+            self.lines_processed += 1
+            try:
+                response = self._execute(line)
+            except ValueError:
+                response = "error:20"  # unsupported or invalid command
+            if response is not None:
+                self._write(response)
+
+    def _execute(self, line: str) -> Optional[str]:
+        upper = line.upper()
+        if upper == "V":
+            return VERSION_STRING  # the version is the only response, there is no "ok"
+        if upper == "$$":
+            for setting, value in self.settings.items():
+                self._write(f"{setting}={value:.3f}")
+            return "ok"
+        if upper == "$H":
+            self._wait_for_planner_empty()
+            self._state = "Home"
+            time.sleep(HOMING_TIME * self.time_scale)
+            with self._condition:
+                self._position = self._planned_position = (0.0, 0.0, 0.0)
+                self._state = "Idle"
+            return "ok"
+        if upper == "$SLP":
+            self._wait_for_planner_empty()
+            self._state = "Sleep"
+            return "ok"
+        if upper.startswith("$J="):
+            return self._execute_jog(upper[3:])
+        if upper.startswith("$"):
+            raise ValueError(line)
+        return self._execute_gcode(upper)
+
+    def _execute_jog(self, line: str) -> str:
+        # a jog's G90/G91 and feed rate only apply to the jog, they don't change the parser's modal state
+        with self._condition:
+            if any(not block.jog for block in self._planner) or self._state not in ("Idle", "Jog", "Sleep"):
+                return "error:8"  # only allowed when idle or jogging
+        words = _WORD.findall(line.replace(" ", ""))
+        if not words or "".join(letter + value for letter, value in words) != line.replace(" ", ""):
+            raise ValueError(line)
+        absolute = self._absolute
+        axes = {}
+        feed_rate = None
+        for letter, value in words:
+            number = float(value)
+            if letter == "G" and number in (90, 91):
+                absolute = number == 90
+            elif letter in "XYZ":
+                axes["XYZ".index(letter)] = number
+            elif letter == "F":
+                feed_rate = number
+            else:
+                raise ValueError(line)
+        if feed_rate is None or not axes:
+            raise ValueError(line)
+        self._queue_move(axes, {}, absolute=absolute, motion=1, feed_rate=feed_rate, jog=True)
+        return "ok"
+
+    def _execute_gcode(self, line: str) -> str:
+        words = _WORD.findall(line.replace(" ", ""))
+        if not words or "".join(letter + value for letter, value in words) != line.replace(" ", ""):
+            raise ValueError(line)
+        axes = {}
+        offsets = {}
+        dwell = None
+        set_offset = False
+        for letter, value in words:
+            number = float(value)
+            if letter == "G":
+                if number in (0, 1, 2, 3):
+                    self._motion = int(number)
+                elif number == 90:
+                    self._absolute = True
+                elif number == 91:
+                    self._absolute = False
+                elif number == 92:
+                    set_offset = True
+                elif number == 4:
+                    dwell = 0.0
+                else:
+                    raise ValueError(line)
+            elif letter in "XYZ":
+                axes["XYZ".index(letter)] = number
+            elif letter in "IJ":
+                offsets["IJ".index(letter)] = number
+            elif letter == "F":
+                self._feed_rate = number
+            elif letter == "P" and dwell is not None:
+                dwell = number
+            else:
+                raise ValueError(line)
+
+        if dwell is not None:
+            self._wait_for_planner_empty()
+            time.sleep(dwell * self.time_scale)
+        elif set_offset:
+            with self._condition:
+                self._work_offset = tuple(self._planned_position[i] - axes[i] if i in axes else self._work_offset[i]
+                                          for i in range(3))
+        elif axes:
+            self._queue_move(axes, offsets, absolute=self._absolute, motion=self._motion, feed_rate=self._feed_rate)
+        return "ok"
+
+    def _queue_move(self, axes: dict[int, float], offsets: dict[int, float], absolute: bool, motion: int,
+                    feed_rate: float, jog: bool = False):
+        start = self._planned_position
+        if absolute:
+            target = tuple(axes[i] + self._work_offset[i] if i in axes else start[i] for i in range(3))
+        else:
+            target = tuple(start[i] + axes.get(i, 0.0) for i in range(3))
+
+        centre = (start[0] + offsets.get(0, 0.0), start[1] + offsets.get(1, 0.0))
+        block = self.model.block(start, target, feed_rate, motion, centre, jog)
+        if block is None:
+            return
+
+        with self._condition:
+            while len(self._planner) >= self.planner_size and self._running:
+                self._condition.wait(timeout=0.1)
+            self._planner.append(block)
+            self._planned_position = target
+            if self._state == "Sleep":
+                self._state = "Idle"
+            self._condition.notify_all()
+
+    def _wait_for_planner_empty(self):
+        with self._condition:
+            while (self._planner or self._current_block is not None) and self._running:
+                self._condition.wait(timeout=0.1)
+
+    def _block_duration(self, block: Block, entry_speed: float, exit_speed: float) -> float:
+        return trapezoid_time(block.length, entry_speed, block.nominal_speed, exit_speed, block.acceleration)
+
+    def _motion_loop(self):
+        entry_speed = 0.0
+        while self._running:
+            with self._condition:
+                if not self._planner:
+                    entry_speed = 0.0
+                    self._condition.wait(timeout=0.1)
+                    continue
+                block = self._planner[0]
+                following = self._planner[1] if len(self._planner) > 1 else None
+                # only moves already in the planner can be joined on to, otherwise we have to stop
+                exit_speed = 0.0
+                if following is not None:
+                    exit_speed = junction_speed(block, following, self.model.junction_deviation)
+                    exit_speed = min(exit_speed, math.sqrt(entry_speed ** 2 + 2 * block.acceleration * block.length))
+                self._current_block = block
+                self._current_block_started = time.monotonic()
+                self._current_block_duration = self._block_duration(block, entry_speed, exit_speed) * self.time_scale
+                self._current_block_speeds = (entry_speed, exit_speed)
+                self._state = "Jog" if block.jog else "Run"
+                # wait for the move to finish, unless it is a jog that is cancelled
+                finish = self._current_block_started + self._current_block_duration
+                while self._running and not self._jog_cancelled and (remaining := finish - time.monotonic()) > 0:
+                    self._condition.wait(timeout=remaining)
+                if self._jog_cancelled:
+                    self._position = self._planned_position = self._current_position()
+                    self._jog_cancelled = False
+                    exit_speed = 0.0
+                else:
+                    self._position = block.target
+                self._planner.popleft()
+                self._current_block = None
+                if not self._planner:
+                    self._state = "Idle"
+                self._condition.notify_all()
+            entry_speed = exit_speed
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s [%(levelname)s] %(message)s')
+
+    parser = argparse.ArgumentParser(description="Run a simulated DrawCore on a pseudo-terminal")
+    parser.add_argument("--rx-buffer-size", type=int, default=DEFAULT_RX_BUFFER_SIZE)
+    parser.add_argument("--planner-size", type=int, default=DEFAULT_PLANNER_SIZE)
+    parser.add_argument("--line-latency", type=float, default=DEFAULT_LINE_LATENCY,
+                        help="time taken to process each line (in seconds)")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="multiplier for the time moves take, 0 for instant moves")
+    args = parser.parse_args()
+
+    device = VirtualDrawCore(rx_buffer_size=args.rx_buffer_size, planner_size=args.planner_size,
+                             line_latency=args.line_latency, time_scale=args.time_scale)
+    with device:
+        print(device.path, flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()